@@ -0,0 +1,222 @@
+'''
+Streaming export of the tables of cores.db to CSV files
+
+The rows are read from the cursor in chunks (fetchmany) and written as they come,
+so the memory used does not depend on the size of the table.
+
+Incremental export (export_delta): each destination folder holds a manifest.json that lists
+the deltas written so far and the high-water mark of the last one (last events.id, last change of a user
+and the ids of the sessions that were still open). The next delta only contains new or changed rows.
+
+Usage:  python -m backend.export events --gzip --since "2024-01-01" --until "2024-07-01"
+        python -m backend.export --incremental /path/to/destination --gzip
+'''
+import csv
+import gzip
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime
+from backend.main import cores_db, OPEN_SESSION
+
+# tables that can be exported, and the timestamp column used by the date-range filter
+EXPORTABLE_TABLES = {'users': 'last_mod',
+                     'events': 'login_time'}
+
+CHUNK_SIZE = 5000   # rows per fetchmany()
+
+# time of the last change of a user: every write of a user sets last_mod, except a login (last_login only)
+USER_CHANGED = "max(COALESCE(last_mod, ''), COALESCE(last_login, ''))"
+
+
+def default_export_path(table_name, compress=False):
+    '''~/Downloads/<table>_<date>.csv (.csv.gz if compressed)'''
+    # Get today's date to append to the file name
+    today = datetime.now().strftime('%Y_%m_%d')
+    file_name = f"{table_name}_{today}.csv" + (".gz" if compress else "")
+    # Define a path to save the file in the user's home directory
+    home_dir = os.path.expanduser('~')  # Gets the user's home directory
+    return os.path.join(home_dir, 'Downloads', file_name)  # Saves in the Downloads folder
+
+
+def open_csv_file(file_path, compress=False):
+    if compress:
+        return gzip.open(file_path, 'wt', compresslevel=6, newline='', encoding='utf-8')
+    return open(file_path, 'w', newline='', encoding='utf-8')
+
+
+def stream_rows(cursor, chunk_size=CHUNK_SIZE):
+    '''Yield lists of rows from an executed cursor, chunk_size rows at a time'''
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def write_csv(cursor, file_path, compress=False, chunk_size=CHUNK_SIZE, progress=None):
+    '''Write the header and the rows of an executed cursor to file_path, chunk by chunk.
+       progress: optional callback progress(rows_written, rows_per_sec) called after each chunk
+       Returns the number of rows written.'''
+    column_names = [description[0] for description in cursor.description]
+    row_count = 0
+    start = time.perf_counter()
+    with open_csv_file(file_path, compress) as csv_file:
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(column_names)  # Write the headers first
+        for rows in stream_rows(cursor, chunk_size):
+            csv_writer.writerows(rows)
+            row_count += len(rows)
+            if progress:
+                progress(row_count, row_count / max(time.perf_counter() - start, 1e-9))
+    return row_count
+
+
+def export_table_to_csv(table_name, file_path=None, compress=False, limit=None, since=None, until=None,
+                        chunk_size=CHUNK_SIZE, progress=None):
+    '''Export one table to a CSV file (default: ~/Downloads/<table>_<date>.csv) without loading it in memory.
+       compress:     write a gzip file (.csv.gz)
+       limit:        maximum number of rows
+       since, until: '%Y-%m-%d[ %H:%M:%S]' range on the timestamp column of the table (until is exclusive)
+       progress:     optional callback progress(rows_written, rows_per_sec)
+       Returns the path of the file, or False if the export failed.'''
+    if table_name not in EXPORTABLE_TABLES:
+        print(f"Error: table '{table_name}' cannot be exported.")
+        return False
+    if file_path is None:
+        file_path = default_export_path(table_name, compress)
+
+    time_column = EXPORTABLE_TABLES[table_name]
+    conditions, params = [], []
+    if since:
+        conditions.append(f"{time_column} >= ?")
+        params.append(since)
+    if until:
+        conditions.append(f"{time_column} < ?")
+        params.append(until)
+    sql = f"SELECT * FROM {table_name}"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY id"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+
+    start = time.perf_counter()
+    try:
+        with cores_db() as conn:
+            cursor = conn.execute(sql, params)
+            row_count = write_csv(cursor, file_path, compress, chunk_size, progress)
+    except (sqlite3.Error, OSError) as e:
+        print(f"Failed to export {table_name} to {file_path}: {e}")
+        return False
+
+    elapsed = time.perf_counter() - start
+    print(f"Exported {row_count} rows of {table_name} to {file_path} in {elapsed:.2f} s "
+          f"({row_count / max(elapsed, 1e-9):.0f} rows/s)")
+    return file_path
+
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def read_manifest(destination):
+    '''Returns the manifest of a destination folder (an empty one if there is none yet)'''
+    path = os.path.join(destination, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {'format': 1, 'key': 'id', 'deltas': []}
+    with open(path, 'r', encoding='utf-8') as manifest_file:
+        return json.load(manifest_file)
+
+
+def write_manifest(destination, manifest):
+    '''Write the manifest atomically: a reader never sees a half-written file'''
+    path = os.path.join(destination, MANIFEST_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def export_delta(destination, compress=False, progress=None):
+    '''Export the rows of 'events' and 'users' that are new or changed since the last export to `destination`.
+       - events: id above the last exported id, plus the sessions that were still open last time
+                 (their logout has been recorded since)
+       - users:  last change (USER_CHANGED: last_mod or last_login) at or after the last exported one (rows changed
+                 in the same second are repeated), plus the users without last_mod (their changes are not dated)
+       A row may appear in several deltas: the most recent delta wins (key: id).
+       Both tables are read from the same snapshot of the database.
+       progress: optional callback progress(table_name, rows_written, rows_per_sec)
+       Returns the manifest entry of the new delta, or None if the export failed.'''
+    os.makedirs(destination, exist_ok=True)
+    manifest = read_manifest(destination)
+    previous = manifest['deltas'][-1]['watermark'] if manifest['deltas'] else \
+               {'last_event_id': 0, 'last_user_mod': '', 'open_event_ids': []}
+    sequence = len(manifest['deltas']) + 1
+    extension = ".csv.gz" if compress else ".csv"
+    files = {table_name: f"{table_name}_delta_{sequence:05d}{extension}" for table_name in ('events', 'users')}
+    rows = {}
+
+    def report(table_name):
+        return (lambda count, rate: progress(table_name, count, rate)) if progress else None
+
+    start = time.perf_counter()
+    try:
+        with cores_db() as conn:
+            conn.execute("BEGIN")   # one read snapshot for both tables and for the new watermark
+            cursor = conn.execute(f"""--sql
+                SELECT * FROM events
+                WHERE  id > ? OR id IN (SELECT value FROM json_each(?))
+                ORDER BY id
+            """, (previous['last_event_id'], json.dumps(previous['open_event_ids'])))
+            rows['events'] = write_csv(cursor, os.path.join(destination, files['events']), compress,
+                                       progress=report('events'))
+            cursor = conn.execute(f"SELECT * FROM users WHERE last_mod IS NULL OR {USER_CHANGED} >= ? ORDER BY id",
+                                  (previous['last_user_mod'],))
+            rows['users'] = write_csv(cursor, os.path.join(destination, files['users']), compress,
+                                      progress=report('users'))
+
+            (last_event_id,) = conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()
+            (last_user_mod,) = conn.execute(f"SELECT COALESCE(MAX({USER_CHANGED}), '') FROM users").fetchone()
+            open_event_ids = [row[0] for row in conn.execute(f"SELECT id FROM events WHERE {OPEN_SESSION}")]
+    except (sqlite3.Error, OSError) as e:
+        print(f"Failed to export delta to {destination}: {e}")
+        return None
+
+    delta = {'sequence': sequence,
+             'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+             'files': files,
+             'rows': rows,
+             'since': previous,
+             'watermark': {'last_event_id': last_event_id,
+                           'last_user_mod': last_user_mod,
+                           'open_event_ids': open_event_ids}}
+    manifest['deltas'].append(delta)
+    write_manifest(destination, manifest)   # written last: a failed export leaves the previous watermark
+
+    elapsed = time.perf_counter() - start
+    print(f"Exported delta {sequence} to {destination}: {rows['events']} events, {rows['users']} users "
+          f"in {elapsed:.2f} s")
+    return delta
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Export a table of cores.db to CSV.")
+    parser.add_argument('table', nargs='?', choices=EXPORTABLE_TABLES.keys())
+    parser.add_argument('--incremental', metavar='DESTINATION',
+                        help="export only the rows that are new or changed since the last export to this folder")
+    parser.add_argument('--output', help="path of the CSV file (default: ~/Downloads/<table>_<date>.csv)")
+    parser.add_argument('--gzip', action='store_true', help="write a gzip-compressed file")
+    parser.add_argument('--limit', type=int, help="maximum number of rows")
+    parser.add_argument('--since', help="first date/time included, e.g. 2024-01-01")
+    parser.add_argument('--until', help="date/time excluded, e.g. 2024-07-01")
+    args = parser.parse_args()
+    if args.incremental:
+        export_delta(args.incremental, args.gzip)
+    elif args.table:
+        export_table_to_csv(args.table, args.output, args.gzip, args.limit, args.since, args.until)
+    else:
+        parser.error("a table or --incremental is required")
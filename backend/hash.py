@@ -2,10 +2,12 @@ import os
 from hashlib import blake2b
 from base64 import b64encode, b64decode
 
-def get_salt_hash(email, password):
-    '''generate salt and hash for email (used as username) and password'''
+def get_salt_hash(email, password, salt_bytes=None):
+    '''generate salt and hash for email (used as username) and password
+       salt_bytes: blake2b.SALT_SIZE bytes to use as salt (default: random; given by the test data generators)'''
     msg = bytes((email + password), 'utf-8')
-    salt_bytes = os.urandom(blake2b.SALT_SIZE)
+    if salt_bytes is None:
+        salt_bytes = os.urandom(blake2b.SALT_SIZE)
     salt_string = b64encode(salt_bytes).decode('utf-8')     
     hash = blake2b(salt=salt_bytes)
     hash.update(msg)
@@ -0,0 +1,236 @@
+'''
+Ingestion server for the login/logout events of many kiosks (optional "remote events" mode)
+
+The kiosks post their events in batches (backend/remote.py) over persistent keep-alive HTTP/1.1
+connections; one writer task groups the batches waiting in the queue and writes them in a single
+transaction of the central database, so 20+ instruments never compete for the lock of a shared file.
+A request is answered only after its events are committed. A batch that cannot be written (database error,
+or an entry the SQL rejects) fails alone: the writer task keeps serving the other clients.
+
+Protocol (JSON):
+    POST /events   {"events": [entry, ...]}   ->  200 {"accepted": n}   (entries: journal line format,
+                                                  see backend/journal.py; upserted by natural key)
+    GET  /health                              ->  200 {"status": "ok", "events_written": n}
+
+Usage:  python -m backend.ingest central.db --host 0.0.0.0 --port 8765
+'''
+import asyncio
+import json
+import sqlite3
+import time
+from backend.journal import write_entries
+from backend.merge import open_central_db
+
+MAX_BODY_SIZE = 10 * 1024 * 1024   # bytes per request
+MAX_GROUP_SIZE = 5000              # events per transaction of the writer task
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 422: 'Unprocessable Entity',
+           503: 'Service Unavailable'}
+
+
+class BadRequest(Exception):
+    pass
+
+
+def validate_entries(payload):
+    '''Returns the list of entries of a POST /events payload; raises BadRequest if it is not valid'''
+    if not isinstance(payload, dict) or not isinstance(payload.get('events'), list):
+        raise BadRequest("expected {\"events\": [...]}")
+    for entry in payload['events']:
+        if not isinstance(entry, dict) or entry.get('op') not in ('login', 'logout', 'heartbeat'):
+            raise BadRequest("every event needs an 'op' of 'login', 'logout' or 'heartbeat'")
+        for key in ('email', 'device', 'login_time'):
+            if not isinstance(entry.get(key), str):
+                raise BadRequest(f"every event needs a text '{key}'")
+    return payload['events']
+
+
+class IngestServer:
+    def __init__(self, path_to_central_db, host='127.0.0.1', port=8765):
+        self.path_to_central_db = path_to_central_db
+        self.host = host
+        self.port = port
+        self.events_written = 0
+        self._conn = None
+        self._queue = None
+        self._server = None
+        self._writer_task = None
+        self._connections = set()       # stream writers of the open client connections
+
+    async def start(self):
+        # the connection is only used by the writer task, one to_thread() call at a time
+        self._conn = open_central_db(self.path_to_central_db, check_same_thread=False)
+        self._queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._write_loop())
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]     # the actual port if port=0
+        print(f"Ingestion server listening on {self.host}:{self.port} (database: {self.path_to_central_db})")
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._connections):     # keep-alive connections stay open otherwise
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            self._writer_task = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    async def submit(self, entries):
+        '''Queue a batch for the writer task; returns when it is committed (raises the error of the write otherwise)'''
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((entries, future))
+        return await future
+
+    # ---------------------------------------------------------------- writer task
+    def _write(self, entries):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            write_entries(self._conn, entries)
+            self._conn.execute("COMMIT")
+        except Exception:
+            if self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            raise
+
+    async def _write_group(self, group):
+        '''Write the batches of the group in one transaction; returns {batch index: error} (empty: all written).
+           If the transaction fails, the batches are written one per transaction to isolate the failing ones.'''
+        try:
+            await asyncio.to_thread(self._write, [entry for batch, _ in group for entry in batch])
+            self.events_written += sum(len(batch) for batch, _ in group)
+            return {}
+        except Exception as e:
+            if len(group) == 1:
+                return {0: e}
+        errors = {}
+        for index, (batch, _) in enumerate(group):
+            try:
+                await asyncio.to_thread(self._write, batch)
+                self.events_written += len(batch)
+            except Exception as e:
+                errors[index] = e
+        return errors
+
+    async def _write_loop(self):
+        while True:
+            # wait for one batch, then take the batches already waiting: one transaction for all of them
+            group = [await self._queue.get()]
+            event_count = len(group[0][0])
+            while not self._queue.empty() and event_count < MAX_GROUP_SIZE:
+                group.append(self._queue.get_nowait())
+                event_count += len(group[-1][0])
+            try:
+                errors = await self._write_group(group)
+            except Exception as e:      # never let the task die: the clients would wait forever
+                errors = dict.fromkeys(range(len(group)), e)
+            for index, (_, future) in enumerate(group):
+                if future.done():       # the client went away
+                    continue
+                error = errors.get(index)
+                if error is None:
+                    future.set_result(None)
+                else:
+                    print("Error while writing events:", error)
+                    future.set_exception(error)
+
+    # ---------------------------------------------------------------- HTTP/1.1 (keep-alive)
+    async def _handle_connection(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, response = await self._dispatch(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self._write_response(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except BadRequest as e:
+            self._write_response(writer, 400, {'error': str(e)}, keep_alive=False)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _read_request(self, reader):
+        '''Returns (method, path, headers, body), or None when the client closed the connection'''
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, path, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise BadRequest("malformed request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise BadRequest("malformed Content-Length")
+        if length > MAX_BODY_SIZE:
+            raise BadRequest("request body too large")
+        body = await reader.readexactly(length) if length else b''
+        return method, path, headers, body
+
+    async def _dispatch(self, method, path, body):
+        if path == '/health':
+            return 200, {'status': 'ok', 'events_written': self.events_written}
+        if path != '/events':
+            return 404, {'error': f"unknown path {path}"}
+        if method != 'POST':
+            return 405, {'error': "use POST"}
+        try:
+            entries = validate_entries(json.loads(body))
+        except (BadRequest, ValueError) as e:
+            return 400, {'error': str(e)}
+        try:
+            await self.submit(entries)
+        except sqlite3.Error as e:
+            return 503, {'error': str(e)}
+        except Exception as e:          # the entries could not be written (e.g. a value of the wrong type)
+            return 422, {'error': f"{type(e).__name__}: {e}"}
+        return 200, {'accepted': len(entries)}
+
+    def _write_response(self, writer, status, response, keep_alive=True):
+        body = json.dumps(response).encode('utf-8')
+        head = (f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Receive the login/logout events of the kiosks into a central database.")
+    parser.add_argument('central', help="path of the central database (created if it does not exist)")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on (0.0.0.0: all interfaces)")
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    server = IngestServer(args.central, args.host, args.port)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print(f"Stopped after {time.perf_counter() - start:.0f} s, {server.events_written} events written.")
@@ -0,0 +1,127 @@
+'''
+Local journal of login/logout events (JSON Lines)
+
+When cores.db cannot be reached or locked, the background writer appends the events to this
+append-only file on the local disk, and they are replayed into the database once it is back.
+- events are identified by their natural key (device, email, login_time), not by a row id,
+  so that a replay can be repeated safely (idempotent)
+- the file is fsync-ed once per batch of the writer (sync()), not once per line
+- a replay is one transaction: one executemany for the logins, one for the logouts (write_entries(),
+  also used by the ingestion server)
+
+Line formats:
+    {"op": "login",  "email": ..., "device": ..., "login_time": ..., "login_type": ..., "logout_time": ..., "logout_type": ...}
+    {"op": "logout", "email": ..., "device": ..., "login_time": ..., "logout_time": ..., "logout_type": ...}
+    {"op": "heartbeat", "email": ..., "device": ..., "login_time": ..., "last_seen": ...}   (remote mode only)
+'''
+import json
+import os
+import threading
+from backend.records import EVENT_COLUMNS
+
+DEFAULT_JOURNAL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'events_journal.jsonl')
+
+# keys of an entry: the columns of 'events' but the id (missing keys are written as NULL)
+EMPTY_ENTRY = dict.fromkeys(col for col in EVENT_COLUMNS if col != 'id')
+
+
+def write_entries(conn, entries):
+    '''Upsert a list of entries (journal line format) by natural key with `conn` (no commit).
+       Shared by the journal replay and the ingestion server (backend/ingest.py); requires the unique
+       index uq_events_natural_key (migration 3). Writing the same entries twice changes nothing, and
+       a logout received before its login creates the row, completed when the login arrives.
+       Returns the number of entries written.'''
+    logins = [dict(EMPTY_ENTRY, **entry) for entry in entries if entry.get('op') == 'login']
+    logouts = [dict(EMPTY_ENTRY, **entry) for entry in entries if entry.get('op') == 'logout']
+    heartbeats = [dict(EMPTY_ENTRY, **entry) for entry in entries if entry.get('op') == 'heartbeat']
+    conn.executemany("""--sql
+        INSERT INTO events (email, device, login_time, login_type, logout_time, logout_type)
+        VALUES (:email, :device, :login_time, :login_type, :logout_time, :logout_type)
+        ON CONFLICT (device, login_time, email) DO UPDATE SET login_type = excluded.login_type
+    """, logins)
+    conn.executemany("""--sql
+        INSERT INTO events (email, device, login_time, logout_time, logout_type)
+        VALUES (:email, :device, :login_time, :logout_time, :logout_type)
+        ON CONFLICT (device, login_time, email) DO UPDATE
+            SET logout_time = excluded.logout_time, logout_type = excluded.logout_type
+    """, logouts)
+    conn.executemany("""--sql
+        UPDATE events SET last_seen = :last_seen
+        WHERE  device = :device AND login_time = :login_time AND email = :email
+          AND  (last_seen IS NULL OR last_seen < :last_seen)
+    """, heartbeats)
+    return len(logins) + len(logouts) + len(heartbeats)
+
+
+class EventJournal:
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_JOURNAL
+        self._lock = threading.Lock()
+        self._file = None
+        self._dirty = False                          # written but not fsync-ed yet
+        self.entry_count = len(self.read())          # entries waiting to be replayed
+
+    def has_entries(self):
+        return self.entry_count > 0
+
+    def append(self, entry):
+        '''Append one event (dict with an 'op' key); durable after the next sync()'''
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line)
+            self._file.flush()
+            self._dirty = True
+            self.entry_count += 1
+
+    def sync(self):
+        '''fsync the lines appended since the last call (called once per batch of the writer)'''
+        with self._lock:
+            if self._dirty and self._file is not None:
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    def read(self):
+        '''Returns the list of entries (a line cut by a crash, always the last one, is ignored)'''
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, 'r', encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print("Warning: incomplete line ignored in the events journal.")
+        return entries
+
+    def discard(self, count):
+        '''Remove the first `count` entries (the ones replayed), keeping the ones appended since'''
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            remaining = self.read()[count:]
+            with open(self.path + '.tmp', 'w', encoding='utf-8') as journal_file:
+                for entry in remaining:
+                    journal_file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            os.replace(self.path + '.tmp', self.path)
+            self._dirty = False
+            self.entry_count = len(remaining)
+
+    def replay(self, conn):
+        '''Write the journaled events with `conn` (the caller commits, then calls discard()).
+           Events already in the database are merged (natural key), so a replay can be repeated.
+           Returns the number of entries read.'''
+        entries = self.read()
+        write_entries(conn, entries)
+        return len(entries)
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -1,83 +1,379 @@
 # This module cannot be called be_sqlite3 becaseu it does not import well (it needs the second underscore before 3)
 import sqlite3
 import os
-from datetime import datetime
+import math
+import atexit
+import pathlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from backend.hash import get_salt_hash, authenticate
-import csv
+from backend.writer import BackgroundWriter
+from backend.journal import EventJournal, write_entries
+from backend.remote import RemoteEventSink
+from backend.sqlstats import sql_stats, InstrumentedConnection
+from backend.records import (USER_SCHEMA, EVENT_SCHEMA, USER_COLUMNS, EVENT_COLUMNS, SELECT_USERS, SELECT_EVENTS,
+                             UserRecord, EventRecord, row_factory)
+
+
+# format of all the timestamps stored in cores.db
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def format_time(value=None):
+    '''Timestamp of cores.db for a datetime (default: now); strings are returned unchanged'''
+    if isinstance(value, str):
+        return value
+    return (value or datetime.now()).strftime(TIME_FORMAT)
 
 
 # define a dictionary that sets the attributes of the class User and the columns of the table 'users'
 def init_user_dict():
-    # the values are used simply to show the formatting. The User class is set with None values. 
-    user_dict = {   'id'             : '123',
-                    'email'          : 'John.Doe@mail.edu',         # previously named user_id 
-                    'name'           : 'John Doe',                  # previously named user_name
-                    'nickname'       : 'Nick',                      # previously named user_nickname
-                    'title'          : 'PI | PhD student | Tech',    # the title is retried from iLab
-                    'phone'          : '123-456-7890', 	            # previously user_phone
-                    'pi_name'        : 'Dr. Pie',
-                    'pi_phone'       : '555-555-5555',
-                    'type'           : 'user | admin',              # previously user_type
-                    'last_mod_type'  : 'iLab',
-                    'last_mod'       : '2023-08-18 21:20:00',
-                    'first_login'    : '2023-07-17 17:20:00',
-                    'last_login'     : '2023-07-18 09:20:00',
-                    'salt'           : '12345678901234567890',
-                    'hash'           : 'ofiae98aeikjs;aelsij',
-                    'login_attempts' : '1', 
-                    'locked_after'   : '2024-12-31 00:00:00'  }
-    return user_dict
+    # the values are used simply to show the formatting (the schema is defined in backend/records.py).
+    # The User class is set with None values.
+    return dict(USER_SCHEMA)
+
+
+class UserCache:
+    '''Bounded LRU cache of the rows of 'users' (dicts column -> value), by id and by email.
+       - emails are compared case-insensitively, like the unique index on users(email)
+       - every write path of this module invalidates the rows it changes; authenticate_user() also
+         drops a row whose last_mod no longer matches the database (changed by another process):
+         every write of a user sets last_mod, except the last_login of a login
+       - get() returns a copy: callers can modify it freely
+       hits/misses are counted for monitoring (stats()).'''
+    def __init__(self, max_size=512):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()      # id -> row, least recently used first
+        self._ids = {}                  # email (lower case) -> id
+        self._lock = threading.Lock()
 
+    @staticmethod
+    def email_key(email):
+        return email.lower() if isinstance(email, str) else email
+
+    def get(self, id=None, email=None):
+        '''Returns a copy of the cached row (by id, or by email), or None (a miss)'''
+        with self._lock:
+            if id is None:
+                id = self._ids.get(self.email_key(email))
+            row = self._rows.get(id)
+            if row is None:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(id)
+            self.hits += 1
+            return dict(row)
+
+    def put(self, row):
+        '''Cache a row read from the database (dict with at least 'id' and 'email')'''
+        with self._lock:
+            self._remove(row['id'])
+            self._remove(self._ids.get(self.email_key(row['email'])))
+            self._rows[row['id']] = dict(row)
+            self._ids[self.email_key(row['email'])] = row['id']
+            while len(self._rows) > self.max_size:
+                _, oldest = self._rows.popitem(last=False)
+                self._ids.pop(self.email_key(oldest['email']), None)
+
+    def update(self, email, **values):
+        '''Apply values written to the database to the cached row of `email` (if cached)'''
+        with self._lock:
+            row = self._rows.get(self._ids.get(self.email_key(email)))
+            if row is not None:
+                row.update(values)
+
+    def invalidate(self, id=None, email=None):
+        '''Drop the row with this id and/or this email'''
+        with self._lock:
+            self._remove(id)
+            self._remove(self._ids.get(self.email_key(email)))
+
+    def last_mod_of(self, email):
+        '''last_mod of the cached row of `email` (without counting a hit), or None'''
+        with self._lock:
+            row = self._rows.get(self._ids.get(self.email_key(email)))
+            return row['last_mod'] if row is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self._ids.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._rows), 'max_size': self.max_size, 'hits': self.hits,
+                    'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def _remove(self, id):
+        row = self._rows.pop(id, None)
+        if row is not None and self._ids.get(self.email_key(row['email'])) == id:
+            del self._ids[self.email_key(row['email'])]
+
+
+# the single user cache of the process
+user_cache = UserCache()
 
 
 # The functions below are outside of any class
 # they should not need the @staticmethod decorator
-def conn_cores_db(path_to_folder= None): 
-    # if no path_to_folder is provided, use the script's folder
-    if path_to_folder == None:
-        path_to_folder = os.path.dirname(os.path.abspath(__file__)) 
-    path_to_cores_db = os.path.join(path_to_folder, 'cores.db')
-    
-    # check if the file named cores.db already exists in path_to_cores_db 
-    if os.path.exists(path_to_cores_db):
-        conn = sqlite3.connect(path_to_cores_db)
-        # print("Connected to 'cores.db' ...")             
+
+DEFAULT_CORES_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cores.db')
+
+# pragmas applied once, when a pooled connection is opened
+CONNECTION_PRAGMAS = ( "PRAGMA journal_mode=WAL",      # readers do not block the writer (and vice versa)
+                       "PRAGMA busy_timeout=5000",     # wait up to 5 s for a lock instead of failing
+                       "PRAGMA foreign_keys=ON",
+                       "PRAGMA synchronous=NORMAL" )   # safe with WAL; one fsync per checkpoint, not per commit
+
+
+class ConnectionPool:
+    '''Process-wide manager for the connections to cores.db.
+       Each thread gets one long-lived connection, opened and configured on first use,
+       and all of them are closed by close_all() on shutdown.
+       Usage:   with cores_db_pool.transaction() as conn:   (or simply:  with cores_db() as conn:)
+                    conn.execute(...)                      # commit on success, rollback on error
+    '''
+    def __init__(self, path_to_cores_db=None):
+        self.path_to_cores_db = path_to_cores_db or DEFAULT_CORES_DB
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []          # every connection opened by the pool, so that close_all() can reach them
+        self._checked = False           # the existence check of cores.db is done once per path
+        self.factory = sqlite3.Connection   # class of the connections (InstrumentedConnection: see enable_sql_stats)
+
+    def configure(self, path_to_cores_db=None):
+        '''Point the pool to another database file (closes the current connections)'''
+        self.close_all()
+        self.path_to_cores_db = path_to_cores_db or DEFAULT_CORES_DB
+        self._checked = False
+
+    def _check_cores_db(self):
+        if not self._checked:
+            if not os.path.exists(self.path_to_cores_db):
+                # only the main thread may ask to create a new database (the background writer must not prompt)
+                if threading.current_thread() is not threading.main_thread() or not create_cores_db(self.path_to_cores_db):
+                    raise sqlite3.OperationalError(f"'{self.path_to_cores_db}' is not available.")
+            self._checked = True
+
+    def _open(self):
+        self._check_cores_db()
+        # mode=rw: never create an empty file if cores.db disappears (e.g. unreachable share)
+        # check_same_thread=False only so that close_all() can close the connections of other threads;
+        # each connection is still used by the thread that opened it
+        uri = pathlib.Path(self.path_to_cores_db).resolve().as_uri() + "?mode=rw"
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, factory=self.factory)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def connection(self):
+        '''Return the connection of the calling thread (opened on first use)'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
         return conn
-    
-    # show warning and ask if user wants to create new DB
-    else:
-        print("WARNING: 'cores.db' not found.")
-        user_input = input("Would you like to create a new database? (yes/no): ").upper() 
 
-        # if yes, create cores.db file
-        if (user_input == 'YES' or user_input == 'Y') : 
+    @contextmanager
+    def transaction(self):
+        '''Context manager yielding a connection; commits on success and rolls back on error'''
+        conn = self.connection()
+        with conn:
+            yield conn
+
+    def close_thread_connection(self):
+        '''Close the connection of the calling thread (for threads that end before the process)'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            with self._lock:
+                if conn in self._connections:
+                    self._connections.remove(conn)
+            conn.close()
+
+    def close_all(self):
+        '''Close every connection opened by the pool (call on shutdown)'''
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
             try:
-                conn = sqlite3.connect(path_to_cores_db)
-                print("'cores.db' has been created.")
-                create_tables(conn)         
-                # create & add admin user when new db created 
-                admin_user = User()
-                admin_user.email = 'admin'
-                admin_user.name = 'Admin User'
-                admin_user.type = 'admin'
-                admin_user.salt, admin_user.hash = get_salt_hash('admin', 'admin')
-                admin_user.add_user()
-                print('Admin user created.')
-                return conn
-            
+                conn.close()
             except sqlite3.Error as e:
-                print("Error:", e)
-                return False
-        else:
+                print("Error while closing connection:", e)
+        self._local = threading.local()
+
+
+# the single pool used by the whole process
+cores_db_pool = ConnectionPool()
+
+
+def cores_db():
+    '''Shortcut for cores_db_pool.transaction();  usage:  with cores_db() as conn: ...'''
+    return cores_db_pool.transaction()
+
+
+def enable_sql_stats():
+    '''Record the statistics of every SQL statement in sql_stats (see backend/sqlstats.py).
+       Call at startup: the connections already open are closed, the next ones are instrumented.'''
+    if not sql_stats.enabled:
+        cores_db_pool.close_all()
+        cores_db_pool.factory = InstrumentedConnection
+        sql_stats.enabled = True
+        sql_stats.reset()
+        print("SQL statistics enabled.")
+
+
+# the single background writer (owns the write connection of its thread; see backend/writer.py)
+event_writer = BackgroundWriter(cores_db_pool)
+
+# local journal of the events that could not be written to cores.db (see backend/journal.py)
+event_journal = EventJournal()
+event_writer.after_batch = event_journal.sync      # one fsync of the journal per batch of the writer
+
+
+_replay_lock = threading.Lock()
+_replay_queued = None       # Future of the replay waiting for the writer (not started yet), if any
+
+
+def replay_event_journal():
+    '''Queue the replay of the journaled events (no-op if the journal is empty).
+       The entries are discarded only after the replay has been committed.
+       One replay at a time: while a replay is waiting for the writer, it is returned instead of a new one
+       (two replays in the same batch would read the same entries and discard them twice).'''
+    global _replay_queued
+    if not event_journal.has_entries():
+        return None
+    replayed = []
+    def replay(conn):
+        global _replay_queued
+        with _replay_lock:
+            _replay_queued = None       # entries journaled from now on need a new replay
+        replayed.append(event_journal.replay(conn))
+        return replayed[-1]
+    def on_done(future):
+        global _replay_queued
+        with _replay_lock:
+            if _replay_queued is future:
+                _replay_queued = None   # failed or cancelled before the job started: never reuse it
+        if not future.cancelled() and future.exception() is None:
+            event_journal.discard(replayed[-1])
+            print(f"{replayed[-1]} journaled event(s) written to the database.")
+    with _replay_lock:
+        if _replay_queued is not None:
+            return _replay_queued
+        future = _replay_queued = event_writer.submit(replay)
+    future.add_done_callback(on_done)
+    return future
+
+
+# optional "remote events" mode: the events are sent to the ingestion server (see backend/remote.py and
+# backend/ingest.py) instead of cores.db; None: events are written to the local cores.db
+remote_events = None
+
+
+def store_events_locally(entries):
+    '''Fallback of the remote mode: write the entries to cores.db, or to the local journal if that fails too.
+       Returns the Future of the background writer.'''
+    future = event_writer.submit(lambda conn: write_entries(conn, entries))
+    def journal_on_failure(future):
+        if future.exception() is not None:
+            print("Error while recording events:", future.exception(), "(saved in the local journal)")
+            for entry in entries:
+                event_journal.append(entry)
+    future.add_done_callback(journal_on_failure)
+    return future
+
+
+def use_remote_events(url):
+    '''Send the login/logout events to the ingestion server at `url` (e.g. http://server:8765/events).
+       The events are stored locally while the server cannot be reached.'''
+    global remote_events
+    if remote_events is not None:
+        remote_events.stop()
+    remote_events = RemoteEventSink(url, fallback=store_events_locally)
+    print(f"Login/logout events are sent to {url}")
+    return remote_events
+
+
+def report_failure(future, message):
+    '''Done-callback for the futures of event_writer: print the error, if any'''
+    if future.exception() is not None:
+        print(message, future.exception())
+
+
+def close_cores_db():
+    '''Flush the background writer and close all pooled connections; connected to QApplication.aboutToQuit in main.py'''
+    if remote_events is not None:
+        remote_events.stop()    # first: its fallback queues jobs for the writer
+    event_writer.stop()
+    event_journal.close()
+    cores_db_pool.close_all()
+    print("User cache:", user_cache.stats())
+
+
+# also flush the queued writes when the interpreter exits without Qt (scripts, benchmarks)
+atexit.register(event_writer.stop)
+
+
+def conn_cores_db(path_to_folder= None): 
+    '''Legacy entry point: returns the pooled connection of the calling thread (or False if cores.db is not available).
+       If path_to_folder is provided, the pool is pointed to path_to_folder/cores.db first.'''
+    if path_to_folder != None:
+        cores_db_pool.configure(os.path.join(path_to_folder, 'cores.db'))
+    try:
+        return cores_db_pool.connection()
+    except sqlite3.Error as e:
+        print("Error:", e)
+        return False
+
+
+def create_cores_db(path_to_cores_db, ask=True):
+    '''Create a new cores.db file with the tables and the admin user. Returns True if created.'''
+    if ask:
+        # show warning and ask if user wants to create new DB
+        print(f"WARNING: '{path_to_cores_db}' not found.")
+        user_input = input("Would you like to create a new database? (yes/no): ").upper() 
+        if not (user_input == 'YES' or user_input == 'Y'):
             print("Aborted.")
             return False
 
+    # create cores.db file
+    try:
+        conn = sqlite3.connect(path_to_cores_db)
+        print("'cores.db' has been created.")
+        if not create_tables(conn):
+            conn.close()
+            return False
+        # bring the new tables to the latest schema version
+        from backend.migrations import migrate
+        migrate(conn)
+        # create & add admin user when new db created 
+        # (written with this connection; the pool is not ready before the file exists)
+        salt, hash = get_salt_hash('admin', 'admin')
+        with conn:
+            conn.execute("INSERT INTO users (email, name, type, salt, hash) VALUES (?, ?, ?, ?, ?)",
+                         ('admin', 'Admin User', 'admin', salt, hash))
+        conn.close()
+        print('Admin user created.')
+        return True
+
+    except sqlite3.Error as e:
+        print("Error:", e)
+        return False
+
 
 def create_tables(conn):
     '''Create two tables ('users' and 'events') in cores.db, if they do not exist'''
 
     empty_user = User()
-    user_dict = empty_user.__dict__
+    user_dict = empty_user.column_values()
     del user_dict['id']   # remove the id key which will need to be handled differently
 
     event_dict = init_event_dict()
@@ -123,79 +419,84 @@ def get_column_names(table_name):
         Returns:
             list: A list of column names for the specified table.
         """
-        conn = conn_cores_db()   
-        with conn:
-            cursor = conn.cursor()
-            try:
+        try:
+            with cores_db() as conn:
+                cursor = conn.cursor()
                 cursor.execute(f"PRAGMA table_info({table_name});")
                 columns_info = cursor.fetchall()
                 column_names = [info[1] for info in columns_info]  
                 return column_names
             
-            except sqlite3.Error as e:
-                print("Error:", e)
-                return None
-
-def export_table_to_csv(table_name):
-    # Get today's date to append to the file name
-    today = datetime.now().strftime('%Y_%m_%d')
-    file_name = f"{table_name}_{today}.csv"
-    
-    # Define a path to save the file in the user's home directory
-    home_dir = os.path.expanduser('~')  # Gets the user's home directory
-    file_path = os.path.join(home_dir, 'Downloads', file_name)  # Saves in the Downloads folder
-    
-    # Connect to the database and fetch the data
-    conn = conn_cores_db()  # Ensure conn_cores_db() is accessible
-    cursor = conn.cursor()
-    cursor.execute(f"SELECT * FROM {table_name}")
-    rows = cursor.fetchall()
-    
-    # Fetch the column headers
-    column_names = [description[0] for description in cursor.description]
-    
-    try:
-        # Write the data to a CSV file
-        with open(file_path, 'w', newline='', encoding='utf-8') as csv_file:
-            csv_writer = csv.writer(csv_file)
-            csv_writer.writerow(column_names)  # Write the headers first
-            csv_writer.writerows(rows)
-        
-        print(f"Exported {table_name} to {file_path}")
-        return True
-    except Exception as e:
-        print(f"Failed to export {table_name} to {file_path}: {e}")
-        return False
+        except sqlite3.Error as e:
+            print("Error:", e)
+            return None
 
 class User:
-    def __init__(self, user_dict=init_user_dict()):
+    # one slot per column (no per-instance dict), plus the values last loaded or saved
+    __slots__ = USER_COLUMNS + ('_saved',)
+
+    def __init__(self):
         # usage: user1 = User() will generate an empty instance
-        for key, value in user_dict.items():
+        for key in USER_COLUMNS:
             setattr(self, key, None)
+        self._saved = {}    # values of the columns when last loaded or saved (see dirty_columns())
+
+    def column_values(self):
+        '''Dictionary of the values of the columns of 'users' (a snapshot of this user)'''
+        return {col: getattr(self, col, None) for col in USER_COLUMNS}
+
+    def mark_saved(self):
+        '''The current values are the ones stored in the database (called after a load or a save)'''
+        self._saved = self.column_values()
+
+    def dirty_columns(self):
+        '''Columns changed since the user was loaded or saved (all of them for a user never loaded)'''
+        return [col for col in USER_COLUMNS
+                if col != 'id' and (col not in self._saved or getattr(self, col, None) != self._saved[col])]
+
+    def save(self):
+        '''Write the columns changed since the user was loaded (dirty_columns()) with one UPDATE,
+           in one transaction. Returns True if saved (or nothing to save), False otherwise.'''
+        if self.id is None:
+            print("Error: Cannot save a user that is not in the database (use add_user or upsert).")
+            return False
+        columns = self.dirty_columns()
+        if not columns:
+            return True
+        # the column names come from USER_COLUMNS only (whitelist); the values are parameters
+        assignments = ", ".join(f"{col} = :{col}" for col in columns)
+        try:
+            with cores_db() as conn:
+                conn.execute(f"UPDATE users SET {assignments} WHERE id = :id", self.column_values())
+        except sqlite3.Error as e:
+            print("Error:", e)
+            return False
+        user_cache.invalidate(id=self.id, email=self._saved.get('email'))
+        self.mark_saved()
+        print(f"User id: {self.id}, columns {', '.join(columns)} updated successfully.")
+        return True
 
-    
     def add_user(self):
         '''Method to add a user to the 'users' table.
            The recording of the login event should be handled separately.'''
         try:
-            # Generate the dictionary of attribute names and values for user
-            user_dict = self.__dict__
-            # Generate the placeholders for SQL values   :id, :email, :name ...
-            placeholders = ", ".join([f":{col}" for col in user_dict.keys()])  
-            # Set the 'first_login' attribute to the current datetime
+            # Set 'first_login' (and 'last_mod', if not set by the caller) to the current datetime
             current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             self.first_login = current_time
             self.last_login = current_time
+            self.last_mod = self.last_mod or current_time
+            # Generate the dictionary of attribute names and values for user
+            user_dict = self.column_values()
+            # Generate the placeholders for SQL values   :id, :email, :name ...
+            placeholders = ", ".join([f":{col}" for col in user_dict.keys()])  
 
             # Generate the SQL query using named placeholders
             sql = f"INSERT INTO users VALUES ({placeholders})"
             
             # connect to cores.db;  
-            conn = conn_cores_db()   
-            with conn:
+            with cores_db() as conn:
                 cursor = conn.cursor()
                 cursor.execute(sql, user_dict)
-                conn.commit()
                 row_id = cursor.lastrowid
                 
                 # NOTE (FT): It is not practical to record a login event from the User class
@@ -210,6 +511,8 @@ class User:
                 # login_event.record_login()
 
             self.id = row_id
+            self.mark_saved()
+            user_cache.invalidate(email=self.email)
             print(f"User added successfully on row {row_id}.")
             
             # Return the row ID of the added user
@@ -220,104 +523,165 @@ class User:
             return None  
         
 
+    def upsert(self, columns_to_update):
+        '''Insert the user or, if a user with the same email (case-insensitive) exists, update only
+           `columns_to_update` of that user. One statement; relies on the unique index on users(email).
+           All attributes (id, type, ...) are then set from the stored row.
+           Returns the row id or None.'''
+        # column names are never taken from outside the class: check them against the table's columns
+        invalid_columns = [col for col in columns_to_update if col not in USER_COLUMNS or col in ('id', 'email')]
+        if invalid_columns:
+            print("Error: invalid columns:", invalid_columns)
+            return None
+        user_dict = {key: value for key, value in self.column_values().items() if key != 'id'}
+        columns = ", ".join(user_dict.keys())
+        placeholders = ", ".join([f":{col}" for col in user_dict.keys()])
+        updates = ", ".join([f"{col} = excluded.{col}" for col in columns_to_update])
+        sql = f"""--sql
+            INSERT INTO users ({columns}) VALUES ({placeholders})
+            ON CONFLICT (email COLLATE NOCASE) DO UPDATE SET {updates}
+            RETURNING *
+        """
+        try:
+            with cores_db() as conn:
+                row = conn.execute(sql, user_dict).fetchone()
+        except sqlite3.Error as e:
+            print("Error:", e)
+            return None
+
+        for key, value in zip(USER_COLUMNS, row):
+            setattr(self, key, value)
+        self.mark_saved()
+        user_cache.put(dict(zip(USER_COLUMNS, row)))     # the stored row is known: no need to read it again
+        print(f"User {self.email} saved on row {self.id}.")
+        return self.id
+
     @classmethod
     def from_database(cls, row_id):
         # This method constructs a User instance with attributes values existing in the the 'users' table
         # The function does the following:
-        #           - read a line from database; 
+        #           - read a line from the user cache (if its last_mod is still current), or from the
+        #             database (then cached);
         #           - create an new instance of the User class; 
-        #           - set the values read from database to the attributes of the instance;
+        #           - set the values read to the attributes of the instance;
         #           - return the instance
         # Usage: new_user = User.from_database(id)        
-        # connect to cores.db;  
-
-        conn = conn_cores_db()   
-        with conn:
-            cursor = conn.cursor()
-            try:
-                # Fetch the user's information from the database
-                cursor.execute("SELECT * FROM users WHERE id=?", (row_id, ))
-                user_info = cursor.fetchone()
+        user_dict = cls.current_cached_row(user_cache.get(id=row_id))
+        if user_dict is None:
+            user_dict = cls.read_user_row("id=?", row_id)
+        return cls.from_user_dict(user_dict)
+    
+    @classmethod
+    def from_database_by_email(cls, email):
+        # One lookup by email (case-insensitive): the user cache (if still current), or one query
+        user_dict = cls.current_cached_row(user_cache.get(email=email))
+        if user_dict is None:
+            user_dict = cls.read_user_row("email=? COLLATE NOCASE", email)
+        if user_dict is False:
+            print(f"Error: User with email '{email}' not found.")
+            return None
+        return cls.from_user_dict(user_dict)
 
-                if user_info:
-                    user_instance = cls()  # Create an empty instance of the class
-                    # Create empty dict to put loaded user into
-                    user_dict = {}
+    @classmethod
+    def from_record(cls, record):
+        '''User from a UserRecord (see list_users/iter_users)'''
+        user_instance = cls()
+        for key, value in zip(USER_COLUMNS, record):
+            setattr(user_instance, key, value)
+        user_instance.mark_saved()
+        return user_instance
 
-                    # Use zip to create something like ("id", 1), ...
-                    for key, value in zip(user_instance.__dict__.keys(), user_info):
-                        user_dict[key] = value
-                    user_instance.__dict__.update(user_dict)   # the builtin update function is very convenient here!
+    @staticmethod
+    def current_cached_row(user_dict):
+        '''The cached row if its last_mod still matches the database (one lookup by primary key),
+           else None (the row is dropped from the cache and must be read again)'''
+        if user_dict is None:
+            return None
+        try:
+            with cores_db() as conn:
+                row = conn.execute("SELECT last_mod FROM users WHERE id=?", (user_dict['id'],)).fetchone()
+        except sqlite3.Error as e:
+            print("Error:", e)
+            return None
+        if row is not None and row[0] == user_dict['last_mod']:
+            return user_dict
+        user_cache.invalidate(id=user_dict['id'], email=user_dict['email'])
+        return None
 
-                    print("User information loaded successfully.")
-                    return user_instance
-                else:
-                    print("Error: User not found.")
-                    return None
+    @staticmethod
+    def read_user_row(condition, value):
+        '''Read one row of 'users' into a dict and cache it. Returns the dict, False if not found, None on error'''
+        try:
+            with cores_db() as conn:
+                user_info = conn.execute(f"{SELECT_USERS} WHERE {condition}", (value,)).fetchone()
+        except sqlite3.Error as e:
+            print("Error:", e)
+            return None
+        if not user_info:
+            return False
+        user_dict = dict(zip(USER_COLUMNS, user_info))
+        user_cache.put(user_dict)
+        return user_dict
 
-            except sqlite3.Error as e:
-                print("Error:", e)
-                return None
-    
     @classmethod
-    def from_database_by_email(cls, email):
-        # Get the row ID for the given email; find existing user
-        # NOTE: this function does not check if 
-        row_id = get_rowid_for_email(email)
-        
-        # If row ID is found, call the generic method
-        if row_id is not None:
-            return cls.from_database(row_id)
-        else:
-            print(f"Error: User with email '{email}' not found.")
+    def from_user_dict(cls, user_dict):
+        if user_dict is None:
+            return None
+        if user_dict is False:
+            print("Error: User not found.")
             return None
+        user_instance = cls()  # Create an empty instance of the class
+        for key, value in user_dict.items():
+            setattr(user_instance, key, value)
+        user_instance.mark_saved()
+        print("User information loaded successfully.")
+        return user_instance
 
 
-    # Update one property of one user with known rowid
+    # Update one property of one user with known rowid (and last_mod, unless the property is last_login)
     def update_user_property(self, id, column_name, new_value):
+        if column_name not in USER_COLUMNS or column_name == 'id':
+            print("Error: invalid column:", column_name)
+            return False
         try:
             sql = """--sql 
                 UPDATE  users 
-                SET     {}  = ? 
-                WHERE   id == ?
-            """.format(column_name)
+                SET     {}  = :value {}
+                WHERE   id == :id
+            """.format(column_name, "" if column_name in ('last_login', 'last_mod') else ", last_mod = :last_mod")
+            last_mod = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
             # connect to cores_db;   
-            conn = conn_cores_db()
-            with conn:
+            with cores_db() as conn:
                 cur = conn.cursor()
-                cur.execute(sql, (new_value, id))
-                conn.commit()
+                cur.execute(sql, {'value': new_value, 'last_mod': last_mod, 'id': id})
+            user_cache.invalidate(id=id)
             print(f"User id: {id}, column: {column_name} updated successfully. New value: {new_value}")
             return True
         except sqlite3.Error as e:
             print("Error:", e)
             return False
 
-    #============================================================================================================
-    # NOTE: FUNCTION FOR UPDATING/ RE-WRITING AN EXISTING USER   <= !!! Might interfere with the ID/Autoincrement!! CHECK!!!
-    # added on 22DEC2023
+    # Re-write an existing user: only the changed columns, in one UPDATE (see save())
     def update_user(self):
-        for _ in self.__dict__.keys():
-            self.update_user_property(self.id, _, self.__dict__[_])
-    #==============================================================================================================
+        return self.save()
 
 
     @staticmethod
     def authenticate_user(email, password) :
-        # connect to cores_db;  
-        conn = conn_cores_db()
-
         # get stored salt and hash in user's row 
         try:
-            with conn:
+            with cores_db() as conn:
                 cursor = conn.cursor()
-                cursor.execute("SELECT salt, hash FROM users WHERE email=?", (email,))
+                cursor.execute("SELECT salt, hash, last_mod FROM users WHERE email=? COLLATE NOCASE", (email,))
                 user_info = cursor.fetchone()
                 print("user_info:", user_info)
 
                 if user_info:
-                    salt_db_str, hash_db_str = user_info
+                    salt_db_str, hash_db_str, last_mod = user_info
+                    # the row was changed since it was cached (e.g. by another process): read it again
+                    if user_cache.last_mod_of(email) != last_mod:
+                        user_cache.invalidate(email=email)
                 else:
                     # User not found
                     return False
@@ -328,15 +692,13 @@ class User:
         
         result = authenticate(email, password, salt_db_str, hash_db_str)
 
-        # Update 'last_login' when login is successful
+        # Update 'last_login' when login is successful (queued for the background writer: the login does not wait)
         if result:
-            try:
-                with conn:
-                    cursor = conn.cursor()
-                    cursor.execute("UPDATE users SET last_login=? WHERE email=?", (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), email))
-                    conn.commit()
-            except sqlite3.Error as e:
-                print("Error while updating last_login:", e)
+            last_login = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            future = event_writer.submit(lambda conn: conn.execute(
+                "UPDATE users SET last_login=? WHERE email=? COLLATE NOCASE", (last_login, email)).rowcount)
+            future.add_done_callback(lambda f: report_failure(f, "Error while updating last_login:"))
+            user_cache.update(email, last_login=last_login)
         
         return result
     
@@ -355,13 +717,11 @@ class User:
             bool: True if the password matches, False otherwise.
         """
 
-        conn = conn_cores_db()
-
         try:
-            with conn:
+            with cores_db() as conn:
                 cursor = conn.cursor()
                 # Query the database for the user's salt and hash
-                cursor.execute("SELECT salt, hash FROM users WHERE email = ?", (email,))
+                cursor.execute("SELECT salt, hash FROM users WHERE email = ? COLLATE NOCASE", (email,))
                 result = cursor.fetchone()
                 if result:
                     salt_string, hash_string = result
@@ -387,18 +747,18 @@ class User:
         Returns:
             bool: True if the update was successful, False otherwise.
         """
-        conn = conn_cores_db()
-
         try:
-            with conn:
+            with cores_db() as conn:
                 cursor = conn.cursor()
                 # Generate new salt and hash for the new password
                 salt_string, hash_string = get_salt_hash(email, new_plain_password)
 
                 # Update the user's salt and hash in the database
                 try:
-                    cursor.execute("UPDATE users SET salt = ?, hash = ? WHERE email = ?", (salt_string, hash_string, email))
-                    cursor.connection.commit()
+                    last_mod = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                    cursor.execute("UPDATE users SET salt = ?, hash = ?, last_mod = ? WHERE email = ? COLLATE NOCASE",
+                                   (salt_string, hash_string, last_mod, email))
+                    user_cache.invalidate(email=email)
                     return True
                 except Exception as e:
                     print(f"Failed to update password for {email}: {e}")
@@ -421,7 +781,7 @@ class User:
         """
         user_instance = User.from_database_by_email(email)
         if user_instance is not None:
-            return True, user_instance.__dict__
+            return True, user_instance.column_values()
         else:
             return False, {}
 
@@ -439,7 +799,7 @@ class User:
         """
         user_instance = User.from_database_by_email(email)
         if user_instance is not None:
-            return True, user_instance.__dict__
+            return True, user_instance.column_values()
         else:
             return False, {}
 
@@ -490,77 +850,133 @@ def get_duplicates(email):
 
 def get_id_of_most_recent_user(email):
     ''' Returns one ID as integer (not a list) or None'''
-    ids_list = get_duplicates(email)
-    if not ids_list:
+    # one query: the most recently modified row with this email (ties: the newest row)
+    try:
+        with cores_db() as conn:
+            row = conn.execute("""--sql
+                SELECT   id 
+                FROM     users 
+                WHERE    email = ? COLLATE NOCASE
+                ORDER BY last_mod IS NULL, last_mod DESC, id DESC 
+                LIMIT 1
+            """, (email,)).fetchone()
+    except sqlite3.Error as e:
+        print("Error:", e)
         return None
-    elif len(ids_list) == 1:
-        unique_id = ids_list[0]
-        return unique_id
-    elif len(ids_list) > 1:
-        most_recent_user_id = None
-        last_mod_dt = datetime.now().replace(year = 1901)
-        for id in ids_list:
-            user = User.from_database(id)
-            user_last_mod_dt = datetime.strptime(user.last_mod, '%Y-%m-%d %H:%M:%S')
-            if user_last_mod_dt > last_mod_dt:
-                last_mod_dt = user_last_mod_dt
-                most_recent_user_id = user.id
-        print('most_recent_user_id:', most_recent_user_id)
-        return most_recent_user_id 
+    return row[0] if row else None
+
+
+# the columns of the surviving user that are filled from its duplicates when empty
+MERGED_USER_COLUMNS = ('name', 'nickname', 'title', 'phone', 'pi_name', 'pi_phone', 'type', 'salt', 'hash')
+
+
+def collapse_duplicate_users(conn=None, email=None):
+    '''Collapse users sharing the same email (case-insensitive) into the most recently modified row.
+       - the duplicates are found in a single pass (window function over last_mod)
+       - empty columns of the surviving row are filled from the duplicates (MERGED_USER_COLUMNS),
+         first_login/last_login become the earliest/latest of the group
+       - events recorded with a different spelling of the email are repointed to the surviving email
+       - the duplicates are deleted with one statement
+       conn:  run inside the caller's transaction (used by the migrations); default: own transaction
+       email: only collapse this email (default: the whole table)
+       Returns the number of deleted rows.'''
+    if conn is None:
+        with cores_db() as conn:
+            return collapse_duplicate_users(conn, email)
+
+    email_filter = "AND email = :email COLLATE NOCASE" if email else ""
+    conn.execute("""--sql
+        CREATE TEMP TABLE IF NOT EXISTS user_duplicates (
+            old_id INTEGER PRIMARY KEY, keep_id INTEGER, old_email TEXT, keep_email TEXT )
+    """)
+    conn.execute("DELETE FROM temp.user_duplicates")
+    conn.execute(f"""--sql
+        INSERT INTO temp.user_duplicates (old_id, keep_id, old_email, keep_email)
+        SELECT id, keep_id, email, keep_email
+        FROM ( SELECT id, email,
+                      FIRST_VALUE(id)    OVER w AS keep_id,
+                      FIRST_VALUE(email) OVER w AS keep_email,
+                      ROW_NUMBER()       OVER w AS rank
+               FROM   users
+               WHERE  email IS NOT NULL {email_filter}
+               WINDOW w AS (PARTITION BY email COLLATE NOCASE
+                            ORDER BY last_mod IS NULL, last_mod DESC, id DESC) )
+        WHERE rank > 1
+    """, {'email': email})
+    (count,) = conn.execute("SELECT COUNT(*) FROM temp.user_duplicates").fetchone()
+    if count == 0:
+        return 0
+
+    # fill the empty columns of the surviving rows (most recent non-empty value of the duplicates)
+    merged = ",\n".join(f"""{col} = COALESCE({col}, (
+                SELECT d.{col} FROM users d JOIN temp.user_duplicates m ON d.id = m.old_id
+                WHERE  m.keep_id = users.id AND d.{col} IS NOT NULL
+                ORDER BY d.last_mod DESC LIMIT 1))""" for col in MERGED_USER_COLUMNS)
+    group = "SELECT old_id FROM temp.user_duplicates WHERE keep_id = users.id"
+    conn.execute(f"""--sql
+        UPDATE users SET
+            {merged},
+            first_login = (SELECT MIN(d.first_login) FROM users d WHERE d.id = users.id OR d.id IN ({group})),
+            last_login  = (SELECT MAX(d.last_login)  FROM users d WHERE d.id = users.id OR d.id IN ({group}))
+        WHERE id IN (SELECT keep_id FROM temp.user_duplicates)
+    """)
+
+    # events are linked to users by email: repoint the ones recorded with another spelling
+    conn.execute("""--sql
+        UPDATE events 
+        SET    email = (SELECT keep_email FROM temp.user_duplicates m WHERE m.old_email = events.email LIMIT 1)
+        WHERE  email IN (SELECT old_email FROM temp.user_duplicates WHERE old_email != keep_email)
+    """)
+    conn.execute("DELETE FROM users WHERE id IN (SELECT old_id FROM temp.user_duplicates)")
+    conn.execute("DELETE FROM temp.user_duplicates")
+    if email:
+        user_cache.invalidate(email=email)      # the surviving row changed too
+    else:
+        user_cache.clear()
+    print(f"{count} duplicate user(s) removed.")
+    return count
+
 
 def remove_duplicates(email):
-    id_duplicates_list = get_duplicates(email)
-    print('id_duplicates_list:', id_duplicates_list)
-    if id_duplicates_list:
-        if len(id_duplicates_list) > 1:
-            most_recent_user_id = get_id_of_most_recent_user(email)
-            print('most_recent_user_id:', most_recent_user_id)
-            id_duplicates_list.remove(most_recent_user_id) # remove most recent
-            ids_to_delete_list = id_duplicates_list
-            print('ids_to_delete_list:', ids_to_delete_list)
-            conn = conn_cores_db()
-            with conn:
-                cur = conn.cursor()
-                for id in ids_to_delete_list:
-                    cur.execute("DELETE FROM users WHERE id = ?", (id,))
-        else:
-            print(f"Only one user has the email: {email}")
-    else:
-        print(f"No user with email {email} found.")
+    try:
+        removed = collapse_duplicate_users(email=email)
+    except sqlite3.Error as e:
+        print("Error:", e)
         return None
+    if not removed:
+        print(f"No duplicates found for email {email}.")
+    return removed
 
 
 
 
 def get_rowid_for_email(email):
     # connect to cores_db;  
-    conn = conn_cores_db()   
-    with conn:
-        cursor = conn.cursor()
-        try:
+    try:
+        with cores_db() as conn:
+            cursor = conn.cursor()
             # Fetch the user's row ID from the database
-            cursor.execute("SELECT id FROM users WHERE email=?", (email,))
+            cursor.execute("SELECT id FROM users WHERE email=? COLLATE NOCASE", (email,))
             row_id = cursor.fetchone()
 
-            if row_id:
-                return row_id[0]
-            else:
-                print(f"Error: User with email '{email}' not found.")
-                return None
+    except sqlite3.Error as e:
+        print("Error:", e)
+        return None
 
-        except sqlite3.Error as e:
-            print("Error:", e)
-            return None
+    if row_id:
+        return row_id[0]
+    else:
+        print(f"Error: User with email '{email}' not found.")
+        return None
 
 
 def get_rowid(email):
     ' returns tuples'
     # get the rowid of a user existing in the 'users' table, based on email and check if unique 
     # connect to cores_db;  
-    conn = conn_cores_db()
-    with conn:
+    with cores_db() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT id FROM users WHERE email=?", (email,))
+        cur.execute("SELECT id FROM users WHERE email=? COLLATE NOCASE", (email,))
         user_ids = cur.fetchall()
         print(user_ids, "  |  len(user_id):", len(user_ids))
     
@@ -576,111 +992,272 @@ def get_rowid(email):
     
 def get_rowid_for_email(email):
     # connect to cores_db;  
-    conn = conn_cores_db()   
-    with conn:
-        cursor = conn.cursor()
-        try:
+    try:
+        with cores_db() as conn:
+            cursor = conn.cursor()
             # Fetch the user's row ID from the database
-            cursor.execute("SELECT id FROM users WHERE email=?", (email,))
+            cursor.execute("SELECT id FROM users WHERE email=? COLLATE NOCASE", (email,))
             row_id = cursor.fetchone()
 
-            if row_id:
-                return row_id[0]
-            else:
-                print(f"Error: User with email '{email}' not found.")
-                return None
+    except sqlite3.Error as e:
+        print("Error:", e)
+        return None
 
-        except sqlite3.Error as e:
-            print("Error:", e)
-            return None
+    if row_id:
+        return row_id[0]
+    else:
+        print(f"Error: User with email '{email}' not found.")
+        return None
     
 
 
-event_dict = {  'id'          : '123',
-                'email'       : 'xyz@chop.edu',
-                'device'      : 'Aurora alpha',
-                'login_time'  : '2023-08-18 14:20:00',
-                'login_type'  : 'local | iLab | EMERGENCY',
-                'logout_time' : '2023-08-18 16:20:00',
-                'logout_type' : 'by_user  | by_inactivity  | pending' }
-
-
-
 # define a dictionary that sets the attributes of the class Event and the columns of the table 'events'
 def init_event_dict():
-
-
-    event_dict = {  'id'          : None,
-                    'email'       : 'xyz@chop.edu',
-                    'device'      : 'Device Name',
-                    'login_time'  : '2023-08-18 14:20:00',
-                    'login_type'  : 'local | iLab | EMERGENCY',
-                    'logout_time' : '2023-08-18 16:20:00',
-                    'logout_type' : 'by_user  | by_inactivity  | pending' }
-    
+    # the values show the formatting (the schema is defined in backend/records.py);
+    # evaluated at each call, so the times are the current time
     current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    event_dict['login_time'] = current_time
-    event_dict['logout_time'] = current_time
+    return dict(EVENT_SCHEMA, id=None, login_time=current_time, logout_time=current_time)
+
+
+# SQL condition: the sessions that can still change (their logout is not recorded yet)
+OPEN_SESSION = "(logout_time IS NULL OR logout_time = 'N/A' OR logout_type = 'PENDING')"
+
+# logout_type of the sessions closed by close_orphaned_sessions() (the kiosk crashed or was powered off)
+ORPHANED_LOGOUT_TYPE = 'orphaned'
+
+
+# a session whose heartbeat is older than SessionHeartbeat.stale_after() is orphaned (several missed heartbeats);
+# never less than this, so that a short interval does not close a session paused by a slow writer
+STALE_HEARTBEAT_MINUTES = 30
+
+
+def close_orphaned_sessions(conn=None, device=None):
+    '''Close the sessions left open by a crash, in one set-based UPDATE.
+       A session is orphaned if a later login exists on the same device (one session at a time per device),
+       if its last heartbeat is older than SessionHeartbeat.stale_after(), or if it belongs to `device`
+       (at startup: nobody can be logged in on this kiosk yet).
+       The inferred logout is the last heartbeat of the session (events.last_seen), else the next login
+       on the same device, else the login time.
+       conn: run inside the caller's transaction (default: own transaction)
+       Returns the number of sessions closed.'''
+    if conn is None:
+        with cores_db() as conn:
+            return close_orphaned_sessions(conn, device)
+    next_login = """(SELECT MIN(n.login_time) FROM events n
+                     WHERE n.device = events.device AND n.login_time > events.login_time)"""
+    cursor = conn.execute(f"""--sql
+        UPDATE events
+        SET    logout_time = COALESCE(last_seen, {next_login}, login_time),
+               logout_type = :orphaned
+        WHERE  {OPEN_SESSION} AND device IS NOT NULL
+          AND  (device = :device OR last_seen < :stale_before OR {next_login} IS NOT NULL)
+    """, {'orphaned': ORPHANED_LOGOUT_TYPE, 'device': device,
+          'stale_before': format_time(datetime.now() - SessionHeartbeat.stale_after())})
+    if cursor.rowcount:
+        print(f"{cursor.rowcount} orphaned session(s) closed.")
+    return cursor.rowcount
+
+
+class SessionHeartbeat:
+    '''Periodic checkpoint of an open session: events.last_seen = time of the last beat().
+       beat() is called from the GUI thread (MiniGui timer). It only records the time and queues a job for
+       the background writer if none is waiting, so beats coalesce while the writer is busy; the job writes
+       the latest time with a single-row UPDATE (constant SQL: the prepared statement is cached by sqlite3).'''
+    SQL = "UPDATE events SET last_seen = ? WHERE id = ?"
+    interval = 60           # seconds between two beats (config.json: "heartbeat_interval", see configure())
+    MISSED_BEATS = 3        # a session is stale after this many missed beats (see close_orphaned_sessions)
+
+    @classmethod
+    def configure(cls, interval):
+        '''Set the interval between two beats (seconds); returns False (interval unchanged) if it is not valid'''
+        try:
+            seconds = float(interval)
+        except (TypeError, ValueError):
+            seconds = None
+        if seconds is None or not math.isfinite(seconds) or seconds <= 0:
+            print(f"Error: invalid heartbeat_interval {interval!r} (seconds > 0); using {cls.interval} s.")
+            return False
+        cls.interval = seconds
+        return True
 
-    return event_dict
+    @classmethod
+    def stale_after(cls):
+        '''Age of the last heartbeat after which a session is orphaned: MISSED_BEATS intervals,
+           at least STALE_HEARTBEAT_MINUTES (every kiosk sweeps all devices: use the same interval everywhere)'''
+        return max(timedelta(minutes=STALE_HEARTBEAT_MINUTES), timedelta(seconds=cls.MISSED_BEATS * cls.interval))
+
+    def __init__(self, event):
+        self.event = event
+        self._last_seen = None
+        self._queued = False
+        self._lock = threading.Lock()
+
+    def beat(self):
+        last_seen = format_time()
+        if remote_events is not None:
+            return remote_events.submit({'op': 'heartbeat', 'email': self.event.email, 'device': self.event.device,
+                                         'login_time': self.event.login_time, 'last_seen': last_seen})
+        with self._lock:
+            self._last_seen = last_seen
+            if self._queued:
+                return None     # the waiting job will write this time
+            self._queued = True
+        future = event_writer.submit(self._write)
+        future.add_done_callback(lambda f: report_failure(f, "Error while recording heartbeat:"))
+        return future
+
+    def _write(self, conn):
+        with self._lock:
+            last_seen, self._queued = self._last_seen, False
+        if getattr(self.event, 'lastrowid', None) is None:
+            return 0            # the login is not recorded (journaled): nothing to checkpoint
+        return conn.execute(self.SQL, (last_seen, self.event.lastrowid)).rowcount
+
+
+def sweep_orphaned_sessions(device=None):
+    '''Queue close_orphaned_sessions() for the background writer: after the replay of the journal,
+       and without blocking the GUI (startup: device of the kiosk; periodic: device=None)'''
+    future = event_writer.submit(lambda conn: close_orphaned_sessions(conn, device))
+    future.add_done_callback(lambda f: report_failure(f, "Error while closing orphaned sessions:"))
+    return future
 
 
 class Event:
-    def __init__(self, event_dict=init_event_dict()):
-        for key, value in event_dict.items():
+    # one slot per column (no per-instance dict), plus the state of the asynchronous recording
+    __slots__ = EVENT_COLUMNS + ('lastrowid', 'journaled', 'login_future')
+
+    def __init__(self):
+        for key in EVENT_COLUMNS:
             setattr(self, key, None)
+        self.lastrowid = None       # id of the row, once the login is recorded in cores.db
+        self.journaled = False      # the login was saved in the local journal instead
+        self.login_future = None    # Future of the asynchronous write of the login (see login())
+
+    @classmethod
+    def from_record(cls, record):
+        '''Event from an EventRecord (see list_events/iter_events); lastrowid is the id of the row'''
+        event = cls()
+        for key, value in zip(EVENT_COLUMNS, record):
+            setattr(event, key, value)
+        event.lastrowid = event.id
+        return event
 
 
+    def column_values(self):
+        '''Dictionary of the values of the columns of 'events' (a snapshot of this event)'''
+        return {col: getattr(self, col, None) for col in EVENT_COLUMNS}
+
+    def insert_login(self, conn, event_dict=None):
+        '''INSERT this login event with `conn` (no commit); sets and returns self.lastrowid
+           event_dict: snapshot taken by column_values() (default: the current values)'''
+        # Generate the dictionary of column names and values for log
+        if event_dict is None:
+            event_dict = self.column_values()
+        # Generate the placeholders for SQL values
+        placeholders = ', '.join([f":{col}" for col in event_dict.keys()])
+        # Generate the SQL query using named placeholders; the same login recorded twice (same device,
+        # email and second: e.g. a double click) is the same session, identified by its natural key
+        sql = f"""--sql
+            INSERT INTO events ({', '.join(event_dict.keys())}) VALUES ({placeholders})
+            ON CONFLICT (device, login_time, email) DO UPDATE SET login_type = excluded.login_type
+            RETURNING id
+        """
+        (row_id,) = conn.execute(sql, event_dict).fetchone()
+        # Store lastrowid in the Event instance
+        self.lastrowid = row_id
+        return self.lastrowid
+
+    def forget_lastrowid(self):
+        '''The INSERT of insert_login was rolled back: the row id is not in the database'''
+        self.lastrowid = None
+
+    def update_logout(self, conn, logout_time=None, logout_type=None):
+        '''UPDATE the logout columns of this event with `conn`, in one statement (no commit)
+           logout_time: datetime or timestamp string (default: now); logout_type: default self.logout_type'''
+        if getattr(self, 'lastrowid', None) is None:
+            raise ValueError("Cannot record logout event without a valid login event.")
+        conn.execute("UPDATE events SET logout_time=?, logout_type=? WHERE id=?",
+                     (format_time(logout_time), logout_type or self.logout_type, self.lastrowid))
+        return True
+
     def record_login(self):
         # 3) Func: record_login():
         # Purpose: add one row to 'logins' table to record a login event
         # return row_id if successful
         # Usage:  current_event.record_login()
         print("... recording login ...")
-        conn = conn_cores_db() 
-        with conn:
-            cursor = conn.cursor()
-            # Generate the dictionary of attribute names and values for log
-            event_dict = self.__dict__
-
-            try:
-                # Generate the placeholders for SQL values
-                placeholders = ', '.join([f":{col}" for col in event_dict.keys()])
-                print("placeholders: ", placeholders)
-                # Generate the SQL query using named placeholders
-                sql = f"INSERT INTO events VALUES ({placeholders})"
-                cursor.execute(sql, event_dict)
-                conn.commit()
-
-                # Store lastrowid in the Event instance
-                self.lastrowid = cursor.lastrowid
-
-                print("Login event recorded successfully.")
-                return self.lastrowid
-            except sqlite3.Error as e:
-                print("Error while recording login event:", e)
-                return None
+        try:
+            with cores_db() as conn:
+                self.insert_login(conn)
+            print("Login event recorded successfully.")
+            return self.lastrowid
+        except sqlite3.Error as e:
+            print("Error while recording login event:", e)
+            return None
         
     def record_logout(self):
         # Function to record logout datetime using lastrowid
 
         if hasattr(self, 'lastrowid') and self.lastrowid is not None:
-            conn = conn_cores_db()
-            with conn:
-                cursor = conn.cursor()
-                try:
-                    cursor.execute("UPDATE events SET logout_time=? WHERE id=?", (datetime.now(), self.lastrowid))
-                    cursor.execute("UPDATE events SET logout_type=? WHERE id=?", (self.logout_type, self.lastrowid))
-                    conn.commit()
-                    print("Logout event recorded successfully.")
-                    return True
-                except sqlite3.Error as e:
-                    print("Error while recording logout event:", e)
-                    return False
+            try:
+                with cores_db() as conn:
+                    self.update_logout(conn)
+                print("Logout event recorded successfully.")
+                return True
+            except sqlite3.Error as e:
+                print("Error while recording logout event:", e)
+                return False
         else:
             print("Error: Cannot record logout event without a valid login event.")
             return False
 
+    def record_login_async(self):
+        '''Queue the login event for the background writer (or the events server, in remote mode);
+           returns a Future with the lastrowid (True in remote mode).
+           The GUI does not wait for the database (usage: from the Qt main thread).
+           If the database is not available, the event is saved in the local journal instead.'''
+        event_dict = self.column_values()   # snapshot: the GUI may change the event before it is written
+        if remote_events is not None:
+            entry = {col: value for col, value in event_dict.items() if col != 'id'}
+            return remote_events.submit({'op': 'login', **entry})
+        replay_event_journal()      # the database may be back: write the journaled events first
+        future = event_writer.submit(lambda conn: self.insert_login(conn, event_dict),
+                                     on_rollback=self.forget_lastrowid)
+        future.add_done_callback(lambda f: self.journal_login_on_failure(f, event_dict))
+        return future
+
+    def record_logout_async(self):
+        '''Queue the logout for the background writer; returns a Future (True when recorded).
+           Queued after the login, so lastrowid is known when the logout is written.
+           If the database (or the login) is not available, the logout is saved in the local journal.'''
+        logout_time = format_time()
+        logout_type = self.logout_type
+        if remote_events is not None:
+            # the remote mode identifies the session by its natural key (no row id)
+            return remote_events.submit({'op': 'logout', 'email': self.email, 'device': self.device,
+                                         'login_time': self.login_time, 'logout_time': logout_time,
+                                         'logout_type': logout_type})
+        future = event_writer.submit(lambda conn: self.update_logout(conn, logout_time, logout_type))
+        future.add_done_callback(lambda f: self.journal_logout_on_failure(f, logout_time, logout_type))
+        return future
+
+    # the two callbacks below run in the writer thread, right after the failed job
+    def journal_login_on_failure(self, future, event_dict):
+        if future.exception() is not None:
+            print("Error while recording login event:", future.exception(), "(saved in the local journal)")
+            self.journaled = True
+            entry = {col: value for col, value in event_dict.items() if col != 'id'}
+            event_journal.append({'op': 'login', **entry})
+
+    def journal_logout_on_failure(self, future, logout_time, logout_type):
+        if future.exception() is not None:
+            if getattr(self, 'lastrowid', None) is None and not getattr(self, 'journaled', False):
+                print("Error while recording logout event:", future.exception())
+                return
+            print("Error while recording logout event:", future.exception(), "(saved in the local journal)")
+            event_journal.append({'op': 'logout', 'email': self.email, 'device': self.device,
+                                  'login_time': self.login_time, 'logout_time': logout_time,
+                                  'logout_type': logout_type})
 
 
     @classmethod
@@ -702,11 +1279,137 @@ class Event:
 
 
 
+def iter_rows(sql, params, record_type):
+    '''Generator of the rows of a SELECT (as record_type) on the pooled connection of the calling thread.
+       Read-only, outside of any transaction: the caller may write with cores_db() while iterating (its commit
+       or rollback does not end the read, the end of the read does not commit its writes); the statement is
+       finalized when the generator is exhausted or closed.'''
+    cursor = cores_db_pool.connection().cursor()
+    try:
+        cursor.row_factory = row_factory(record_type)
+        cursor.execute(sql, params)
+        yield from cursor
+    finally:
+        cursor.close()
+
+
+def iter_events(since=None, until=None, device=None, email=None, open_only=False):
+    '''Stream the events as EventRecord (named tuples built by the row factory), ordered by id.
+       since, until: '%Y-%m-%d[ %H:%M:%S]' range on login_time (until is exclusive)
+       device, email: only the events of this device / this user (email: case-insensitive)
+       open_only:     only the sessions whose logout is not recorded yet
+       Nothing is loaded in advance: the rows are read as the generator is consumed.'''
+    conditions, params = [], []
+    if since:
+        conditions.append("login_time >= ?")
+        params.append(since)
+    if until:
+        conditions.append("login_time < ?")
+        params.append(until)
+    if device:
+        conditions.append("device = ?")
+        params.append(device)
+    if email:
+        conditions.append("email = ? COLLATE NOCASE")
+        params.append(email)
+    if open_only:
+        conditions.append(OPEN_SESSION)
+    sql = SELECT_EVENTS
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY id"
+    try:
+        yield from iter_rows(sql, params, EventRecord)
+    except sqlite3.Error as e:
+        print("Error while reading events:", e)
+
+
+def list_events(since=None, until=None, device=None, email=None, open_only=False):
+    '''Same as iter_events, as a list'''
+    return list(iter_events(since, until, device, email, open_only))
+
+
+def iter_users(user_type=None):
+    '''Stream the users as UserRecord, ordered by id (user_type: only 'user' or 'admin' users)'''
+    sql = SELECT_USERS + (" WHERE type = ?" if user_type else "") + " ORDER BY id"
+    try:
+        yield from iter_rows(sql, (user_type,) if user_type else (), UserRecord)
+    except sqlite3.Error as e:
+        print("Error while reading users:", e)
+
+
+def list_users(user_type=None):
+    '''Same as iter_users, as a list'''
+    return list(iter_users(user_type))
+
+
+def login(email, password, device, login_type='local'):
+    '''Fast path of a local login: one SELECT and the password check in the calling thread, then a single job
+       for the background writer: UPDATE users.last_login and INSERT the login event, in one transaction.
+       The GUI never waits for a write (a locked cores.db does not freeze the kiosk); if the write fails,
+       the login event is saved in the local journal (as record_login_async does).
+       Returns (user, event), or (None, None) if the login failed. event.lastrowid is None until the writer
+       has recorded the event (always None in remote mode: the event goes to the ingestion server);
+       event.login_future completes when the event is written (locally, or by the server).'''
+    try:
+        with cores_db() as conn:
+            cursor = conn.execute(f"{SELECT_USERS} WHERE email=? COLLATE NOCASE", (email,))
+            cursor.row_factory = row_factory(UserRecord)
+            record = cursor.fetchone()
+    except sqlite3.Error as e:
+        print("Error while logging in:", e)
+        return None, None
+    if not record:
+        print(f"Error: User with email '{email}' not found.")
+        return None, None
+    if not authenticate(email, password, record.salt, record.hash):
+        return None, None
+    user = User.from_record(record)
+    event = Event.login_from_args(user.email, device, login_type)
+    user.last_login = event.login_time
+    user.mark_saved()
+    user_cache.put(user.column_values())
+    update_last_login = "UPDATE users SET last_login=? WHERE id=?"
+    if remote_events is not None:
+        event.lastrowid = None              # remote mode: no local row, the event goes to the ingestion server
+        event.login_future = event.record_login_async()
+        future = event_writer.submit(lambda conn: conn.execute(update_last_login, (user.last_login, user.id)).rowcount)
+        future.add_done_callback(lambda f: report_failure(f, "Error while updating last_login:"))
+        return user, event
+    replay_event_journal()                  # the database may be back: write the journaled events first
+    event_dict = event.column_values()      # snapshot: the GUI may change the event before it is written
+    def write_login(conn):
+        conn.execute(update_last_login, (user.last_login, user.id))
+        return event.insert_login(conn, event_dict)     # sets event.lastrowid
+    future = event.login_future = event_writer.submit(write_login, on_rollback=event.forget_lastrowid)
+    future.add_done_callback(lambda f: event.journal_login_on_failure(f, event_dict))
+    return user, event
+
+
 def initialize_database():
-    # Set the path to the database (cores.db)
-    script_directory = os.path.dirname(os.path.abspath(__file__))
+    # Open (or create) the database (cores.db) in the script's folder through the pool;
+    # returns None if the kiosk cannot record its events in it (call use_remote_events() first, if used)
     path_to_folder = os.path.dirname(os.path.abspath(__file__))
     conn = conn_cores_db(path_to_folder)
+    if conn:
+        # apply pending schema migrations (same engine as the "Update Database" settings tab)
+        from backend.migrations import migrate, get_schema_version, NATURAL_KEY_VERSION
+        try:
+            migrate(conn, progress=lambda step, total, text: print(f"[{step}/{total}] {text}"))
+        except sqlite3.Error as e:
+            print("Error while migrating the database:", e)
+        # the events are upserted on their natural key: without its unique index every write would fail
+        version = get_schema_version(conn)
+        if version < NATURAL_KEY_VERSION:
+            if remote_events is None:
+                print(f"Error: cores.db is at schema version {version}; version {NATURAL_KEY_VERSION} is required "
+                      f"to record the events. Fix the migration error, or set \"events_url\" (remote events).")
+                return None
+            print(f"Warning: cores.db is at schema version {version}: the events are only sent to the server.")
+            return conn
+        # write the events journaled while the database was not available
+        replay_event_journal()
+    return conn
 
 # # ===========================================================================================
 if __name__ == "__main__":
@@ -0,0 +1,157 @@
+'''
+Merge the cores.db files of many kiosks into one central reporting database
+
+Each source database is ATTACHed to the central one and copied with set-based statements
+(INSERT ... SELECT), one transaction per source:
+- events are identified by their natural key (device, login_time, email): a row already merged is
+  not copied twice, and a session that was still open at the previous merge gets its logout
+- users are de-duplicated by email (case-insensitive); the most recently modified row wins
+- the central 'merge_sources' table keeps a watermark per source (last events.id, last users.last_mod,
+  open sessions), so repeated merges only read the new rows of each kiosk
+
+Usage:  python -m backend.merge central.db kiosk_a/cores.db=Aurora\ A kiosk_b/cores.db=Symphony ...
+        (=device: the name used for the events recorded without a device; default: the folder name)
+'''
+import os
+import pathlib
+import sqlite3
+import time
+from datetime import datetime
+from backend.main import create_tables, OPEN_SESSION
+from backend.migrations import migrate
+from backend import records
+
+# pragmas of the central database: bulk loading, run by one process
+CENTRAL_PRAGMAS = ( "PRAGMA journal_mode=WAL",
+                    "PRAGMA synchronous=NORMAL",
+                    "PRAGMA temp_store=MEMORY",
+                    "PRAGMA cache_size=-200000" )   # 200 MB page cache
+
+# columns of 'users' copied from the sources (the central database has its own ids)
+USER_COLUMNS = tuple(col for col in records.USER_COLUMNS if col != 'id')
+
+
+def open_central_db(path_to_central_db, check_same_thread=True):
+    '''Open (or create) the central database, at the latest schema version, with the merge tables.
+       The natural key of the events (unique index, migration 3) is what makes a repeated merge a no-op.'''
+    is_new = not os.path.exists(path_to_central_db)
+    conn = sqlite3.connect(pathlib.Path(path_to_central_db).resolve().as_uri(), uri=True,
+                           check_same_thread=check_same_thread)
+    for pragma in CENTRAL_PRAGMAS:
+        conn.execute(pragma)
+    if is_new:
+        create_tables(conn)
+    migrate(conn)
+    conn.isolation_level = None     # transactions are managed explicitly (ATTACH is not allowed inside one)
+    conn.execute("""--sql
+        CREATE TABLE IF NOT EXISTS merge_sources (
+            source          TEXT PRIMARY KEY,
+            path            TEXT,
+            last_event_id   INTEGER,
+            last_user_mod   TEXT,
+            open_event_ids  TEXT,
+            merged_at       TEXT )
+    """)
+    return conn
+
+
+def get_watermark(conn, source):
+    row = conn.execute("SELECT last_event_id, last_user_mod, open_event_ids FROM merge_sources WHERE source = ?",
+                       (source,)).fetchone()
+    if row is None:
+        return 0, '', '[]'
+    return row
+
+
+def merge_source(conn, path_to_source_db, source):
+    '''Merge the new rows of one kiosk database into the central database (one transaction).
+       source: device name of the kiosk (watermark key, and device of the events recorded without one)
+       Returns (events_copied, users_copied).'''
+    last_event_id, last_user_mod, open_event_ids = get_watermark(conn, source)
+    source_uri = pathlib.Path(path_to_source_db).resolve().as_uri() + "?mode=ro"
+    conn.execute("ATTACH DATABASE ? AS src", (source_uri,))
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # events: new rows, plus the sessions that were still open at the previous merge
+            cursor = conn.execute(f"""--sql
+                INSERT INTO main.events (email, device, login_time, login_type, logout_time, logout_type)
+                SELECT email, COALESCE(device, :source), login_time, login_type, logout_time, logout_type
+                FROM   src.events
+                WHERE  id > :last_event_id OR id IN (SELECT value FROM json_each(:open_event_ids))
+                ON CONFLICT (device, login_time, email) DO UPDATE
+                    SET logout_time = excluded.logout_time, logout_type = excluded.logout_type
+                    WHERE NOT (logout_time IS excluded.logout_time AND logout_type IS excluded.logout_type)
+            """, {'source': source, 'last_event_id': last_event_id, 'open_event_ids': open_event_ids})
+            events_copied = cursor.rowcount
+
+            # users: one row per email, the most recently modified wins
+            columns = ", ".join(USER_COLUMNS)
+            updates = ", ".join(f"{col} = excluded.{col}" for col in USER_COLUMNS if col != 'email')
+            cursor = conn.execute(f"""--sql
+                INSERT INTO main.users ({columns})
+                SELECT {columns} FROM src.users
+                WHERE  email IS NOT NULL AND COALESCE(last_mod, '') >= :last_user_mod
+                ORDER BY last_mod
+                ON CONFLICT (email COLLATE NOCASE) DO UPDATE SET {updates}
+                    WHERE COALESCE(excluded.last_mod, '') > COALESCE(users.last_mod, '')
+            """, {'last_user_mod': last_user_mod})
+            users_copied = cursor.rowcount
+
+            # new watermark of the source
+            conn.execute(f"""--sql
+                INSERT OR REPLACE INTO merge_sources (source, path, last_event_id, last_user_mod, open_event_ids, merged_at)
+                VALUES (:source, :path,
+                        (SELECT COALESCE(MAX(id), 0) FROM src.events),
+                        (SELECT COALESCE(MAX(last_mod), '') FROM src.users),
+                        (SELECT json_group_array(id) FROM src.events WHERE {OPEN_SESSION}),
+                        :merged_at)
+            """, {'source': source, 'path': os.path.abspath(path_to_source_db),
+                  'merged_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.execute("DETACH DATABASE src")
+    return events_copied, users_copied
+
+
+def merge_databases(path_to_central_db, sources):
+    '''Merge several kiosk databases into the central database.
+       sources: list of (path_to_source_db, device_name)
+       Returns a dict {device_name: (events_copied, users_copied) or the error message}.'''
+    conn = open_central_db(path_to_central_db)
+    results = {}
+    total_start = time.perf_counter()
+    for path_to_source_db, source in sources:
+        start = time.perf_counter()
+        try:
+            results[source] = merge_source(conn, path_to_source_db, source)
+        except sqlite3.Error as e:
+            print(f"Error while merging '{path_to_source_db}' ({source}):", e)
+            results[source] = str(e)
+            continue
+        events_copied, users_copied = results[source]
+        print(f"{source}: {events_copied} events, {users_copied} users merged in {time.perf_counter() - start:.2f} s")
+    conn.execute("PRAGMA optimize")
+    conn.close()
+    print(f"Merged {len(sources)} database(s) in {time.perf_counter() - total_start:.2f} s")
+    return results
+
+
+def parse_source(argument):
+    '''"path=Device name" -> (path, device name);  "path" -> (path, name of the folder of path)'''
+    path, _, device = argument.partition('=')
+    if not device:
+        device = os.path.basename(os.path.dirname(os.path.abspath(path))) or path
+    return path, device
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Merge kiosk cores.db files into a central reporting database.")
+    parser.add_argument('central', help="path of the central database (created if it does not exist)")
+    parser.add_argument('sources', nargs='+', help="kiosk databases, as path or path=device name")
+    args = parser.parse_args()
+    merge_databases(args.central, [parse_source(argument) for argument in args.sources])
@@ -0,0 +1,272 @@
+'''
+Versioned schema migrations for cores.db
+
+The version of a database is the highest version recorded in the 'schema_version' table
+(0 for a database created by create_tables() and never migrated).
+Every migration is an ordered list of steps (SQL strings or functions taking the connection).
+migrate() applies all pending migrations in ONE transaction: either the database reaches
+the latest version, or nothing is changed.
+
+Usage:  from backend.migrations import migrate
+        migrate(progress=lambda step, total, text: print(step, total, text))
+'''
+import sqlite3
+from datetime import datetime
+from backend.main import cores_db_pool, collapse_duplicate_users
+
+
+def create_schema_version_table(conn):
+    conn.execute("""--sql
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version     INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at  TEXT )
+    """)
+
+
+def get_schema_version(conn):
+    ''' Returns the current version of the schema (0 if never migrated)'''
+    create_schema_version_table(conn)
+    (version,) = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()
+    return version
+
+
+def copy_sequence(table_name, old_table_name):
+    '''Returns a step that carries the AUTOINCREMENT counter of old_table_name over to table_name,
+       so that the ids of deleted rows are not reused after a table rebuild'''
+    def step(conn):
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (old_table_name,)).fetchone()
+        if row:
+            conn.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table_name,))
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table_name, row[0]))
+    return step
+
+
+def table_columns(conn, table_name):
+    return [info[1] for info in conn.execute(f"PRAGMA table_info({table_name})")]
+
+
+def copy_rows(table_name, new_table_name, columns, optional=None):
+    '''Returns a step copying the rows of table_name into new_table_name during a table rebuild.
+       optional: {column: type} of columns that table_name may already have (create_tables() makes the
+       columns of the current records, e.g. events.last_seen): they are added to new_table_name and
+       copied as well. The non-NULL values of every copied column are counted in both tables, and the
+       step raises sqlite3.DatabaseError (the migration is rolled back) if anything was lost.'''
+    def step(conn):
+        existing = table_columns(conn, table_name)
+        copied = list(columns)
+        for column_name, column_type in (optional or {}).items():
+            if column_name in existing:
+                conn.execute(f"ALTER TABLE {new_table_name} ADD COLUMN {column_name} {column_type}")
+                copied.append(column_name)
+        column_list = ', '.join(copied)
+        conn.execute(f"INSERT INTO {new_table_name} ({column_list}) SELECT {column_list} FROM {table_name}")
+        counts = ', '.join(f"COUNT({column_name})" for column_name in copied)
+        before = conn.execute(f"SELECT COUNT(*), {counts} FROM {table_name}").fetchone()
+        after = conn.execute(f"SELECT COUNT(*), {counts} FROM {new_table_name}").fetchone()
+        if before != after:
+            raise sqlite3.DatabaseError(f"rebuild of '{table_name}' lost values: {before} -> {after} "
+                                        f"(rows, {column_list})")
+    return step
+
+
+def epoch(column):
+    ''' SQL expression converting a '%Y-%m-%d %H:%M:%S' column to INTEGER epoch seconds (NULL if not a date)'''
+    return f"CAST(strftime('%s', {column}) AS INTEGER)"
+
+
+# ============================================================================================
+# Migration 1: typed columns and indexes
+#   - login_attempts becomes INTEGER
+#   - INTEGER epoch timestamps, generated from the text timestamps (never out of sync, no extra writes)
+#   - indexes for the login lookups and for the reports on 'events'
+# SQLite cannot change the type of a column, so both tables are rebuilt (same column order); the columns of
+# later migrations that create_tables() already made (events.last_seen) are carried over.
+# ============================================================================================
+MIGRATION_1_STEPS = [
+    """--sql
+    CREATE TABLE users_v1 (
+        id              INTEGER PRIMARY KEY AUTOINCREMENT,
+        email           TEXT,
+        name            TEXT,
+        nickname        TEXT,
+        title           TEXT,
+        phone           TEXT,
+        pi_name         TEXT,
+        pi_phone        TEXT,
+        type            TEXT,
+        last_mod_type   TEXT,
+        last_mod        TEXT,
+        first_login     TEXT,
+        last_login      TEXT,
+        salt            TEXT,
+        hash            TEXT,
+        login_attempts  INTEGER,
+        locked_after    TEXT,
+        last_mod_epoch   INTEGER GENERATED ALWAYS AS (""" + epoch('last_mod') + """) VIRTUAL,
+        last_login_epoch INTEGER GENERATED ALWAYS AS (""" + epoch('last_login') + """) VIRTUAL )
+    """,
+    """--sql
+    INSERT INTO users_v1 (id, email, name, nickname, title, phone, pi_name, pi_phone, type, last_mod_type,
+                          last_mod, first_login, last_login, salt, hash, login_attempts, locked_after)
+    SELECT id, email, name, nickname, title, phone, pi_name, pi_phone, type, last_mod_type,
+           last_mod, first_login, last_login, salt, hash, CAST(login_attempts AS INTEGER), locked_after
+    FROM users
+    """,
+    copy_sequence('users_v1', 'users'),
+    "DROP TABLE users",
+    "ALTER TABLE users_v1 RENAME TO users",
+    """--sql
+    CREATE TABLE events_v1 (
+        id              INTEGER PRIMARY KEY AUTOINCREMENT,
+        email           TEXT,
+        device          TEXT,
+        login_time      TEXT,
+        login_type      TEXT,
+        logout_time     TEXT,
+        logout_type     TEXT,
+        login_epoch     INTEGER GENERATED ALWAYS AS (""" + epoch('login_time') + """) VIRTUAL,
+        logout_epoch    INTEGER GENERATED ALWAYS AS (""" + epoch('logout_time') + """) VIRTUAL )
+    """,
+    copy_rows('events', 'events_v1', ['id', 'email', 'device', 'login_time', 'login_type', 'logout_time',
+                                       'logout_type'], optional={'last_seen': 'TEXT'}),
+    copy_sequence('events_v1', 'events'),
+    "DROP TABLE events",
+    "ALTER TABLE events_v1 RENAME TO events",
+    "CREATE INDEX IF NOT EXISTS idx_users_email ON users (email COLLATE NOCASE)",
+    "CREATE INDEX IF NOT EXISTS idx_events_email ON events (email)",
+    "CREATE INDEX IF NOT EXISTS idx_events_device_login_time ON events (device, login_time)",
+    "CREATE INDEX IF NOT EXISTS idx_events_logout_type ON events (logout_type)",
+    "ANALYZE",
+]
+
+
+# ============================================================================================
+# Migration 2: one user per email
+#   duplicates are collapsed first (set-based), then the email becomes unique (case-insensitive),
+#   which lets the iLab registration save users with a single upsert
+# ============================================================================================
+MIGRATION_2_STEPS = [
+    collapse_duplicate_users,
+    "DROP INDEX IF EXISTS idx_users_email",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_users_email ON users (email COLLATE NOCASE)",
+]
+
+
+# ============================================================================================
+# Migration 3: natural key of the events
+#   (device, login_time, email) identifies a session on every kiosk: the journal replay, the remote
+#   ingestion and the merge of kiosk databases upsert on it. Exact duplicates (same key) are removed,
+#   keeping the row with the most information (a recorded logout), then the lowest id.
+#   The unique index replaces idx_events_device_login_time (same leading columns).
+# ============================================================================================
+MIGRATION_3_STEPS = [
+    """--sql
+    DELETE FROM events WHERE id IN (
+        SELECT id FROM ( SELECT id, ROW_NUMBER() OVER (
+                                    PARTITION BY device, login_time, email
+                                    ORDER BY logout_time IS NULL OR logout_time = 'N/A', id) AS rank
+                         FROM   events
+                         WHERE  device IS NOT NULL )
+        WHERE rank > 1 )
+    """,
+    "DROP INDEX IF EXISTS idx_events_device_login_time",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_events_natural_key ON events (device, login_time, email)",
+]
+
+
+# ============================================================================================
+# Migration 4: normalized logout times
+#   record_logout() used to store datetime.now() as is ('%Y-%m-%d %H:%M:%S.%f');
+#   every timestamp of cores.db is '%Y-%m-%d %H:%M:%S'
+# ============================================================================================
+MIGRATION_4_STEPS = [
+    """--sql
+    UPDATE events SET logout_time = strftime('%Y-%m-%d %H:%M:%S', logout_time)
+    WHERE  length(logout_time) > 19 AND strftime('%Y-%m-%d %H:%M:%S', logout_time) IS NOT NULL
+    """,
+]
+
+
+def add_column(table_name, column_name, column_type):
+    '''Returns a step adding a column (skipped if the table already has it, e.g. created by create_tables())'''
+    def step(conn):
+        if column_name not in table_columns(conn, table_name):
+            conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+    return step
+
+
+# ============================================================================================
+# Migration 5: session heartbeat
+#   last_seen: last checkpoint of an open session (written periodically by the MiniGui), so that
+#   the length of a session interrupted by a crash is known (used by close_orphaned_sessions)
+# ============================================================================================
+MIGRATION_5_STEPS = [
+    add_column('events', 'last_seen', 'TEXT'),
+]
+
+
+# ordered list of (version, description, steps)
+MIGRATIONS = [
+    (1, "typed columns (INTEGER epoch timestamps, INTEGER login_attempts) and indexes", MIGRATION_1_STEPS),
+    (2, "unique email (duplicate users collapsed)", MIGRATION_2_STEPS),
+    (3, "unique natural key of the events (device, login_time, email)", MIGRATION_3_STEPS),
+    (4, "logout times in the '%Y-%m-%d %H:%M:%S' format", MIGRATION_4_STEPS),
+    (5, "session heartbeat (events.last_seen)", MIGRATION_5_STEPS),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+NATURAL_KEY_VERSION = 3     # uq_events_natural_key: required by the upserts of the events (ON CONFLICT)
+
+
+def run_step(conn, step):
+    if callable(step):
+        step(conn)
+    else:
+        conn.execute(step)
+
+
+def migrate(conn=None, progress=None):
+    '''Apply all pending migrations in one transaction.
+       conn:     connection to use (default: the pooled connection of the calling thread)
+       progress: optional callback progress(step, total_steps, description), called before each step
+       Returns the schema version reached. Raises sqlite3.Error (after rollback) if a step fails.'''
+    if conn is None:
+        conn = cores_db_pool.connection()
+
+    # BEGIN IMMEDIATE takes the write lock first, so that two kiosks cannot migrate the same file twice
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        current_version = get_schema_version(conn)
+        pending = [m for m in MIGRATIONS if m[0] > current_version]
+        total_steps = sum(len(steps) for _, _, steps in pending)
+        step_count = 0
+        for version, description, steps in pending:
+            for step in steps:
+                step_count += 1
+                if progress:
+                    progress(step_count, total_steps, f"v{version}: {description}")
+                run_step(conn, step)
+            conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                         (version, description, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+            current_version = version
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+    if pending:
+        print(f"Database migrated to version {current_version}.")
+    return current_version
+
+
+def needs_migration(conn=None):
+    ''' Returns True if the database is older than LATEST_VERSION'''
+    if conn is None:
+        conn = cores_db_pool.connection()
+    with conn:
+        return get_schema_version(conn) < LATEST_VERSION
+
+
+if __name__ == "__main__":
+    migrate(progress=lambda step, total, text: print(f"[{step}/{total}] {text}"))
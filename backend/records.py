@@ -0,0 +1,64 @@
+'''
+Schema of the tables of cores.db and the compact record types generated from it
+
+The columns of 'users' and 'events' are defined once, here (name and example value, in table order);
+everything else is generated from this definition: USER_COLUMNS/EVENT_COLUMNS, the SELECT statements,
+the record types and the attributes (__slots__) of the User and Event classes of backend/main.py.
+
+The records are named tuples: no per-instance dict, and the row factory builds them directly
+from the tuples returned by sqlite3 (one allocation per row).
+
+Usage:  cursor = conn.execute(SELECT_EVENTS + " WHERE device = ?", (device,))
+        cursor.row_factory = row_factory(EventRecord)
+        for event in cursor:  print(event.email, event.login_time)
+'''
+from collections import namedtuple
+
+# column -> example value (shows the format; the objects are created with None values)
+USER_SCHEMA = { 'id'             : 123,
+                'email'          : 'John.Doe@mail.edu',         # previously named user_id
+                'name'           : 'John Doe',                  # previously named user_name
+                'nickname'       : 'Nick',                      # previously named user_nickname
+                'title'          : 'PI | PhD student | Tech',   # the title is retried from iLab
+                'phone'          : '123-456-7890',              # previously user_phone
+                'pi_name'        : 'Dr. Pie',
+                'pi_phone'       : '555-555-5555',
+                'type'           : 'user | admin',              # previously user_type
+                'last_mod_type'  : 'iLab',
+                'last_mod'       : '2023-08-18 21:20:00',
+                'first_login'    : '2023-07-17 17:20:00',
+                'last_login'     : '2023-07-18 09:20:00',
+                'salt'           : '12345678901234567890',
+                'hash'           : 'ofiae98aeikjs;aelsij',
+                'login_attempts' : 1,
+                'locked_after'   : '2024-12-31 00:00:00' }
+
+EVENT_SCHEMA = { 'id'          : 123,
+                 'email'       : 'xyz@chop.edu',
+                 'device'      : 'Aurora alpha',
+                 'login_time'  : '2023-08-18 14:20:00',
+                 'login_type'  : 'local | iLab | EMERGENCY',
+                 'logout_time' : '2023-08-18 16:20:00',
+                 'logout_type' : 'by_user  | by_inactivity  | PENDING',
+                 'last_seen'   : '2023-08-18 16:19:00' }          # last heartbeat of the session (migration 5)
+
+# names of the columns, in table order
+USER_COLUMNS = tuple(USER_SCHEMA)
+EVENT_COLUMNS = tuple(EVENT_SCHEMA)
+
+# SELECT of these columns (not '*': the tables also have generated columns since migration 1)
+SELECT_USERS = f"SELECT {', '.join(USER_COLUMNS)} FROM users"
+SELECT_EVENTS = f"SELECT {', '.join(EVENT_COLUMNS)} FROM events"
+
+# read-only records, one per row
+UserRecord = namedtuple('UserRecord', USER_COLUMNS)
+EventRecord = namedtuple('EventRecord', EVENT_COLUMNS)
+
+
+def row_factory(record_type):
+    '''sqlite3 row factory building record_type straight from the row tuple (the row must have
+       the columns of the record, in order: use SELECT_USERS / SELECT_EVENTS)'''
+    new = tuple.__new__
+    def factory(cursor, row):
+        return new(record_type, row)
+    return factory
@@ -0,0 +1,140 @@
+'''
+Client side of the "remote events" mode: send the login/logout events to the ingestion server
+
+The events are queued from the GUI thread and sent by one thread, in batches, over a persistent
+keep-alive HTTP connection (backend/ingest.py writes each batch in a grouped transaction).
+When the server is unreachable (or answers with an error), the batch is handed to `fallback`
+(local storage: cores.db, or the local journal) and the server is not tried again before
+`retry_after` seconds. Events stored locally reach the central database with backend/merge.py.
+
+Usage:  sink = RemoteEventSink('http://reports-server:8765/events', fallback)
+        future = sink.submit({'op': 'login', 'email': ..., 'device': ..., 'login_time': ..., ...})
+'''
+import http.client
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+_STOP = object()   # queue marker: stop the thread
+
+
+class RemoteEventSink:
+    def __init__(self, url, fallback, batch_size=200, timeout=5, retry_after=30):
+        '''url:      address of POST /events of the ingestion server
+           fallback: function fallback(entries) -> Future, storing a batch locally (called in the thread of the sink)'''
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or '/events'
+        self.fallback = fallback
+        self.batch_size = batch_size        # maximum number of events per request
+        self.timeout = timeout              # seconds, connection and response
+        self.retry_after = retry_after      # seconds without trying the server after a failure
+        self._retry_at = 0.0
+        self._connection = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='remote_events', daemon=True)
+                self._thread.start()
+
+    def submit(self, entry):
+        '''Queue one event (journal line format, see backend/journal.py); returns a Future (True when stored,
+           remotely or locally)'''
+        future = Future()
+        self.start()
+        self._queue.put((entry, future))
+        return future
+
+    def stop(self, timeout=10):
+        '''Send the queued events, then stop the thread (call on shutdown, before the local writer is stopped)'''
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def _next_batch(self):
+        '''Wait for one event, then take the events already waiting (up to batch_size)'''
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        try:
+            while True:
+                batch = self._next_batch()
+                stop = batch[-1] is _STOP
+                if stop:
+                    batch.pop()
+                batch = [(entry, future) for entry, future in batch if future.set_running_or_notify_cancel()]
+                if batch:
+                    self._send(batch)
+                if stop:
+                    return
+        finally:
+            self._close_connection()
+
+    def _send(self, batch):
+        entries = [entry for entry, _ in batch]
+        if time.monotonic() >= self._retry_at:
+            try:
+                self._post(entries)
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                print(f"Events server {self.host}:{self.port} not available ({e}): "
+                      f"events stored locally for {self.retry_after} s.")
+                self._close_connection()
+                self._retry_at = time.monotonic() + self.retry_after
+            else:
+                for _, future in batch:
+                    future.set_result(True)
+                return
+        self._store_locally(batch)
+
+    def _post(self, entries):
+        '''POST one batch; raises if the server did not commit it'''
+        body = json.dumps({'events': entries}, separators=(',', ':')).encode('utf-8')
+        for attempt in (1, 2):
+            if self._connection is None:
+                self._connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self._connection.request('POST', self.path, body, {'Content-Type': 'application/json'})
+                response = self._connection.getresponse()
+                answer = json.loads(response.read() or b'{}')
+                break
+            except (ConnectionResetError, BrokenPipeError, http.client.RemoteDisconnected):
+                # the server closed the idle keep-alive connection: reconnect once
+                self._close_connection()
+                if attempt == 2:
+                    raise
+        if response.status != 200:
+            raise http.client.HTTPException(f"HTTP {response.status}: {answer.get('error')}")
+        if response.getheader('Connection', '').lower() == 'close':
+            self._close_connection()
+
+    def _store_locally(self, batch):
+        local = self.fallback([entry for entry, _ in batch])
+        def on_done(future):
+            for _, entry_future in batch:
+                if future.exception() is None:
+                    entry_future.set_result(True)
+                else:
+                    entry_future.set_exception(future.exception())
+        local.add_done_callback(on_done)
+
+    def _close_connection(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -0,0 +1,164 @@
+'''
+Bulk import of users from a roster (CSV file, e.g. exported from iLab) into cores.db
+
+The file is read as a stream (csv.DictReader), validated row by row, and written in chunks with
+executemany(): one upsert statement keyed on the email (unique, case-insensitive), all chunks in
+ONE transaction, so a roster of 10k users takes well under a second and a failed import changes nothing.
+- the header names are matched case-insensitively, with a few aliases (e.g. "E-mail", "PI")
+- rows without a valid email are skipped (and counted)
+- rows of type 'admin' are skipped (and counted) unless allow_admin (--allow-admin): a roster file must not
+  be able to create administrators
+- an existing user is only updated if a value differs; empty cells never erase stored values,
+  and the type of an existing user is never changed (an admin stays admin)
+- imported users have no password yet: they log in with iLab the first time
+
+Usage:  python -m backend.roster roster.csv [--dry-run] [--allow-admin]
+'''
+import csv
+import re
+import sqlite3
+import time
+from datetime import datetime
+from backend.main import cores_db, user_cache
+
+# precompiled once: the whole cell must be an email address
+EMAIL_REGEX = re.compile(r'[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}')
+
+# columns of 'users' that a roster can set (never id, salt, hash, logins)
+ROSTER_COLUMNS = ('email', 'name', 'nickname', 'title', 'phone', 'pi_name', 'pi_phone', 'type')
+
+# other header names accepted for these columns (lower case)
+HEADER_ALIASES = {'e-mail': 'email', 'email address': 'email', 'user email': 'email',
+                  'full name': 'name', 'user name': 'name',
+                  'pi': 'pi_name', 'pi name': 'pi_name', 'principal investigator': 'pi_name',
+                  'pi phone': 'pi_phone', 'phone number': 'phone', 'user type': 'type'}
+
+CHUNK_SIZE = 2000   # rows per executemany()
+
+# last_mod_type of the users written by an import
+LAST_MOD_TYPE = 'roster'
+
+
+def map_header(fieldnames):
+    '''Returns {header of the file: column of 'users'} for the headers that match a roster column'''
+    mapping = {}
+    for field in fieldnames or []:
+        key = (field or '').strip().lower()
+        column = key.replace(' ', '_') if key.replace(' ', '_') in ROSTER_COLUMNS else HEADER_ALIASES.get(key)
+        if column and column not in mapping.values():
+            mapping[field] = column
+    return mapping
+
+
+def read_roster(csv_file, counts, allow_admin=False):
+    '''Yield one dict per valid row (all ROSTER_COLUMNS, None for empty cells); counts['skipped'] += 1 per invalid row,
+       and per admin row unless allow_admin (also counted in counts['skipped_admin'])'''
+    reader = csv.DictReader(csv_file)
+    mapping = map_header(reader.fieldnames)
+    if 'email' not in mapping.values():
+        raise ValueError(f"no email column in the header: {reader.fieldnames}")
+    for row in reader:
+        user = dict.fromkeys(ROSTER_COLUMNS)
+        for field, column in mapping.items():
+            value = (row.get(field) or '').strip()
+            user[column] = value or None
+        if not user['email'] or not EMAIL_REGEX.fullmatch(user['email']):
+            counts['skipped'] += 1
+            continue
+        if user['type'] == 'admin' and not allow_admin:
+            counts['skipped'] += 1
+            counts['skipped_admin'] += 1
+            continue
+        user['type'] = user['type'] if user['type'] in ('user', 'admin') else 'user'
+        yield user
+
+
+def chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def upsert_sql():
+    columns = ROSTER_COLUMNS + ('last_mod', 'last_mod_type')
+    updated = [col for col in ROSTER_COLUMNS if col not in ('email', 'type')]
+    # an empty cell keeps the stored value; the row is only written if something changes
+    assignments = ",\n".join(f"{col} = COALESCE(excluded.{col}, users.{col})" for col in updated)
+    changed = " OR ".join(f"users.{col} IS NOT COALESCE(excluded.{col}, users.{col})" for col in updated)
+    return f"""--sql
+        INSERT INTO users ({', '.join(columns)})
+        VALUES ({', '.join(':' + col for col in columns)})
+        ON CONFLICT (email COLLATE NOCASE) DO UPDATE SET
+            {assignments},
+            last_mod = excluded.last_mod,
+            last_mod_type = excluded.last_mod_type
+        WHERE {changed}
+    """
+
+
+def import_roster(path_to_csv, chunk_size=CHUNK_SIZE, dry_run=False, progress=None, allow_admin=False):
+    '''Insert or update the users of a CSV roster, in one transaction.
+       dry_run:  validate and count, then roll back
+       allow_admin: import the rows of type 'admin' (skipped otherwise)
+       progress: optional callback progress(rows_done, rows_per_sec) called after each chunk
+       Returns {'inserted': n, 'updated': n, 'unchanged': n, 'skipped': n, 'skipped_admin': n}, or None if the
+       import failed ('skipped' includes 'skipped_admin').'''
+    counts = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'skipped': 0, 'skipped_admin': 0}
+    sql = upsert_sql()
+    seen = set()        # emails already imported from this file (lower case)
+    last_mod = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    rows_done = 0
+    start = time.perf_counter()
+    try:
+        with open(path_to_csv, 'r', newline='', encoding='utf-8-sig') as csv_file, cores_db() as conn:
+            for chunk in chunks(read_roster(csv_file, counts, allow_admin), chunk_size):
+                # which users of this chunk exist already (one query per chunk)
+                emails = [user['email'] for user in chunk]
+                placeholders = ", ".join("?" * len(emails))
+                existing = {email.lower() for (email,) in conn.execute(
+                    f"SELECT email FROM users WHERE email COLLATE NOCASE IN ({placeholders})", emails)}
+                new_users = 0
+                for user in chunk:
+                    user['last_mod'] = last_mod
+                    user['last_mod_type'] = LAST_MOD_TYPE
+                    key = user['email'].lower()
+                    if key not in existing and key not in seen:
+                        new_users += 1
+                    seen.add(key)
+                # rows written = inserted + updated (the unchanged users are not written)
+                before = conn.total_changes
+                conn.executemany(sql, chunk)
+                written = conn.total_changes - before
+                counts['inserted'] += new_users
+                counts['updated'] += written - new_users
+                counts['unchanged'] += len(chunk) - written
+                rows_done += len(chunk)
+                if progress:
+                    progress(rows_done, rows_done / max(time.perf_counter() - start, 1e-9))
+            if dry_run:
+                conn.rollback()
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"Failed to import {path_to_csv}: {e}")
+        return None
+    user_cache.clear()      # rows of cached users may have changed
+
+    elapsed = time.perf_counter() - start
+    print(f"{'Checked' if dry_run else 'Imported'} {path_to_csv} in {elapsed:.2f} s: {counts['inserted']} inserted, "
+          f"{counts['updated']} updated, {counts['unchanged']} unchanged, {counts['skipped']} skipped "
+          f"({counts['skipped_admin']} admin, {counts['skipped'] - counts['skipped_admin']} invalid email)")
+    return counts
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Import a CSV roster of users into cores.db.")
+    parser.add_argument('roster', help="CSV file with a header (email required; name, title, phone, pi_name, ...)")
+    parser.add_argument('--dry-run', action='store_true', help="validate and count, without writing")
+    parser.add_argument('--allow-admin', action='store_true', help="import the rows of type 'admin' (skipped by default)")
+    args = parser.parse_args()
+    import_roster(args.roster, dry_run=args.dry_run, allow_admin=args.allow_admin)
@@ -0,0 +1,249 @@
+'''
+Opt-in statistics of the SQL statements executed on cores.db
+
+When enabled (backend.main.enable_sql_stats(), or "sql_stats": true in config.json), the pool opens its
+connections with InstrumentedConnection: every statement is timed and recorded under its template
+(the SQL with whitespace collapsed, literals and IN-lists replaced by '?'), together with:
+- count, total/avg/max time, p50/p99 from a histogram (power-of-2 buckets of microseconds), all of the
+  execution only (execute/executemany)
+- rows: rows fetched for a SELECT, rows changed for INSERT/UPDATE/DELETE
+- fetch: time spent in the fetches of a SELECT after its execution (kept apart: a row can be fetched long
+  after the statement ran, and the fetches are not one call each)
+- wait: wall time minus the CPU time of the thread, i.e. sleeping in the busy handler (lock waits) or on the disk
+- errors, and how many were "database is locked/busy"
+- the call sites (module.function:line of the backend code that ran it)
+Commits and rollbacks of `with conn:` are recorded as "COMMIT" / "ROLLBACK".
+When not enabled, the connections are plain sqlite3 connections (no cost).
+
+Usage:  from backend.main import enable_sql_stats, sql_stats
+        enable_sql_stats()                      # at startup, before the database is used
+        ...
+        for row in sql_stats.snapshot(): print(row['template'], row['count'], row['p99_ms'])
+        sql_stats.dump('sql_stats.json')
+'''
+import contextlib
+import json
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+
+BUCKETS = 32            # bucket b: durations of [2**(b-1), 2**b) microseconds
+MAX_CALL_SITES = 5      # call sites listed per template in snapshot()
+SKIPPED_FUNCTIONS = {'ConnectionPool.transaction', 'cores_db'}     # not call sites: `with cores_db() as conn:`
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_COMMENTS = re.compile(r"--[^\n]*")
+
+
+@lru_cache(maxsize=1024)
+def template_of(sql):
+    '''SQL -> template: comments removed, whitespace collapsed, literals and lists of placeholders as '?' '''
+    template = " ".join(_COMMENTS.sub(" ", sql).split())
+    template = _LITERALS.sub("?", template)
+    return _IN_LISTS.sub("(?, ...)", template)
+
+
+class StatementStats:
+    __slots__ = ('count', 'total', 'max', 'rows', 'fetch', 'wait', 'errors', 'locked', 'buckets', 'call_sites')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0        # seconds
+        self.max = 0.0
+        self.rows = 0
+        self.fetch = 0.0        # seconds, not in total/max/buckets
+        self.wait = 0.0
+        self.errors = 0
+        self.locked = 0
+        self.buckets = [0] * BUCKETS
+        self.call_sites = Counter()
+
+    def add(self, seconds, wait, rows, error, call_site):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.rows += rows
+        self.wait += wait
+        self.buckets[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+        if error is not None:
+            self.errors += 1
+            if 'locked' in str(error) or 'busy' in str(error):
+                self.locked += 1
+        self.call_sites[call_site] += 1
+
+    def percentile(self, fraction):
+        '''Upper bound (ms) of the bucket holding the given fraction of the durations'''
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** bucket / 1000, self.max * 1000)
+        return self.max * 1000
+
+
+class SqlStats:
+    def __init__(self):
+        self.enabled = False
+        self.since = None
+        self._lock = threading.Lock()
+        self._stats = {}        # template -> StatementStats
+
+    def record(self, sql, seconds, wait=0.0, rows=0, error=None, call_site=None):
+        template = template_of(sql)
+        with self._lock:
+            stats = self._stats.get(template)
+            if stats is None:
+                stats = self._stats[template] = StatementStats()
+            stats.add(seconds, wait, rows, error, call_site)
+
+    def add_rows(self, sql, rows, seconds):
+        '''Rows fetched (and the time spent fetching them) after the execution of a SELECT'''
+        with self._lock:
+            stats = self._stats.get(template_of(sql))
+            if stats is not None:
+                stats.rows += rows
+                stats.fetch += seconds
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.since = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    def snapshot(self):
+        '''Returns one dict per template, the most expensive (execution and fetch time) first'''
+        with self._lock:
+            items = list(self._stats.items())
+            rows = []
+            for template, s in items:
+                rows.append({'template': template,
+                             'count': s.count,
+                             'total_ms': round(s.total * 1000, 3),
+                             'avg_ms': round(s.total * 1000 / s.count, 3),
+                             'p50_ms': round(s.percentile(0.5), 3),
+                             'p99_ms': round(s.percentile(0.99), 3),
+                             'max_ms': round(s.max * 1000, 3),
+                             'rows': s.rows,
+                             'fetch_ms': round(s.fetch * 1000, 3),
+                             'wait_ms': round(s.wait * 1000, 3),
+                             'errors': s.errors,
+                             'locked': s.locked,
+                             'call_sites': dict(s.call_sites.most_common(MAX_CALL_SITES))})
+        rows.sort(key=lambda row: row['total_ms'] + row['fetch_ms'], reverse=True)
+        return rows
+
+    def dump(self, path):
+        '''Write the snapshot to a JSON file; returns the path, or False if it could not be written'''
+        report = {'since': self.since, 'dumped_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                  'statements': self.snapshot()}
+        try:
+            with open(path, 'w', encoding='utf-8') as json_file:
+                json.dump(report, json_file, indent=2)
+        except OSError as e:
+            print(f"Failed to write the SQL statistics to {path}: {e}")
+            return False
+        return path
+
+
+# the statistics of the process (filled by the instrumented connections)
+sql_stats = SqlStats()
+
+
+def call_site():
+    '''module.function:line of the first caller outside this module, contextlib and the pool'''
+    frame = sys._getframe(2)
+    while frame is not None and (frame.f_code.co_filename in (__file__, contextlib.__file__)
+                                 or frame.f_code.co_qualname in SKIPPED_FUNCTIONS):
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return f"{frame.f_globals.get('__name__')}.{frame.f_code.co_name}:{frame.f_lineno}"
+
+
+def timed(sql, function, *args):
+    '''Run function(*args) (executing sql) and record it; returns its result'''
+    wall, cpu = time.perf_counter(), time.thread_time()
+    result, error = None, None
+    try:
+        result = function(*args)
+        return result
+    except sqlite3.Error as e:
+        error = e
+        raise
+    finally:
+        seconds = time.perf_counter() - wall
+        wait = max(seconds - (time.thread_time() - cpu), 0.0)
+        rows = 0
+        if isinstance(result, sqlite3.Cursor) and result.rowcount > 0:
+            rows = result.rowcount      # INSERT/UPDATE/DELETE (-1 for a SELECT: rows are counted when fetched)
+        sql_stats.record(sql, seconds, wait, rows, error, call_site())
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    _sql = None
+
+    def execute(self, sql, parameters=()):
+        self._sql = sql
+        return timed(sql, super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql = sql
+        return timed(sql, super().executemany, sql, seq_of_parameters)
+
+    def _fetched(self, rows, start):
+        if self._sql is not None and rows:
+            sql_stats.add_rows(self._sql, rows, time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(row is not None, start)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(len(rows), start)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(len(rows), start)
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        row = super().__next__()
+        self._fetched(1, start)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    '''sqlite3.Connection recording its statements in sql_stats (see ConnectionPool.factory)'''
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        return timed("COMMIT", super().commit)
+
+    def rollback(self):
+        return timed("ROLLBACK", super().rollback)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # `with conn:` commits (or rolls back) without calling commit()/rollback()
+        if not self.in_transaction:
+            return super().__exit__(exc_type, exc_value, traceback)
+        return timed("ROLLBACK" if exc_type else "COMMIT", super().__exit__, exc_type, exc_value, traceback)
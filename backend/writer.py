@@ -0,0 +1,133 @@
+'''
+Background writer for cores.db
+
+One thread owns the write connection and executes the jobs submitted from the GUI thread,
+so that a slow or locked database never freezes the kiosk.
+A job is a function taking the connection; submit() returns a concurrent.futures.Future
+that receives the job's return value (e.g. the lastrowid of an INSERT).
+Jobs waiting in the queue are executed together, in one transaction (one fsync per batch).
+If that transaction fails, it is rolled back and the jobs are run again one per transaction; a job that
+keeps state in Python objects (e.g. Event.lastrowid from its INSERT) gives an on_rollback function,
+called after each rollback of its writes, before the job is run again or fails.
+
+Usage:  future = writer.submit(lambda conn: conn.execute(sql, params).lastrowid)
+        future = writer.submit(event.insert_login, on_rollback=event.forget_lastrowid)
+        future.add_done_callback(...)   or   future.result(timeout)
+'''
+import queue
+import threading
+from concurrent.futures import Future
+
+_STOP = object()   # queue marker: stop the thread
+
+
+class BackgroundWriter:
+    def __init__(self, pool, batch_size=100):
+        self.pool = pool                # the connection of the writer thread is taken from this pool
+        self.batch_size = batch_size    # maximum number of jobs per transaction
+        self.after_batch = None         # optional function called in the writer thread after each batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='cores_db_writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, job, on_rollback=None):
+        '''Queue job(conn) for the writer thread; returns a Future with the job's return value.
+           on_rollback(): called in the writer thread when the writes of the job are rolled back'''
+        future = Future()
+        self.start()
+        self._queue.put((job, future, on_rollback))
+        return future
+
+    def flush(self, timeout=None):
+        '''Block until every job submitted before this call has been executed. Returns False on timeout.'''
+        marker = self.submit(lambda conn: None)
+        try:
+            marker.result(timeout)
+            return True
+        except Exception:
+            return False
+
+    def stop(self, timeout=10):
+        '''Execute the queued jobs, then stop the thread (call on shutdown)'''
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+    def _next_batch(self):
+        '''Wait for one job, then take the jobs already waiting (up to batch_size)'''
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size and batch[-1] is not _STOP:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        try:
+            while True:
+                batch = self._next_batch()
+                stop = batch[-1] is _STOP
+                if stop:
+                    batch.pop()
+                if batch:
+                    self._execute(batch)
+                    if self.after_batch:
+                        self.after_batch()
+                if stop:
+                    return
+        finally:
+            # the connection belongs to this thread: close it with the thread
+            self.pool.close_thread_connection()
+
+    def _execute(self, batch):
+        jobs = [(job, future, on_rollback) for job, future, on_rollback in batch
+                if future.set_running_or_notify_cancel()]
+        if not jobs:
+            return
+        try:
+            conn = self.pool.connection()
+            with conn:                  # one transaction for the whole batch
+                results = [job(conn) for job, _, _ in jobs]
+        except Exception as e:
+            # the batch was rolled back: nothing a job did is committed (e.g. the id of an INSERT)
+            for _, _, on_rollback in jobs:
+                self._rolled_back(on_rollback)
+            if len(jobs) == 1:
+                jobs[0][1].set_exception(e)
+            else:
+                # run it again, one job per transaction, to isolate the failing job
+                for job, future, on_rollback in jobs:
+                    self._execute_one(job, future, on_rollback)
+            return
+        for (_, future, _), result in zip(jobs, results):
+            future.set_result(result)
+
+    def _execute_one(self, job, future, on_rollback):
+        try:
+            conn = self.pool.connection()
+            with conn:
+                result = job(conn)
+        except Exception as e:
+            self._rolled_back(on_rollback)
+            future.set_exception(e)
+            return
+        future.set_result(result)
+
+    @staticmethod
+    def _rolled_back(on_rollback):
+        if on_rollback is None:
+            return
+        try:
+            on_rollback()
+        except Exception as e:
+            print("Error in the rollback handler of a background job:", e)
@@ -0,0 +1,296 @@
+'''
+Micro-benchmarks of backend.main, backend.export and backend.hash, with JSON results
+
+Every benchmark runs in a fresh process (peak RSS of that benchmark only), against a database
+generated by benchmarks/generate_db.py for each size (users x events). The user cache is empty
+at the start of each benchmark; the users and ids are picked at random (seeded), so most lookups
+miss the cache, as on a kiosk shared by many users. The write benchmarks add a few hundred rows
+to the database of their size: they run after the read benchmarks.
+
+For each (size, benchmark): iterations, ops/sec, mean/p50/p95/p99/max in ms, peak RSS in KB
+(None where the resource module does not exist, e.g. on Windows).
+
+Compare two versions:  git checkout v1; python -m benchmarks.bench_backend -o v1.json
+                       git checkout v2; python -m benchmarks.bench_backend -o v2.json --compare v1.json
+
+Usage:  python -m benchmarks.bench_backend [--sizes 1000x20000,10000x200000] [--iterations 500]
+                                           [--only authenticate_user,...] [-o results.json] [--compare old.json]
+'''
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+from statistics import mean, quantiles
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+from benchmarks.generate_db import generate
+
+PASSWORD = 'bench'
+DEVICE = 'Bench device'
+DEFAULT_SIZES = '1000x20000,10000x200000'
+DEFAULT_ITERATIONS = 500
+REGRESSION_THRESHOLD = 0.2      # --compare: flag the benchmarks more than 20% slower (p50)
+
+
+# ---- the benchmarks: setup(context) -> op(i), timed once per iteration ----------------------------
+
+def bench_get_salt_hash(context):
+    from backend.hash import get_salt_hash
+    return lambda i: get_salt_hash(context.random_email(), PASSWORD)
+
+
+def bench_authenticate(context):
+    from backend.hash import get_salt_hash, authenticate
+    email = context.random_email()
+    salt, hash = get_salt_hash(email, PASSWORD)
+    return lambda i: authenticate(email, PASSWORD, salt, hash)
+
+
+def bench_from_database(context):
+    from backend.main import User
+    return lambda i: User.from_database(context.random_id())
+
+
+def bench_from_database_by_email(context):
+    from backend.main import User
+    return lambda i: User.from_database_by_email(context.random_email())
+
+
+def bench_authenticate_user(context):
+    '''The lookup and the password check, as seen by the GUI: the UPDATE of last_login is queued for the
+       background writer and is not timed (run_benchmark waits for it after the last iteration)'''
+    from backend.main import User
+    return lambda i: User.authenticate_user(context.random_email(), PASSWORD)
+
+
+def bench_get_id_of_most_recent_user(context):
+    from backend.main import get_id_of_most_recent_user
+    return lambda i: get_id_of_most_recent_user(context.random_email())
+
+
+def bench_export_users(context):
+    from backend.export import export_table_to_csv
+    return lambda i: export_table_to_csv('users', os.path.join(context.folder, f'users_{i}.csv'))
+
+
+def bench_export_events(context):
+    from backend.export import export_table_to_csv
+    return lambda i: export_table_to_csv('events', os.path.join(context.folder, f'events_{i}.csv'))
+
+
+def bench_update_user_property(context):
+    from backend.main import User
+    user = User()
+    return lambda i: user.update_user_property(context.random_id(), 'phone', f"215-555-{i % 10000:04d}")
+
+
+def bench_add_user(context):
+    from backend.main import User
+    from backend.hash import get_salt_hash
+    run_id = f"{time.time_ns():x}"
+    def op(i):
+        user = User()
+        user.email = f"bench.new{i}.{run_id}@chop.edu"
+        user.name = f"Bench New {i}"
+        user.type = 'user'
+        user.salt, user.hash = get_salt_hash(user.email, PASSWORD)
+        user.add_user()
+    return op
+
+
+def bench_record_login(context):
+    from backend.main import Event
+    # a different email per login: every login inserts a row (no upsert of the same second)
+    run_id = f"{time.time_ns():x}"
+    return lambda i: Event.login_from_args(f"bench.login{i}.{run_id}@chop.edu", DEVICE, 'local').record_login()
+
+
+def bench_record_logout(context):
+    from backend.main import Event
+    run_id = f"{time.time_ns():x}"
+    events = []
+    for i in range(context.iterations):      # the logins are not timed
+        event = Event.login_from_args(f"bench.logout{i}.{run_id}@chop.edu", DEVICE, 'local')
+        event.record_login()
+        events.append(event)
+    def op(i):
+        events[i].logout_type = 'by_user'
+        events[i].record_logout()
+    return op
+
+
+# name -> (setup, iteration divisor); read-only benchmarks first
+BENCHMARKS = {
+    'get_salt_hash':                (bench_get_salt_hash, 1),
+    'authenticate':                 (bench_authenticate, 1),
+    'User.from_database':           (bench_from_database, 1),
+    'User.from_database_by_email':  (bench_from_database_by_email, 1),
+    'User.authenticate_user':       (bench_authenticate_user, 1),
+    'get_id_of_most_recent_user':   (bench_get_id_of_most_recent_user, 1),
+    'export_table_to_csv(users)':   (bench_export_users, 50),
+    'export_table_to_csv(events)':  (bench_export_events, 100),
+    'User.update_user_property':    (bench_update_user_property, 1),
+    'User.add_user':                (bench_add_user, 1),
+    'Event.record_login':           (bench_record_login, 1),
+    'Event.record_logout':          (bench_record_logout, 1),
+}
+
+
+class Context:
+    '''What the setup functions can use: the database, random users, a scratch folder'''
+    def __init__(self, path_to_cores_db, folder, iterations, seed):
+        self.path_to_cores_db = path_to_cores_db
+        self.folder = folder
+        self.iterations = iterations
+        self.rng = random.Random(seed)
+        conn = sqlite3.connect(path_to_cores_db)
+        self.users = conn.execute("SELECT id, email FROM users WHERE type = 'user' ORDER BY id").fetchall()
+        conn.close()
+
+    def random_id(self):
+        return self.rng.choice(self.users)[0]
+
+    def random_email(self):
+        return self.rng.choice(self.users)[1]
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak      # bytes on macOS, KB on Linux
+
+
+def run_benchmark(path_to_cores_db, name, iterations, seed):
+    '''Run one benchmark (in the calling process); returns its result dict'''
+    from backend.main import cores_db_pool, event_writer, user_cache
+    setup, divisor = BENCHMARKS[name]
+    iterations = max(3, iterations // divisor)
+    durations = []
+    with tempfile.TemporaryDirectory() as folder, redirect_stdout(io.StringIO()):
+        cores_db_pool.configure(path_to_cores_db)
+        user_cache.clear()
+        op = setup(Context(path_to_cores_db, folder, iterations, seed))
+        for i in range(iterations):
+            t0 = time.perf_counter()
+            op(i)
+            durations.append((time.perf_counter() - t0) * 1000)
+        event_writer.stop()         # the queued writes, before their connection is closed
+        cores_db_pool.close_all()
+    percentiles = quantiles(durations, n=100, method='inclusive')
+    return {'benchmark': name,
+            'iterations': iterations,
+            'ops_per_sec': round(iterations / (sum(durations) / 1000), 1),
+            'mean_ms': round(mean(durations), 4),
+            'p50_ms': round(percentiles[49], 4),
+            'p95_ms': round(percentiles[94], 4),
+            'p99_ms': round(percentiles[98], 4),
+            'max_ms': round(max(durations), 4),
+            'peak_rss_kb': peak_rss_kb()}
+
+
+def parse_sizes(text):
+    '''"1000x20000,10000x200000" -> [(1000, 20000), (10000, 200000)]'''
+    sizes = []
+    for size in text.split(','):
+        users, events = size.lower().split('x')
+        sizes.append((int(users), int(events)))
+    return sizes
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main(sizes, iterations=DEFAULT_ITERATIONS, names=None, seed=1):
+    '''Returns the report (dict, JSON-serializable)'''
+    names = names or list(BENCHMARKS)
+    report = {'version': git_version(),
+              'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+              'python': platform.python_version(),
+              'sqlite': sqlite3.sqlite_version,
+              'platform': platform.platform(),
+              'iterations': iterations,
+              'results': []}
+    # one fresh process per benchmark ('spawn': nothing inherited from this process, same on every OS)
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as folder:
+        for user_count, event_count in sizes:
+            path_to_cores_db = os.path.join(folder, f'cores_{user_count}x{event_count}.db')
+            start = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                generate(path_to_cores_db, user_count, event_count, seed=seed, password=PASSWORD)
+            print(f"{user_count} users x {event_count} events: generated in {time.perf_counter() - start:.1f} s",
+                  file=sys.stderr)
+            for name in names:
+                with context.Pool(1, maxtasksperchild=1) as pool:
+                    result = pool.apply(run_benchmark, (path_to_cores_db, name, iterations, seed))
+                result = {'users': user_count, 'events': event_count, **result}
+                report['results'].append(result)
+                print(f"    {name:30} {result['ops_per_sec']:>10.1f} ops/s   p50 {result['p50_ms']:8.3f} ms   "
+                      f"p99 {result['p99_ms']:8.3f} ms   peak RSS {result['peak_rss_kb']} KB", file=sys.stderr)
+    return report
+
+
+def compare(report, baseline, threshold=REGRESSION_THRESHOLD):
+    '''Print the change of p50 for each (size, benchmark) of both reports; returns the number of regressions'''
+    def key(result):
+        return (result['users'], result['events'], result['benchmark'])
+    old = {key(result): result for result in baseline['results']}
+    regressions = 0
+    print(f"Compared with {baseline.get('version')} ({baseline.get('date')}):", file=sys.stderr)
+    for result in report['results']:
+        before = old.get(key(result))
+        if before is None or not before['p50_ms']:
+            continue
+        change = result['p50_ms'] / before['p50_ms'] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"    {result['users']}x{result['events']} {result['benchmark']:30} p50 {before['p50_ms']:8.3f} -> "
+              f"{result['p50_ms']:8.3f} ms ({change:+.0%}){flag}", file=sys.stderr)
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Backend micro-benchmarks (JSON results).")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help=f"USERSxEVENTS,... (default: {DEFAULT_SIZES})")
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument('--only', help="comma-separated benchmark names (default: all): " + ", ".join(BENCHMARKS))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', help="JSON file to write (default: standard output)")
+    parser.add_argument('--compare', help="JSON file of a previous run: print the changes, exit code 1 on a regression")
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else None
+    unknown = [name for name in names or [] if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+    report = main(parse_sizes(args.sizes), args.iterations, names, args.seed)
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump(report, json_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as json_file:
+            sys.exit(1 if compare(report, json.load(json_file)) else 0)
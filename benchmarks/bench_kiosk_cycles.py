@@ -0,0 +1,168 @@
+'''
+Memory and latency of the kiosk GUI over many login/logout cycles
+
+Each cycle is a session of the real windows: a local login (backend.main.login), BigGui.show_mini_gui,
+then MiniGui.logout_by_user, which brings the login screen back. Measured per cycle:
+    shown_ms    logout_by_user() until the login window is shown again (reset, or built)
+    loaded_ms   logout_by_user() until the calendar page of the browser is loaded again
+    rss_kb      resident memory of the process after the cycle
+The login screen is one BigGui kept for the whole run (MiniGui.logout_and_start_big_gui resets it);
+--rebuild builds a new BigGui on every logout instead, as the kiosk did before, for comparison.
+Both the latency and the RSS should stay flat: the summary gives the first and last --window cycles and
+the RSS growth per 100 cycles (least squares).
+
+The windows are offscreen (QT_QPA_PLATFORM=offscreen) unless --show. The calendar is about:blank unless
+--url is given (a real page measures the network too).
+
+Usage:  python -m benchmarks.bench_kiosk_cycles [--cycles 300] [--window 50] [--rebuild] [--url URL] [--show] [--json]
+'''
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from statistics import linear_regression, median
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+from benchmarks.generate_db import generate
+
+PASSWORD = 'cycles'
+LOAD_TIMEOUT = 10000    # ms, for the calendar page after a logout
+
+
+def rss_kb():
+    '''Current resident memory (Linux), else the peak (resource), else None'''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak      # bytes on macOS, KB on Linux
+
+
+def wait_for_load(browser, timeout_ms=LOAD_TIMEOUT):
+    '''Process the events until the next loadFinished of the browser; returns False on timeout'''
+    from PySide6.QtCore import QEventLoop, QTimer
+    loop = QEventLoop()
+    loaded = []
+    def on_load_finished(ok):
+        loaded.append(ok)
+        loop.quit()
+    browser.view.loadFinished.connect(on_load_finished)
+    QTimer.singleShot(timeout_ms, loop.quit)
+    loop.exec()
+    browser.view.loadFinished.disconnect(on_load_finished)
+    return bool(loaded)
+
+
+def run_cycles(app, config_dict, emails, cycles, rebuild=False):
+    '''Returns one dict per cycle: {'cycle', 'shown_ms', 'loaded_ms', 'rss_kb'}'''
+    from backend.main import login
+    from frontend.main_gui import BigGui
+    big_gui = BigGui(config_dict)
+    big_gui.show()
+    wait_for_load(big_gui.browser)
+    results = []
+    for cycle in range(cycles):
+        with redirect_stdout(io.StringIO()):
+            user, event = login(emails[cycle % len(emails)], PASSWORD, config_dict['device_name'])
+            if user is None:
+                raise RuntimeError(f"login of {emails[cycle % len(emails)]} failed")
+            big_gui.show_mini_gui(user, event, config_dict)
+            app.processEvents()
+            mini_gui = big_gui.mini_gui
+            if rebuild:
+                mini_gui.big_gui = None     # the MiniGui builds a new BigGui, as before
+            t0 = time.perf_counter()
+            mini_gui.logout_by_user()
+            big_gui = mini_gui.big_gui
+            # no event processed yet: the loadFinished of the calendar page cannot have been missed
+            shown = time.perf_counter() - t0 if big_gui.isVisible() else None
+            loaded = time.perf_counter() - t0 if wait_for_load(big_gui.browser) else None
+            del mini_gui
+        results.append({'cycle': cycle,
+                        'shown_ms': round(shown * 1000, 3) if shown is not None else None,
+                        'loaded_ms': round(loaded * 1000, 3) if loaded is not None else None,
+                        'rss_kb': rss_kb()})
+    return results
+
+
+def summary(results, window):
+    '''Median latencies and RSS of the first and last `window` cycles, RSS growth per 100 cycles'''
+    def medians(rows):
+        def med(key):
+            values = [row[key] for row in rows if row[key] is not None]
+            return round(median(values), 3) if values else None
+        return {'shown_ms': med('shown_ms'), 'loaded_ms': med('loaded_ms'), 'rss_kb': med('rss_kb')}
+    window = max(1, min(window, len(results) // 2 or 1))
+    rss = [(row['cycle'], row['rss_kb']) for row in results if row['rss_kb'] is not None]
+    growth = None
+    if len(rss) > 1:
+        slope, _ = linear_regression([cycle for cycle, _ in rss], [kb for _, kb in rss])
+        growth = round(slope * 100, 1)
+    return {'first': medians(results[:window]), 'last': medians(results[-window:]),
+            'rss_growth_kb_per_100_cycles': growth}
+
+
+def main(args):
+    if not args.show:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PySide6.QtWidgets import QApplication
+    import backend.main as backend
+    with open(args.config, 'r') as config_file:
+        config_dict = json.load(config_file)
+    config_dict['calendar_url'] = args.url or 'about:blank'
+    with tempfile.TemporaryDirectory() as folder:
+        path_to_cores_db = os.path.join(folder, 'cores.db')
+        with redirect_stdout(io.StringIO()):
+            generate(path_to_cores_db, args.users, args.users * 10, seed=args.seed, password=PASSWORD)
+            backend.cores_db_pool.configure(path_to_cores_db)
+        emails = [user.email for user in backend.list_users('user')]
+        app = QApplication.instance() or QApplication(sys.argv[:1])
+        app.setQuitOnLastWindowClosed(False)
+        start = time.perf_counter()
+        results = run_cycles(app, config_dict, emails, args.cycles, args.rebuild)
+        elapsed = time.perf_counter() - start
+        with redirect_stdout(io.StringIO()):
+            backend.close_cores_db()
+    return {'cycles': args.cycles, 'rebuild': args.rebuild, 'calendar_url': config_dict['calendar_url'],
+            'elapsed_s': round(elapsed, 2), 'summary': summary(results, args.window), 'results': results}
+
+
+def print_report(report):
+    s = report['summary']
+    print(f"{report['cycles']} login/logout cycles ({'new BigGui per logout' if report['rebuild'] else 'one BigGui'}, "
+          f"calendar {report['calendar_url']}): {report['elapsed_s']} s")
+    for part in ('first', 'last'):
+        print(f"    {part:5}  shown p50 {s[part]['shown_ms']} ms   loaded p50 {s[part]['loaded_ms']} ms   "
+              f"RSS {s[part]['rss_kb']} KB")
+    print(f"    RSS growth: {s['rss_growth_kb_per_100_cycles']} KB per 100 cycles")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Latency and memory of the kiosk windows over login/logout cycles.")
+    parser.add_argument('--cycles', type=int, default=300)
+    parser.add_argument('--window', type=int, default=50, help="cycles compared at the start and the end")
+    parser.add_argument('--rebuild', action='store_true', help="new BigGui on every logout (previous behaviour)")
+    parser.add_argument('--url', help="calendar page (default: about:blank)")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--show', action='store_true', help="show the windows (default: offscreen)")
+    parser.add_argument('--json', action='store_true', help="print the report (with every cycle) as JSON")
+    args = parser.parse_args()
+    report = main(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
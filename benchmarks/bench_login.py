@@ -0,0 +1,107 @@
+'''
+End-to-end latency of a local login on a large database (default: 50k users, 2M events).
+
+"before": the path EmailPassButtonPanel.gui_authenticate_user used to take:
+    User.authenticate_user -> User.from_database_by_email -> Event.record_login
+"after":  backend.main.login(): one SELECT and the password check in the calling thread (outside any write
+          transaction), then one job of the background writer: UPDATE last_login + INSERT the event
+Both modes are timed until every write of the login is committed: "before" also queues the UPDATE of
+last_login on the background writer, so it waits for the writer too (the GUI itself does not wait).
+Every login is done as a different user (picked at random), so the user cache does not hide the queries.
+
+The database is generated once (benchmarks/generate_db.py); pass --db to keep it between runs.
+
+Usage:  python -m benchmarks.bench_login [--iterations 2000] [--users 50000] [--events 2000000] [--db path]
+'''
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from statistics import mean, quantiles
+
+from backend.main import User, Event, login, cores_db_pool, user_cache, event_writer
+from benchmarks.generate_db import generate
+
+PASSWORD = 'bench'
+DEVICE = 'Bench device'
+
+
+def generate_database(path_to_cores_db, user_count, event_count):
+    '''Create a database with user_count users (all with the password PASSWORD) and event_count events'''
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        generate(path_to_cores_db, user_count, event_count, password=PASSWORD)
+    print(f"Generated {user_count} users and {event_count} events in {time.perf_counter() - start:.1f} s")
+
+
+def user_emails():
+    with cores_db_pool.transaction() as conn:
+        return [email for (email,) in conn.execute("SELECT email FROM users WHERE type = 'user' ORDER BY id")]
+
+
+def login_before(email):
+    if User.authenticate_user(email, PASSWORD):
+        user = User.from_database_by_email(email)
+        event = Event.login_from_args(user.email, DEVICE, 'local')
+        event.record_login()
+    event_writer.flush()
+
+
+def login_after(email):
+    user, event = login(email, PASSWORD, DEVICE, 'local')
+    event.login_future.result()
+
+
+def run(login_function, iterations, emails):
+    '''Returns the list of durations in milliseconds'''
+    durations = []
+    rng = random.Random(1)
+    # the backend print()s a lot; keep it out of the console (it costs the same in both modes)
+    with redirect_stdout(io.StringIO()):
+        for _ in range(iterations):
+            email = rng.choice(emails)
+            t0 = time.perf_counter()
+            login_function(email)
+            durations.append((time.perf_counter() - t0) * 1000)
+    return durations
+
+
+def summary(durations):
+    percentiles = quantiles(durations, n=100)
+    return (f"p50 {percentiles[49]:7.3f} ms   p99 {percentiles[98]:7.3f} ms   "
+            f"mean {mean(durations):7.3f} ms   max {max(durations):7.3f} ms")
+
+
+def main(iterations=2000, user_count=50000, event_count=2000000, path_to_cores_db=None):
+    with tempfile.TemporaryDirectory() as folder:
+        if path_to_cores_db is None:
+            path_to_cores_db = os.path.join(folder, 'cores.db')
+        if not os.path.exists(path_to_cores_db):
+            generate_database(path_to_cores_db, user_count, event_count)
+        cores_db_pool.configure(path_to_cores_db)
+        emails = user_emails()
+        results = {}
+        for label, login_function in [('before (3 lookups, 3 transactions)', login_before),
+                                      ('after  (login(), 1 background transaction)', login_after)]:
+            user_cache.clear()
+            run(login_function, 50, emails)      # warm up
+            results[label] = run(login_function, iterations, emails)
+        cores_db_pool.close_all()
+
+    print(f"{iterations} logins, {user_count} users, {event_count} events")
+    for label, durations in results.items():
+        print(f"{label}:  {summary(durations)}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Login latency benchmark (p50/p99).")
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--events', type=int, default=2000000)
+    parser.add_argument('--db', help="database to use, generated if it does not exist (default: a temporary one)")
+    args = parser.parse_args()
+    main(args.iterations, args.users, args.events, args.db)
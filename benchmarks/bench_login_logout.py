@@ -0,0 +1,110 @@
+'''
+Before/after benchmark of the login and logout paths of the backend.
+
+"before": every backend call checks the file and opens a new connection (old conn_cores_db behaviour,
+          reproduced here by UnpooledConnections in place of backend.main.cores_db_pool)
+"after":  every backend call uses the long-lived, configured connection of the pool
+
+The login path is the one of EmailPassButtonPanel.gui_authenticate_user:
+    User.authenticate_user -> User.from_database_by_email -> Event.record_login
+The logout path is the one of MiniGui.logout:
+    Event.record_logout
+
+Usage:  python -m benchmarks.bench_login_logout [iterations]
+'''
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+from statistics import mean, median
+
+import backend.main
+from backend.main import User, Event, ConnectionPool, cores_db_pool, create_cores_db
+from backend.hash import get_salt_hash
+
+EMAIL = 'bench.user@chop.edu'
+PASSWORD = 'bench'
+DEVICE = 'Bench device'
+
+
+class UnpooledConnections(ConnectionPool):
+    '''The old behaviour: check the file and open a brand-new, unconfigured connection for every call'''
+    @contextmanager
+    def transaction(self):
+        if not os.path.exists(self.path_to_cores_db):
+            raise sqlite3.OperationalError(f"'{self.path_to_cores_db}' is not available.")
+        conn = sqlite3.connect(self.path_to_cores_db)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+def setup_database(path_to_cores_db):
+    '''Create a new database with one user that can log in'''
+    with redirect_stdout(io.StringIO()):
+        create_cores_db(path_to_cores_db, ask=False)
+        cores_db_pool.configure(path_to_cores_db)
+        user = User()
+        user.email = EMAIL
+        user.name = 'Bench User'
+        user.type = 'user'
+        user.salt, user.hash = get_salt_hash(EMAIL, PASSWORD)
+        user.add_user()
+
+
+def run(iterations):
+    '''Returns two lists of durations in milliseconds: (login, logout)'''
+    login_ms, logout_ms = [], []
+    # the backend print()s a lot; keep it out of the console (it costs the same in both modes)
+    with redirect_stdout(io.StringIO()):
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            if User.authenticate_user(EMAIL, PASSWORD):
+                user = User.from_database_by_email(EMAIL)
+                event = Event.login_from_args(user.email, DEVICE, 'local')
+                event.record_login()
+            t1 = time.perf_counter()
+            event.logout_type = 'by_user'
+            event.record_logout()
+            t2 = time.perf_counter()
+            login_ms.append((t1 - t0) * 1000)
+            logout_ms.append((t2 - t1) * 1000)
+    return login_ms, logout_ms
+
+
+def summary(durations):
+    return f"mean {mean(durations):7.3f} ms   median {median(durations):7.3f} ms   max {max(durations):7.3f} ms"
+
+
+def main(iterations=200):
+    with tempfile.TemporaryDirectory() as folder:
+        path_to_cores_db = os.path.join(folder, 'cores.db')
+        setup_database(path_to_cores_db)
+        results = {}
+        cores_db_pool.configure(path_to_cores_db)
+        # cores_db() looks the pool up in backend.main on every call: swap it for the "before" run
+        for label, pool in [('before (new connection per call)', UnpooledConnections(path_to_cores_db)),
+                            ('after (pooled connection)', cores_db_pool)]:
+            backend.main.cores_db_pool = pool
+            try:
+                run(10)   # warm up
+                results[label] = run(iterations)
+            finally:
+                backend.main.cores_db_pool = cores_db_pool
+        backend.main.event_writer.flush()
+        cores_db_pool.close_all()
+
+    print(f"{iterations} login/logout cycles")
+    for label, (login_ms, logout_ms) in results.items():
+        print(f"{label}")
+        print(f"    login :  {summary(login_ms)}")
+        print(f"    logout:  {summary(logout_ms)}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,283 @@
+'''
+Deterministic generator of synthetic cores.db files (tests and benchmarks at scale)
+
+The same arguments (and seed) always produce the same rows. What is generated:
+- users with names, titles, phones and PIs; a few (--duplicates) have a second spelling of their
+  email (different case), used in some of their events; with --legacy the second spelling is also
+  a duplicate row of 'users', as in the databases older than migration 2
+- events on several devices (each device: one session at a time, in chronological order), with
+  - a time-of-day distribution (busy working hours, quiet nights, fewer sessions on weekends)
+  - log-normal session durations (median 75 min, from 1 min to 12 h)
+  - login types local/iLab/EMERGENCY, logout types by_user/by_inactivity
+  - a few orphaned PENDING sessions (--orphans: the kiosk crashed, half with a last heartbeat),
+    and the last session of every device still open
+  - heavy-tailed activity: a few users have most of the sessions
+- first_login/last_login of the users match their events; every user has the password --password,
+  the admin user has the password 'admin' (as created by create_cores_db)
+
+The rows are streamed to executemany() in one transaction; the indexes of 'events' are dropped
+during the load and rebuilt at the end (one sort instead of millions of B-tree inserts).
+Scale: about 2M events per minute (10M events: ~6 minutes, ~2.5 GB).
+
+Usage:  python -m benchmarks.generate_db cores_test.db [--users 5000] [--events 200000] [--seed 1] [--legacy]
+'''
+import heapq
+import math
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from hashlib import blake2b
+
+from backend.hash import get_salt_hash
+
+DEFAULT_USERS = 5000
+DEFAULT_EVENTS = 200000
+DEFAULT_YEARS = 5                   # devices are added so that the events span about this many years
+SESSIONS_PER_DEVICE_YEAR = 1850     # (measured with the default distributions)
+MIN_DEVICES = 8
+START_DATE = '2021-01-04'           # a Monday
+PASSWORD = 'cores'
+CHUNK_SIZE = 50000                  # events per progress report
+
+INSTRUMENTS = ('Aurora alpha', 'Aurora beta', 'LSR Fortessa', 'FACSymphony A5', 'FACSAria Fusion',
+               'MoFlo Astrios', 'CytoFLEX S', 'Attune NxT', 'ImageStream X', 'Northern Lights',
+               'Bigfoot', 'Cellometer')
+FIRST_NAMES = ('Alice', 'Bruno', 'Chen', 'Dana', 'Elena', 'Farid', 'Grace', 'Hiro', 'Ines', 'Jamal',
+               'Kara', 'Luis', 'Maya', 'Noah', 'Olga', 'Priya', 'Quinn', 'Ravi', 'Sara', 'Tomas')
+LAST_NAMES = ('Anderson', 'Baker', 'Cohen', 'Diaz', 'Evans', 'Fischer', 'Garcia', 'Huang', 'Ito',
+              'Jensen', 'Kim', 'Lopez', 'Miller', 'Nguyen', 'Okafor', 'Patel', 'Rossi', 'Smith')
+DOMAINS = ('chop.edu', 'upenn.edu', 'pennmedicine.upenn.edu')
+TITLES = ('PhD student', 'Postdoc', 'Tech', 'Staff scientist', 'PI')
+
+# relative number of logins starting in each hour of the day (0h..23h); weekends: WEEKEND_FACTOR
+HOUR_WEIGHTS = (0.02, 0.01, 0.01, 0.01, 0.01, 0.02, 0.05, 0.25, 0.7, 1.0, 1.0, 0.9,
+                0.6, 0.8, 1.0, 0.95, 0.8, 0.55, 0.35, 0.25, 0.15, 0.1, 0.05, 0.03)
+WEEKEND_FACTOR = 0.2
+MEAN_GAP = 30 * 60                  # seconds between two sessions of a device (busy hours)
+DURATION_MEDIAN = 75 * 60           # seconds; log-normal
+DURATION_SIGMA = 0.8
+DURATION_RANGE = (60, 12 * 3600)
+LOGIN_TYPES = (('local', 0.70), ('iLab', 0.28), ('EMERGENCY', 0.02))
+INACTIVITY_RATE = 0.15              # sessions closed by the inactivity timer
+VARIANT_RATE = 0.3                  # events of a duplicate user recorded with the other spelling
+
+
+def device_names(count):
+    return [INSTRUMENTS[i % len(INSTRUMENTS)] + (f" {i // len(INSTRUMENTS) + 1}" if i >= len(INSTRUMENTS) else '')
+            for i in range(count)]
+
+
+def default_device_count(event_count, years=DEFAULT_YEARS):
+    return max(MIN_DEVICES, math.ceil(event_count / (years * SESSIONS_PER_DEVICE_YEAR)))
+
+
+class TimeFormat:
+    '''Seconds since START_DATE -> '%Y-%m-%d %H:%M:%S' (the date strings are cached: much faster than strftime)'''
+    def __init__(self, start_date):
+        self.start = datetime.strptime(start_date, '%Y-%m-%d')
+        self.days = []
+
+    def day(self, day_number):
+        while len(self.days) <= day_number:
+            self.days.append((self.start + timedelta(days=len(self.days))).strftime('%Y-%m-%d'))
+        return self.days[day_number]
+
+    def __call__(self, seconds):
+        day_number, seconds = divmod(seconds, 86400)
+        hour, seconds = divmod(seconds, 3600)
+        minute, second = divmod(seconds, 60)
+        return f"{self.day(day_number)} {hour:02d}:{minute:02d}:{second:02d}"
+
+
+def make_users(rng, user_count, duplicate_rate):
+    '''Returns the list of users: (email, variant email or None, name, title, phone, pi_name, pi_phone)'''
+    users = []
+    for i in range(user_count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        email = f"{first.lower()}.{last.lower()}{i}@{rng.choice(DOMAINS)}"
+        variant = email.replace(first.lower(), first, 1) if rng.random() < duplicate_rate else None
+        pi_last = rng.choice(LAST_NAMES)
+        users.append((email, variant, f"{first} {last}", rng.choice(TITLES),
+                      f"215-{rng.randrange(200, 1000)}-{rng.randrange(10000):04d}",
+                      f"Dr. {pi_last}", f"215-{rng.randrange(200, 1000)}-{rng.randrange(10000):04d}"))
+    return users
+
+
+def device_sessions(seed, device, session_count, users, cum_weights, orphan_rate, start_weekday):
+    '''Yield the sessions of one device in chronological order:
+       (login_seconds, user_index, email, login_type, logout_seconds or None, logout_type, last_seen_seconds)'''
+    rng = random.Random(f"{seed}:{device}")
+    mu = math.log(DURATION_MEDIAN)
+    login_types = [t for t, _ in LOGIN_TYPES]
+    login_weights = [w for _, w in LOGIN_TYPES]
+    t = rng.randrange(7 * 3600, 10 * 3600)
+    picks = []
+    for n in range(session_count):
+        # next login: exponential gap, kept with the probability of its hour of the day (rejection sampling)
+        while True:
+            t += int(rng.expovariate(1 / MEAN_GAP)) + 1
+            day, seconds = divmod(t, 86400)
+            weight = HOUR_WEIGHTS[seconds // 3600]
+            if (start_weekday + day) % 7 >= 5:
+                weight *= WEEKEND_FACTOR
+            if rng.random() < weight:
+                break
+        if not picks:
+            picks = rng.choices(range(len(users)), cum_weights=cum_weights, k=1024)
+        user_index = picks.pop()
+        email, variant = users[user_index][:2]
+        if variant and rng.random() < VARIANT_RATE:
+            email = variant
+        login_type = rng.choices(login_types, login_weights)[0]
+        duration = min(max(int(rng.lognormvariate(mu, DURATION_SIGMA)), DURATION_RANGE[0]), DURATION_RANGE[1])
+        if n == session_count - 1:
+            # the last session of the device: still open
+            yield (t, user_index, email, login_type, None, 'PENDING', None)
+        elif rng.random() < orphan_rate:
+            # orphaned: the kiosk crashed; half of them had a heartbeat before the crash
+            last_seen = t + rng.randrange(duration) if rng.random() < 0.5 else None
+            yield (t, user_index, email, login_type, None, 'PENDING', last_seen)
+        else:
+            logout_type = 'by_inactivity' if rng.random() < INACTIVITY_RATE else 'by_user'
+            yield (t, user_index, email, login_type, t + duration, logout_type, None)
+        t += duration
+
+
+def tagged(sessions, device):
+    for session in sessions:
+        yield session, device
+
+
+def create_schema(conn, legacy):
+    '''Tables of cores.db: latest schema, or (legacy) as created by create_tables() before any migration'''
+    from backend.main import create_tables
+    if not create_tables(conn):
+        raise sqlite3.Error("the tables could not be created")
+    if not legacy:
+        from backend.migrations import migrate
+        migrate(conn)
+
+
+def generate(path_to_cores_db, user_count=DEFAULT_USERS, event_count=DEFAULT_EVENTS, seed=1,
+             device_count=None, duplicate_rate=0.02, orphan_rate=0.005, legacy=False,
+             password=PASSWORD, start_date=START_DATE, progress=None):
+    '''Create path_to_cores_db (must not exist) with user_count users (+ admin) and exactly event_count events.
+       device_count: default: enough devices for the events to span about DEFAULT_YEARS years
+       legacy:       schema version 0 (no migrations): duplicate users are separate rows
+       progress:     optional callback progress(events_done, event_count)
+       Returns {'users': n, 'events': n, 'devices': n, 'first_login': ..., 'last_login': ...}'''
+    if os.path.exists(path_to_cores_db):
+        raise FileExistsError(f"'{path_to_cores_db}' exists already")
+    if device_count is None:
+        device_count = default_device_count(event_count)
+    rng = random.Random(seed)
+    users = make_users(rng, user_count, duplicate_rate)
+    # heavy-tailed activity (Zipf-like): the user of rank r has a weight 1 / (r + 10)
+    ranks = list(range(user_count))
+    rng.shuffle(ranks)
+    cum_weights = []
+    total = 0.0
+    for rank in ranks:
+        total += 1 / (rank + 10)
+        cum_weights.append(total)
+
+    fmt = TimeFormat(start_date)
+    start_weekday = fmt.start.weekday()
+    devices = device_names(device_count)
+    per_device = [event_count // device_count + (1 if i < event_count % device_count else 0)
+                  for i in range(device_count)]
+    first_login = [None] * user_count
+    last_login = [None] * user_count
+
+    def event_rows():
+        # all devices merged in chronological order: the ids increase with login_time, as in a real database
+        sessions = heapq.merge(*[tagged(device_sessions(seed, device, count, users, cum_weights, orphan_rate,
+                                                        start_weekday), device)
+                                 for device, count in zip(devices, per_device)])
+        for done, ((login, user_index, email, login_type, logout, logout_type, last_seen), device) \
+                in enumerate(sessions, 1):
+            if first_login[user_index] is None:
+                first_login[user_index] = login
+            last_login[user_index] = login
+            if progress and done % CHUNK_SIZE == 0:
+                progress(done, event_count)
+            yield (email, device, fmt(login), login_type, fmt(logout) if logout is not None else 'N/A',
+                   logout_type, fmt(last_seen) if last_seen is not None else None)
+
+    conn = sqlite3.connect(path_to_cores_db)
+    try:
+        conn.execute("PRAGMA journal_mode = MEMORY")
+        conn.execute("PRAGMA synchronous = OFF")
+        conn.execute("PRAGMA cache_size = -262144")     # 256 MB
+        create_schema(conn, legacy)
+        conn.execute("BEGIN")
+        admin_salt, admin_hash = get_salt_hash('admin', 'admin', rng.randbytes(blake2b.SALT_SIZE))
+        conn.execute("INSERT INTO users (email, name, type, salt, hash) VALUES ('admin', 'Admin User', 'admin', ?, ?)",
+                     (admin_salt, admin_hash))
+
+        # events first (first_login/last_login of the users come from them), without the indexes
+        indexes = conn.execute("""--sql
+            SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'events' AND sql IS NOT NULL
+        """).fetchall()
+        for name, _ in indexes:
+            conn.execute(f"DROP INDEX {name}")
+        conn.executemany("""--sql
+            INSERT INTO events (email, device, login_time, login_type, logout_time, logout_type, last_seen)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, event_rows())
+        for _, sql in indexes:
+            conn.execute(sql)
+
+        def user_rows():
+            for i, (email, variant, name, title, phone, pi_name, pi_phone) in enumerate(users):
+                first = fmt(first_login[i]) if first_login[i] is not None else None
+                last = fmt(last_login[i]) if last_login[i] is not None else None
+                last_mod = last or fmt(0)
+                salt, hash = get_salt_hash(email, password, rng.randbytes(blake2b.SALT_SIZE))
+                yield (email, name, title, phone, pi_name, pi_phone, 'iLab', last_mod, first, last, salt, hash)
+                if legacy and variant:
+                    # the older duplicate row: registered again with another spelling, fewer details
+                    salt, hash = get_salt_hash(variant, password, rng.randbytes(blake2b.SALT_SIZE))
+                    yield (variant, name, None, None, pi_name, None, 'local', fmt(0), first, first, salt, hash)
+        conn.executemany("""--sql
+            INSERT INTO users (email, name, title, phone, pi_name, pi_phone, type, last_mod_type, last_mod,
+                               first_login, last_login, salt, hash, login_attempts)
+            VALUES (?, ?, ?, ?, ?, ?, 'user', ?, ?, ?, ?, ?, ?, 0)
+        """, user_rows())
+        conn.commit()
+        if not legacy:
+            conn.execute("ANALYZE")
+        conn.execute("PRAGMA journal_mode = DELETE")
+        (user_rows_count,) = conn.execute("SELECT COUNT(*) FROM users").fetchone()
+        first, last = conn.execute("SELECT MIN(login_time), MAX(login_time) FROM events").fetchone()
+    finally:
+        conn.close()
+    return {'users': user_rows_count, 'events': event_count, 'devices': device_count,
+            'first_login': first, 'last_login': last}
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate a synthetic cores.db (same arguments: same rows).")
+    parser.add_argument('path', help="database file to create (must not exist)")
+    parser.add_argument('--users', type=int, default=DEFAULT_USERS)
+    parser.add_argument('--events', type=int, default=DEFAULT_EVENTS)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--devices', type=int, help=f"default: enough for ~{DEFAULT_YEARS} years of events")
+    parser.add_argument('--duplicates', type=float, default=0.02, help="fraction of users with a second email spelling")
+    parser.add_argument('--orphans', type=float, default=0.005, help="fraction of sessions left PENDING")
+    parser.add_argument('--legacy', action='store_true', help="schema version 0 (to test the migrations)")
+    parser.add_argument('--password', default=PASSWORD, help="password of all the generated users")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    def report(done, total):
+        elapsed = time.perf_counter() - start
+        print(f"\r{done}/{total} events  ({done / elapsed:,.0f}/s)", end='', flush=True)
+    summary = generate(args.path, args.users, args.events, args.seed, args.devices, args.duplicates,
+                       args.orphans, args.legacy, args.password, progress=report)
+    print(f"\nGenerated {args.path} in {time.perf_counter() - start:.1f} s: {summary['users']} users, "
+          f"{summary['events']} events on {summary['devices']} devices, "
+          f"from {summary['first_login']} to {summary['last_login']}")
@@ -0,0 +1,256 @@
+'''
+Load test: many kiosks writing to one shared cores.db at the same time
+
+Each kiosk is a separate process (its own pool, writer thread, user cache: like a kiosk PC) that runs
+sessions through the real backend API:
+    login()                          SELECT, then UPDATE users + INSERT events (background writer; remote mode: the
+                                     event goes to the server), timed until every write is done
+    SessionHeartbeat.beat()          x --heartbeats, waits for the write (background writer)
+    Event.record_logout()            (remote mode: record_logout_async(), waits for the server)
+--burst makes all kiosks start each session at the same instant (sessions starting at the top of the hour).
+
+Knobs: --journal-mode (wal/delete, set on the file before the run), --busy-timeout (ms, replaces the
+busy_timeout of CONNECTION_PRAGMAS in the kiosks), --remote (the events go through an ingestion server,
+backend/ingest.py, which writes the batches of all kiosks in grouped transactions).
+
+Reported per operation: count, failures (and how many were "database is locked"), logins whose write was
+deferred to the local journal (database locked too long), throughput, latency p50/p95/p99/max, and the wait time: wall time minus
+the CPU time of the kiosk process during the operation, i.e. the time spent sleeping in the busy handler
+(lock waits) or waiting for the disk.
+
+Usage:  python -m benchmarks.load_kiosks [--kiosks 8] [--sessions 50] [--heartbeats 3] [--burst]
+                                         [--journal-mode wal] [--busy-timeout 5000] [--remote] [--db path] [--json]
+'''
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from statistics import mean, quantiles
+
+from benchmarks.generate_db import generate
+
+PASSWORD = 'kiosk'
+OPERATIONS = ('login', 'heartbeat', 'logout')
+TIMEOUT = 60                # seconds, for the futures of the asynchronous writes
+KIOSK_TIMEOUT = 3600        # seconds, for the results of a kiosk
+
+
+def configure_kiosk(path_to_cores_db, folder, kiosk, journal_mode, busy_timeout, url):
+    '''Point the backend of this process to the shared database (and its own journal), with the pragmas of the run'''
+    import backend.main as main
+    from backend.journal import EventJournal
+    main.CONNECTION_PRAGMAS = tuple(
+        f"PRAGMA journal_mode={journal_mode}" if pragma.startswith("PRAGMA journal_mode") else
+        f"PRAGMA busy_timeout={busy_timeout}" if pragma.startswith("PRAGMA busy_timeout") else pragma
+        for pragma in main.CONNECTION_PRAGMAS)
+    main.cores_db_pool.configure(path_to_cores_db)
+    main.event_journal = EventJournal(os.path.join(folder, f'journal_{kiosk}.jsonl'))
+    main.event_writer.after_batch = main.event_journal.sync
+    if url:
+        main.use_remote_events(url)
+    return main
+
+
+def run_kiosk(kiosk, args, path_to_cores_db, folder, emails, url, barrier, results):
+    '''One kiosk (child process): puts [(operation, latency_ms, wait_ms, status), ...] in results.
+       status: 'ok', 'deferred' (login saved in the journal, written at the next replay), 'locked' or 'failed' '''
+    output = io.StringIO()
+    records = []
+    with redirect_stdout(output):
+        main = configure_kiosk(path_to_cores_db, folder, kiosk, args.journal_mode, args.busy_timeout, url)
+        rng = random.Random(f"{args.seed}:{kiosk}")
+        device = f"Kiosk {kiosk:02d}"
+
+        def timed(operation, function):
+            output.seek(0)
+            output.truncate()
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                status = function()
+            except Exception as e:          # the futures raise the error of the write
+                print(e)
+                status = 'failed'
+            latency = (time.perf_counter() - wall) * 1000
+            wait = max(latency - (time.process_time() - cpu) * 1000, 0.0)
+            text = output.getvalue()
+            if status == 'failed' and ('locked' in text or 'busy' in text):
+                status = 'locked'
+            records.append((operation, latency, wait, status))
+
+        for session in range(args.sessions):
+            if args.burst:
+                barrier.wait()
+            else:
+                time.sleep(rng.uniform(0, 2 * args.think / 1000))
+            session_state = {}
+            def do_login():
+                user, event = main.login(rng.choice(emails), PASSWORD, device, 'local')
+                session_state['event'] = event
+                if event is None:
+                    return 'failed'
+                # the writes of the login are part of its latency (remote mode: the event sent to the
+                # server, and the UPDATE of last_login on the local writer)
+                event.login_future.exception(TIMEOUT)
+                main.event_writer.flush(TIMEOUT)
+                if url is None and event.lastrowid is None:
+                    return 'deferred' if event.journaled else 'failed'
+                if url is not None and event.login_future.exception() is not None:
+                    return 'failed'
+                return 'ok'
+            timed('login', do_login)
+            event = session_state['event']
+            if event is None:
+                continue
+            heartbeat = main.SessionHeartbeat(event)
+            for _ in range(args.heartbeats):
+                time.sleep(args.think / 1000)
+                def do_heartbeat():
+                    future = heartbeat.beat()
+                    return 'ok' if future is None or future.result(TIMEOUT) is not False else 'failed'
+                timed('heartbeat', do_heartbeat)
+            time.sleep(args.think / 1000)
+            event.logout_type = 'by_user'
+            def do_logout():
+                if url:
+                    return 'ok' if event.record_logout_async().result(TIMEOUT) else 'failed'
+                if event.lastrowid is None:
+                    # deferred login: the logout follows it to the journal
+                    event.record_logout_async().exception(TIMEOUT)
+                    return 'deferred' if event.journaled else 'failed'
+                return 'ok' if event.record_logout() else 'failed'
+            timed('logout', do_logout)
+        main.close_cores_db()
+    results.put(records)
+
+
+def start_ingest_server(path_to_cores_db):
+    '''Run an IngestServer in a thread of this process; returns (url, stop function)'''
+    from backend.ingest import IngestServer
+    server = IngestServer(path_to_cores_db, port=0)
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        started.set()
+        loop.run_forever()
+        loop.run_until_complete(server.stop())
+    thread = threading.Thread(target=serve, name='ingest', daemon=True)
+    thread.start()
+    started.wait(10)
+    def stop():
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(10)
+    return f"http://127.0.0.1:{server.port}/events", stop
+
+
+def summary(records, elapsed):
+    '''Returns {operation: statistics}'''
+    statistics = {}
+    for operation in OPERATIONS:
+        rows = [record for record in records if record[0] == operation]
+        if not rows:
+            continue
+        latencies = [latency for _, latency, _, _ in rows]
+        waits = [wait for _, _, wait, _ in rows]
+        statuses = [status for _, _, _, status in rows]
+        percentiles = quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+        failures = statuses.count('failed') + statuses.count('locked')
+        statistics[operation] = {
+            'count': len(rows),
+            'per_sec': round(len(rows) / elapsed, 1),
+            'failures': failures,
+            'locked': statuses.count('locked'),
+            'deferred': statuses.count('deferred'),
+            'failure_rate': round(failures / len(rows), 4),
+            'p50_ms': round(percentiles[49], 3),
+            'p95_ms': round(percentiles[94], 3),
+            'p99_ms': round(percentiles[98], 3),
+            'max_ms': round(max(latencies), 3),
+            'wait_mean_ms': round(mean(waits), 3),
+            'wait_share': round(sum(waits) / sum(latencies), 3) if sum(latencies) else 0.0}
+    return statistics
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as folder:
+        path_to_cores_db = args.db or os.path.join(folder, 'cores.db')
+        if not os.path.exists(path_to_cores_db):
+            with redirect_stdout(io.StringIO()):
+                generate(path_to_cores_db, args.users, args.events, seed=args.seed, password=PASSWORD)
+        conn = sqlite3.connect(path_to_cores_db)
+        conn.execute(f"PRAGMA journal_mode={args.journal_mode}")
+        emails = [email for (email,) in conn.execute("SELECT email FROM users WHERE type = 'user'")]
+        conn.close()
+
+        url, stop_server = None, None
+        if args.remote:
+            with redirect_stdout(io.StringIO()):
+                url, stop_server = start_ingest_server(path_to_cores_db)
+        context = multiprocessing.get_context('spawn')
+        barrier = context.Barrier(args.kiosks)
+        results = context.Queue()
+        kiosks = [context.Process(target=run_kiosk, args=(k, args, path_to_cores_db, folder, emails, url,
+                                                          barrier, results))
+                  for k in range(args.kiosks)]
+        start = time.perf_counter()
+        for kiosk in kiosks:
+            kiosk.start()
+        records = []
+        for _ in kiosks:
+            records.extend(results.get(timeout=KIOSK_TIMEOUT))
+        elapsed = time.perf_counter() - start
+        for kiosk in kiosks:
+            kiosk.join()
+        if stop_server:
+            with redirect_stdout(io.StringIO()):
+                stop_server()
+
+    sessions = sum(1 for record in records if record[0] == 'login' and record[3] in ('ok', 'deferred'))
+    return {'kiosks': args.kiosks, 'sessions_per_kiosk': args.sessions, 'heartbeats': args.heartbeats,
+            'burst': args.burst, 'journal_mode': args.journal_mode, 'busy_timeout_ms': args.busy_timeout,
+            'remote': args.remote, 'elapsed_s': round(elapsed, 2),
+            'sessions_per_sec': round(sessions / elapsed, 1), 'operations': summary(records, elapsed)}
+
+
+def print_report(report):
+    print(f"{report['kiosks']} kiosks x {report['sessions_per_kiosk']} sessions "
+          f"({report['heartbeats']} heartbeats), journal_mode={report['journal_mode']}, "
+          f"busy_timeout={report['busy_timeout_ms']} ms{', burst' if report['burst'] else ''}"
+          f"{', remote' if report['remote'] else ''}: {report['elapsed_s']} s, "
+          f"{report['sessions_per_sec']} sessions/s")
+    for operation, s in report['operations'].items():
+        print(f"    {operation:9} {s['count']:6} ops {s['per_sec']:8.1f}/s   failed {s['failure_rate']:6.1%} "
+              f"(locked {s['locked']}, deferred {s['deferred']})   p50 {s['p50_ms']:8.2f}  p95 {s['p95_ms']:8.2f}  "
+              f"p99 {s['p99_ms']:8.2f}  max {s['max_ms']:8.2f} ms   wait {s['wait_share']:.0%}")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Concurrent kiosks writing to one cores.db.")
+    parser.add_argument('--kiosks', type=int, default=8, help="number of kiosk processes")
+    parser.add_argument('--sessions', type=int, default=50, help="sessions per kiosk")
+    parser.add_argument('--heartbeats', type=int, default=3, help="heartbeats per session")
+    parser.add_argument('--think', type=float, default=5, help="ms between the operations of a session")
+    parser.add_argument('--burst', action='store_true', help="all kiosks start each session at the same time")
+    parser.add_argument('--journal-mode', default='wal', choices=('wal', 'delete', 'truncate'))
+    parser.add_argument('--busy-timeout', type=int, default=5000, help="ms")
+    parser.add_argument('--remote', action='store_true', help="send the events through an ingestion server")
+    parser.add_argument('--db', help="database to use (default: a temporary generated one; changed by the run)")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--events', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args()
+    report = main(args)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
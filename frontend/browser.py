@@ -1,12 +1,17 @@
 from PySide6.QtWidgets import QApplication, QMainWindow, QPushButton, QLineEdit, QFrame, QLabel, QSpacerItem, QVBoxLayout, QHBoxLayout, QWidget, QProgressBar, QSizePolicy
 from PySide6.QtCore import Qt, QUrl, Signal, QTimer
 from PySide6.QtWebEngineWidgets import QWebEngineView
-from backend.main import User, Event, get_id_of_most_recent_user, conn_cores_db
+from backend.main import User, Event
 from backend.hash import get_salt_hash
 from datetime import datetime
-from frontend.funcs import make_js_code_for_get_property_with_xpath, set_labels_properties
+from frontend.funcs import set_labels_properties, FutureSignal
+from frontend.watchdog import operation
+from frontend.ilab_page import LoginWatcher, PROFILE_SCRIPT, WORLD, parse_profile
 
 
+STATUS_MESSAGE = ("Click [Login with iLab] button. After logging in, you will be prompted to set a password "
+                  "for faster access when you log in next time.")
+
 
 class MicroBrowser(QMainWindow):
     # Custom signal emitting a string   
@@ -20,17 +25,17 @@ class MicroBrowser(QMainWindow):
         self.device = config_dict['device_name']
         self.landing_url = config_dict['landing_url']
         self.calendar_url = config_dict['calendar_url']
-        check_timer_interval = 1000
         timeout_timer_interval = 100000
         self.profile_info = {}      # dictionary to store profile info
+        self.current_user = None
+        self.next_load_slot = None  # called once, when the page being loaded is loaded (see call_on_next_load)
         # QTimers
-        self.check_timer = QTimer()
-        self.check_timer.setInterval(check_timer_interval)
         self.timeout_timer = QTimer()
         self.timeout_timer.setInterval(timeout_timer_interval)  # 100 seconds timeout
         self.timeout_timer.setSingleShot(True)  # Only trigger once
         # GUI elements
         self.view = QWebEngineView()     
+        self.login_watcher = LoginWatcher(self.view, parent=self)     # reports the end of the iLab login
         self.url_bar = QLineEdit()
         self.progress_bar = QProgressBar()
         self.progress_bar.setMaximumHeight(5)
@@ -56,10 +61,10 @@ class MicroBrowser(QMainWindow):
         self.login_with_ilab.clicked.connect(self.start_ilab_login)
 
         self.view.loadFinished.connect(self.on_load_finished)
-        self.check_timer.timeout.connect(self.check_if_logged_in)
+        self.login_watcher.logged_in.connect(self.on_logged_in)
         self.timeout_timer.timeout.connect(self.on_timeout)
         self.statusBar().setStyleSheet("QStatusBar { color: dark-gray; }")
-        self.statusBar().showMessage("Click [Login with iLab] button. After logging in, you will be prompted to set a password for faster access when you log in next time.")
+        self.statusBar().showMessage(STATUS_MESSAGE)
 
         browser_layout = QVBoxLayout()
         
@@ -137,8 +142,32 @@ class MicroBrowser(QMainWindow):
         home_url = self.calendar_url 
         self.set_browser_url(home_url)
 
+    def reset(self):
+        '''State of a new browser, for the next session: calendar page, no history, no iLab login in progress'''
+        self.stop_timers()
+        self.cancel_next_load()
+        self.registration_panel_ilab.cancel()
+        self.hide_ilab_registration_panel()
+        self.profile_info = {}
+        self.current_user = None
+        self.statusBar().showMessage(STATUS_MESSAGE)
+        self.view.history().clear()     # the Back button must not show the pages of the previous user
+        self.navigate_home()
+
+    def call_on_next_load(self, slot):
+        '''Call slot() once, when the next page is loaded'''
+        self.cancel_next_load()
+        self.next_load_slot = slot
+        self.view.loadFinished.connect(slot)
+
+    def cancel_next_load(self):
+        if self.next_load_slot is not None:
+            self.view.loadFinished.disconnect(self.next_load_slot)
+            self.next_load_slot = None
+
     # LOGIN SPECIFIC FUNCTIONS        
     def start_ilab_login(self):
+        self.start_timers()     # before the landing page is requested: the watcher is injected in it
         self.url_bar.setText(self.landing_url)
         self.navigate_to_url()
         # hide buttons at the top of the browser
@@ -149,8 +178,6 @@ class MicroBrowser(QMainWindow):
         self.statusBar().showMessage("Enter your iLab credentials to log in iLab...")
         self.big_gui_ref.email_pass_button_frame.hide()   #  hide the frame with email, password & login button
 
-        self.view.loadFinished.connect(self.start_timers)
-
     def cancel_ilab_login(self):
         self.url_bar.setText(self.calendar_url)
         self.navigate_to_url()
@@ -162,13 +189,13 @@ class MicroBrowser(QMainWindow):
         self.statusBar().showMessage("Enter your iLab credentials to log in iLab...")
         self.big_gui_ref.email_pass_button_frame.show()   #  hide the frame with email, password & login button
         self.hide_ilab_registration_panel()
-        self.stop_timers(self)
+        self.stop_timers()
+        self.cancel_next_load()
 
     def start_timers(self):
-        self.check_timer.start()
+        self.login_watcher.start()
         self.timeout_timer.start()
         print("Login started...  ")
-        self.view.loadFinished.disconnect(self.start_timers)     
 
     def on_timeout(self):
         print("Timeout occurred. Stop checking for login elements")
@@ -176,128 +203,75 @@ class MicroBrowser(QMainWindow):
         self.navigate_home()
     
     def stop_timers(self):
-        self.check_timer.stop()
-        # self.check_timer.deleteLater()
+        self.login_watcher.stop()
         self.timeout_timer.stop()
-        # self.timeout_timer.deleteLater()
 
 
-    def check_if_logged_in(self):
-        print("check_if_logged_in(self):... looking for user_dropdown element")
-        js_code = """document.querySelector("div#user_dropdown").innerText"""                # <== WORKS # xpath_string = "//div/div[@id='user_dropdown']"
-        self.view.page().runJavaScript(js_code, 0, self.handle_check_if_logged_in_result)    # <== WORKS 
-
-    def handle_check_if_logged_in_result(self, result):
-        print("handle_check_if_logged_in_result(self, result) -->", result, "<--")
-        #  user is logged in if "div#user_dropdown" is found (result is not None)
-        if result:
-            self.stop_timers()
-            self.goto_profile_page()
-        else:
-            print("user_dropdown element not found <=> not logged in.")
+    def on_logged_in(self, user_dropdown_text):
+        #  user is logged in: "div#user_dropdown" is in the page (reported by the injected script)
+        print("on_logged_in(self) -->", user_dropdown_text, "<--")
+        self.stop_timers()
+        self.goto_profile_page()
 
     def goto_profile_page(self):
         print("goto_profile_page(self):")
         profile_url = self.view.url().toString().split(".com/")[0] + ".com/about/show_profile"
         print("profile_url:", profile_url)
-        self.view.loadFinished.connect(self.get_profile_info)
+        self.call_on_next_load(self.get_profile_info)
         self.set_browser_url(profile_url)
 
     def get_profile_info(self):
         print("get_profile_info(self):")
-        for _ in ['name', 'email', 'phone', 'title']:
-            js_code = make_js_code_for_get_property_with_xpath(f"//div/label[@for='{_}']/..", 'textContent')
-            self.view.page().runJavaScript(js_code, 0, self.profile_handler)
+        self.cancel_next_load()     # once: the later pages are not profile pages
+        # all the fields in one evaluation, one callback
+        self.view.page().runJavaScript(PROFILE_SCRIPT, WORLD, self.profile_handler)
     
     def profile_handler(self, result):
-        print("profile_handler(self, result):", result)
-        result_list = result.split("\n")
-        for _ in range(len(result_list)):
-            print(f"result_list[{_}]:", result_list[_])
         # NOTE: self.profile_info is a dictionary:  e.g. self.profile_info['Email'] = 'user@chop.edu'
-        self.profile_info[result_list[1]] = (result_list[2].strip() + " " + result_list[3].strip()).strip()
+        self.profile_info = parse_profile(result)
         print("Profile info:", self.profile_info)
-        if 'Title' in self.profile_info.keys():
-        # if result_list[1] == "Title":  # NOTE: `Title` is the last item in the profile
-            self.stop_timers()
-            # self.navigate_home()
-            
-            
-            user_name = self.profile_info["Name"]
-            user_email = self.profile_info["Email"]
-            # set the formatted text for user_name and user_email in the registration panel 
-            self.registration_panel_ilab.user_info_label.setText(f"<i>&nbsp;user:</i>&nbsp;&nbsp;&nbsp;<b>{user_name}</b> <br> <i>email:</i>&nbsp;&nbsp;&nbsp;</><b>{user_email}</b>")
-            self.show_ilab_registration_panel()
-
-
-             
+        self.stop_timers()
+        if not self.profile_info['Email']:
+            self.statusBar().showMessage("Your iLab profile could not be read. Click [Cancel login with iLab] and try again.")
+            return
+        user_name = self.profile_info["Name"]
+        user_email = self.profile_info["Email"]
+        # set the formatted text for user_name and user_email in the registration panel 
+        self.registration_panel_ilab.user_info_label.setText(f"<i>&nbsp;user:</i>&nbsp;&nbsp;&nbsp;<b>{user_name}</b> <br> <i>email:</i>&nbsp;&nbsp;&nbsp;</><b>{user_email}</b>")
+        self.show_ilab_registration_panel()
 
     def save_user_to_database(self):
-        # check if there is an existing user registered with the email address
-        user_email = self.profile_info['Email']
-        user_id = get_id_of_most_recent_user(user_email)
+        # insert the user, or update the registered user with the same email, in a single upsert
         password = self.registration_panel_ilab.pass_1.text()
-        if user_id:   # user found
-            print(f'User with email: {user_email} already registered with id: {user_id}.')
-            self.new_user = None
-            self.existing_user = User.from_database(user_id)
-                # replace existing info with current info
-            self.existing_user.name = self.profile_info['Name']
-            self.existing_user.phone = self.profile_info['Phone']
-            self.existing_user.email = self.profile_info['Email']
-            self.existing_user.title = self.profile_info['Title']
-            self.existing_user.last_login = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            self.existing_user.last_mod = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            self.existing_user.last_mod_type = 'iLab'
-            self.existing_user.salt, self.existing_user.hash = get_salt_hash(self.existing_user.email, password)
-
-            properties_to_update = ['name', 'title', 'phone', 'last_mod_type', 'last_mod', 'last_login', 'salt', 'hash']
-            for _ in properties_to_update:
-                self.existing_user.update_user_property(self.existing_user.id, _, self.existing_user.__dict__[_])
-
-            print(f"User {self.existing_user.name} on row {user_id} has been updated.")
-            
-        else:   # user is new
-            self.existing_user = None
-            self.new_user = User()
-            self.new_user.name = self.profile_info['Name']
-            self.new_user.phone = self.profile_info['Phone']
-            self.new_user.email = self.profile_info['Email']
-            self.new_user.title = self.profile_info['Title']
-            self.new_user.last_login = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            self.new_user.last_mod = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            self.new_user.last_mod_type = 'iLab'
-            self.new_user.first_login = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            self.new_user.salt, self.new_user.hash = get_salt_hash(self.new_user.email, password)
-            row_id = self.new_user.add_user()
-            # print(f"User added successfully on row {row_id}.")  # <-- printed by add_user() function
-
-        self.record_login_ilab_event()  # record login EVENT
+        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        user = User()
+        user.name = self.profile_info['Name']
+        user.phone = self.profile_info['Phone']
+        user.email = self.profile_info['Email']
+        user.title = self.profile_info['Title']
+        user.last_login = current_time
+        user.last_mod = current_time
+        user.last_mod_type = 'iLab'
+        user.first_login = current_time     # only used if the user is new
+        # columns replaced when the user is already registered
+        properties_to_update = ['name', 'title', 'phone', 'last_mod_type', 'last_mod', 'last_login', 'salt', 'hash']
+        with operation('iLab registration'):
+            user.salt, user.hash = get_salt_hash(user.email, password)
+            saved = user.upsert(properties_to_update)
+        if saved:
+            self.current_user = user        # all attributes (id, type, ...) are loaded from the stored row
+            self.record_login_ilab_event()  # record login EVENT
+        else:
+            print("Error saving the iLab user to the database.")
 
     def record_login_ilab_event(self):
         print('Recording login event ...')
         # Create an instance of Event and fill in the event details
-        ilab_login_event = Event()
-        ilab_login_event.email = self.profile_info['Email']
-        ilab_login_event.device = self.device
-        ilab_login_event.login_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        ilab_login_event.login_type = 'iLab'
-        self.login_event_id = ilab_login_event.record_login()  # record login event to database
-
-        # the if statements below are for merging `self.new_user` and `self.existing_user` into `current_user`
-        if self.login_event_id:
-            if self.new_user:
-                current_user = self.new_user
-            elif self.existing_user:
-                current_user = self.existing_user
-            else:
-                print("Error fe_browser: current user = None ")
-            
-            self.big_gui_ref.show_mini_gui(current_user, ilab_login_event, self.config_dict)
-        else:
-            print("Error recording login event.")
-            return None
-            # Handle the error as needed
+        ilab_login_event = Event.login_from_args(self.profile_info['Email'], self.device, 'iLab')
+        # record login event to database (background writer: the MiniGui is shown without waiting)
+        self.login_event_signal = FutureSignal(ilab_login_event.record_login_async())
+        self.login_event_signal.finished.connect(lambda row_id: print(f"Login event recorded with ID {row_id}"))
+        self.big_gui_ref.show_mini_gui(self.current_user, ilab_login_event, self.config_dict)
 
 
 
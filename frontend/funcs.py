@@ -1,7 +1,7 @@
 from PySide6.QtWidgets import QApplication, QLabel, QVBoxLayout, QLineEdit, QHBoxLayout, QWidget, QPushButton, QSpacerItem, QFrame, QSizePolicy
 import sys
 import time
-from PySide6.QtCore import Qt
+from PySide6.QtCore import Qt, QObject, Signal, QTimer
 
 '''
 This module is for independent functions.
@@ -43,6 +43,31 @@ def test_set_labels_properties():
 
 
 
+class FutureSignal(QObject):
+    ''' Re-emit the outcome of a concurrent.futures.Future (e.g. from the background writer) as Qt signals.
+        The future completes in the writer thread; the signals are delivered in the GUI thread.
+        Keep a reference to the instance until the signal is received.
+    '''
+    finished = Signal(object)   # result of the future (e.g. the lastrowid of a login event)
+    failed = Signal(object)     # exception raised by the future
+
+    def __init__(self, future, parent=None):
+        super().__init__(parent)
+        if future.done():
+            # add_done_callback would emit now, before the caller connects the signals: emit from the event loop
+            QTimer.singleShot(0, self, lambda: self._on_done(future))
+        else:
+            future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        if future.exception() is not None:
+            self.failed.emit(future.exception())
+        else:
+            self.finished.emit(future.result())
+
+
+
+
 def get_screen_geometry():
     ''' Get the geometries of all available screens.'''
     screens = QApplication.screens()
@@ -0,0 +1,158 @@
+'''
+Idle detection of the kiosk (auto-logout), without polling
+
+IdleMonitor emits `idle` when there was no user input for `timeout_ms`:
+- input to the windows of the application (mouse, keyboard, wheel, touch) is seen by an application-wide
+  event filter, which only records the time (no timer restart per event)
+- input to other applications (e.g. the acquisition software) is asked from the platform when the timer
+  expires: GetLastInputInfo (Windows), CGEventSourceSecondsSinceLastEventType (macOS),
+  XScreenSaverQueryInfo (X11). Where none is available, a move of the mouse cursor counts as input.
+A single-shot timer expires at the earliest time the session can be idle, and is re-armed for the remaining
+time if there was input meanwhile: at most one wakeup per timeout while the user is active.
+
+Usage:  monitor = IdleMonitor(600000, parent=mini_gui)
+        monitor.idle.connect(mini_gui.logout_by_inactivity)
+        monitor.start()   ...   monitor.stop()
+'''
+import ctypes
+import ctypes.util
+import sys
+import time
+from PySide6.QtCore import QObject, QTimer, QEvent, Signal
+from PySide6.QtGui import QCursor
+from PySide6.QtWidgets import QApplication
+
+# events that mean "the user is here"
+ACTIVITY_EVENTS = frozenset({QEvent.MouseMove, QEvent.MouseButtonPress, QEvent.MouseButtonDblClick, QEvent.Wheel,
+                             QEvent.KeyPress, QEvent.TouchBegin, QEvent.TouchUpdate, QEvent.TabletPress,
+                             QEvent.TabletMove})
+
+
+# ---- seconds since the last input to any application (None if it cannot be known) ------------------------
+
+def _windows_idle_seconds():
+    class LASTINPUTINFO(ctypes.Structure):
+        _fields_ = [('cbSize', ctypes.c_uint), ('dwTime', ctypes.c_uint)]
+    info = LASTINPUTINFO()
+    info.cbSize = ctypes.sizeof(info)
+    if not ctypes.windll.user32.GetLastInputInfo(ctypes.byref(info)):
+        return None
+    # both are milliseconds since boot, on 32 bits (wraps after 49.7 days)
+    return ((ctypes.windll.kernel32.GetTickCount() - info.dwTime) & 0xFFFFFFFF) / 1000
+
+
+_quartz = None
+
+def _macos_idle_seconds():
+    global _quartz
+    if _quartz is None:
+        _quartz = ctypes.CDLL(ctypes.util.find_library('ApplicationServices'))
+        _quartz.CGEventSourceSecondsSinceLastEventType.restype = ctypes.c_double
+        _quartz.CGEventSourceSecondsSinceLastEventType.argtypes = [ctypes.c_int, ctypes.c_uint32]
+    # kCGEventSourceStateCombinedSessionState, kCGAnyInputEventType
+    return _quartz.CGEventSourceSecondsSinceLastEventType(0, 0xFFFFFFFF)
+
+
+class _XScreenSaverInfo(ctypes.Structure):
+    _fields_ = [('window', ctypes.c_ulong), ('state', ctypes.c_int), ('kind', ctypes.c_int),
+                ('til_or_since', ctypes.c_ulong), ('idle', ctypes.c_ulong), ('eventMask', ctypes.c_ulong)]
+
+_x11 = None
+
+def _x11_idle_seconds():
+    global _x11
+    if _x11 is None:
+        xlib = ctypes.CDLL(ctypes.util.find_library('X11'))
+        xss = ctypes.CDLL(ctypes.util.find_library('Xss'))
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        xss.XScreenSaverAllocInfo.restype = ctypes.POINTER(_XScreenSaverInfo)
+        xss.XScreenSaverQueryInfo.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(_XScreenSaverInfo)]
+        display = xlib.XOpenDisplay(None)
+        if not display:
+            raise OSError("no X display")
+        _x11 = (xss, display, xlib.XDefaultRootWindow(display), xss.XScreenSaverAllocInfo())
+    xss, display, root, info = _x11
+    if not xss.XScreenSaverQueryInfo(display, root, info):
+        return None
+    return info.contents.idle / 1000
+
+
+def _platform_query():
+    if sys.platform == 'win32':
+        return _windows_idle_seconds
+    if sys.platform == 'darwin':
+        return _macos_idle_seconds
+    if QApplication.platformName() == 'xcb':
+        return _x11_idle_seconds
+    return None
+
+
+_query = False      # not chosen yet
+
+def system_idle_seconds():
+    '''Seconds since the last input to any application, or None if the platform cannot tell (e.g. Wayland)'''
+    global _query
+    if _query is False:
+        _query = _platform_query()
+    if _query is None:
+        return None
+    try:
+        return _query()
+    except (OSError, AttributeError, TypeError) as e:   # library missing or unusable: never ask again
+        print("Idle detection: system idle time not available:", e)
+        _query = None
+        return None
+
+
+class IdleMonitor(QObject):
+    idle = Signal()
+
+    def __init__(self, timeout_ms, parent=None):
+        super().__init__(parent)
+        self.timeout = timeout_ms / 1000
+        self._last_input = time.monotonic()
+        self._cursor = None
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._check)
+
+    def start(self):
+        self._last_input = time.monotonic()
+        self._cursor = QCursor.pos()
+        QApplication.instance().installEventFilter(self)
+        self._timer.start(int(self.timeout * 1000))
+
+    def stop(self):
+        self._timer.stop()
+        app = QApplication.instance()
+        if app is not None:
+            app.removeEventFilter(self)
+
+    def idle_seconds(self):
+        '''Seconds since the last input (to this application or, if known, to any application)'''
+        now = time.monotonic()
+        cursor = QCursor.pos()
+        if cursor != self._cursor:          # the mouse moved, maybe over another application
+            self._cursor = cursor
+            self._last_input = now
+        idle = now - self._last_input
+        system_idle = system_idle_seconds()
+        if system_idle is not None:
+            idle = min(idle, system_idle)
+        return idle
+
+    def eventFilter(self, watched, event):
+        if event.type() in ACTIVITY_EVENTS:
+            self._last_input = time.monotonic()
+        return False        # never consume the event
+
+    def _check(self):
+        remaining = self.timeout - self.idle_seconds()
+        if remaining > 0:
+            self._timer.start(max(int(remaining * 1000), 1000))
+        else:
+            self.stop()
+            self.idle.emit()
@@ -0,0 +1,152 @@
+'''
+Scripts run in the iLab pages of the MicroBrowser
+
+LoginWatcher reports the end of an iLab login without polling the page: while it is started, every page
+loaded in the view gets a script (isolated world: invisible to the scripts of iLab) with a MutationObserver
+that calls back over a QWebChannel as soon as the element of a logged-in user (div#user_dropdown) is in the
+document, or immediately if it is already there. The observer checks again on each change of the URL
+(same-document navigations), and stops after the first report.
+
+PROFILE_SCRIPT reads all the fields of the profile page (about/show_profile) in one evaluation and returns
+them as one JSON object; parse_profile() turns it into the profile dict, with '' for the missing fields.
+
+Usage:  watcher = LoginWatcher(browser.view, parent=browser)
+        watcher.logged_in.connect(browser.on_logged_in)
+        watcher.start()   ...   watcher.stop()
+        view.page().runJavaScript(PROFILE_SCRIPT, WORLD, lambda result: print(parse_profile(result)))
+'''
+import json
+import time
+from PySide6.QtCore import QObject, QFile, QIODevice, Signal, Slot
+from PySide6.QtWebChannel import QWebChannel
+from PySide6.QtWebEngineCore import QWebEngineScript
+
+LOGGED_IN_SELECTOR = "div#user_dropdown"
+WORLD = QWebEngineScript.ApplicationWorld       # isolated from the scripts of the page
+
+# %(selector)s: CSS selector of the element; %(bridge)s: name of the object registered in the channel
+WATCH_SCRIPT = """
+(function () {
+    if (window.__kioskLoginCheck) return;       // once per document
+    var selector = %(selector)r, bridge = null, found = null, observer = null;
+    function check() {
+        if (found !== null) return;
+        var element = document.querySelector(selector);
+        if (!element) return;
+        found = element.innerText || '';
+        if (observer) observer.disconnect();
+        if (bridge) bridge.elementFound(found);
+    }
+    window.__kioskLoginCheck = check;
+    new QWebChannel(qt.webChannelTransport, function (channel) {
+        bridge = channel.objects[%(bridge)r];
+        if (found !== null) bridge.elementFound(found);
+    });
+    observer = new MutationObserver(check);
+    observer.observe(document, {childList: true, subtree: true});
+    check();
+})();
+"""
+
+# field of the profile page (<label for=...>) -> key of the profile dict
+PROFILE_FIELDS = {'name': 'Name', 'email': 'Email', 'phone': 'Phone', 'title': 'Title'}
+
+# the value of a field is the text of the parent of its label, without the label
+PROFILE_SCRIPT = """
+(function () {
+    var profile = {};
+    %s.forEach(function (field) {
+        var label = document.querySelector('label[for="' + field + '"]');
+        if (!label || !label.parentElement) return;
+        var text = label.parentElement.textContent.replace(label.textContent, '');
+        profile[field] = text.replace(/\\s+/g, ' ').trim();
+    });
+    return JSON.stringify(profile);
+})();
+""" % json.dumps(list(PROFILE_FIELDS))
+
+
+def parse_profile(result):
+    '''Result of PROFILE_SCRIPT -> {'Name': ..., 'Email': ..., 'Phone': ..., 'Title': ...}
+       Missing fields, or a result that is not the expected JSON object, give '' values.'''
+    if isinstance(result, str):
+        try:
+            result = json.loads(result)
+        except ValueError:
+            print("Profile page: unexpected result:", result[:200])
+            result = None
+    if not isinstance(result, dict):
+        result = {}
+    return {key: str(result.get(field) or '').strip() for field, key in PROFILE_FIELDS.items()}
+
+
+_qwebchannel_js = None
+
+
+def qwebchannel_js():
+    '''Source of qwebchannel.js (resource of the QtWebChannel module)'''
+    global _qwebchannel_js
+    if _qwebchannel_js is None:
+        resource = QFile(":/qtwebchannel/qwebchannel.js")
+        if not resource.open(QIODevice.ReadOnly):
+            raise RuntimeError("qwebchannel.js not found in the Qt resources")
+        _qwebchannel_js = bytes(resource.readAll()).decode('utf-8')
+        resource.close()
+    return _qwebchannel_js
+
+
+class _Bridge(QObject):
+    '''Object of the web channel, called by the injected script'''
+    found = Signal(str)
+
+    @Slot(str)
+    def elementFound(self, text):
+        self.found.emit(text)
+
+
+class LoginWatcher(QObject):
+    logged_in = Signal(str)     # innerText of the element (name of the user)
+
+    def __init__(self, view, selector=LOGGED_IN_SELECTOR, parent=None):
+        super().__init__(parent)
+        self.view = view
+        self.active = False
+        self.started_at = None
+        self._bridge = _Bridge(self)
+        self._bridge.found.connect(self._on_found)
+        self._channel = QWebChannel(self)
+        self._channel.registerObject('kioskLogin', self._bridge)
+        view.page().setWebChannel(self._channel, WORLD)
+        self._script = QWebEngineScript()
+        self._script.setName('kiosk_login_watch')
+        self._script.setSourceCode(qwebchannel_js() + WATCH_SCRIPT % {'selector': selector, 'bridge': 'kioskLogin'})
+        self._script.setInjectionPoint(QWebEngineScript.DocumentCreation)
+        self._script.setWorldId(WORLD)
+        self._script.setRunsOnSubFrames(False)
+
+    def start(self):
+        '''Watch the pages loaded from now on (the script is injected in each new document)'''
+        if self.active:
+            return
+        self.active = True
+        self.started_at = time.monotonic()
+        self.view.page().scripts().insert(self._script)
+        self.view.urlChanged.connect(self._on_url_changed)
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self.view.page().scripts().remove(self._script)
+        self.view.urlChanged.disconnect(self._on_url_changed)
+
+    def _on_url_changed(self, url):
+        # same-document navigation: the observer of the document is still there, check it now
+        self.view.page().runJavaScript("window.__kioskLoginCheck && window.__kioskLoginCheck();", WORLD)
+
+    def _on_found(self, text):
+        if not self.active:         # report of a page loaded before stop()
+            return
+        print(f"iLab login detected after {time.monotonic() - self.started_at:.1f} s")
+        self.stop()
+        self.logged_in.emit(text)
@@ -3,21 +3,22 @@ import os
 import re
 from datetime import datetime
 from PySide6.QtWidgets import QApplication, QLabel, QVBoxLayout, QHBoxLayout, QWidget, QPushButton, QSpacerItem, QMainWindow, QFrame, QLineEdit, QSizePolicy, QMessageBox
-from PySide6.QtGui import QFont, QGuiApplication, QPalette, QColor, QPixmap, QCursor
+from PySide6.QtGui import QFont, QGuiApplication, QPalette, QColor, QPixmap
 from PySide6.QtWebEngineCore import QWebEnginePage
-from PySide6.QtCore import Qt, QUrl, QTimer, QPoint
+from PySide6.QtCore import Qt, QUrl, QTimer
 from frontend.browser import MicroBrowser
 from frontend.styling import get_chop_palette, Colors, regular_font, bold_font, title_font, subtitle_font
 from frontend.funcs import set_labels_properties, get_screen_geometry
 
-from backend.main import User, Event, get_column_names, export_table_to_csv
+from backend.main import User, Event, get_column_names, login, SessionHeartbeat
 from backend.hash import get_salt_hash
 from itertools import islice
 from frontend.settings import SettingsGUI
+from frontend.watchdog import operation
+from frontend.idle import IdleMonitor
 
 
 AUTOLOGOUT_TIME = 600000   # milliseconds
-INACTIVITY_CHECK_INTERVAL = 1000   #milliseconds
 
  
 
@@ -70,11 +71,12 @@ class ContentMiniGui(QFrame):
 
 
 class MiniGui(QFrame):
-    def __init__(self, curr_user, login_event, config_dict):
-        # NOTE: MiniGui needs config_dict for restarting the BigGui
+    def __init__(self, curr_user, login_event, config_dict, big_gui=None):
+        # NOTE: MiniGui needs config_dict for restarting the BigGui (if big_gui, the kiosk window, is not given)
         super().__init__()
+        self.big_gui = big_gui
+        self.setAttribute(Qt.WA_DeleteOnClose)      # a new MiniGui is created for every session
         self.autologout_time = AUTOLOGOUT_TIME
-        self.inactivity_check_interval = INACTIVITY_CHECK_INTERVAL
         self.ready_to_close = False
         self.login_event = login_event
         self.config_dict = config_dict
@@ -126,19 +128,21 @@ class MiniGui(QFrame):
         self.showMinimized()
 
     def turn_on_mini_gui_timers(self):
-        # Mouse Idle Detection setup
-        self.last_mouse_position = QPoint()
-        self.idle_timer = QTimer(self)
-        self.idle_timer.timeout.connect(self.check_mouse_idle)
-        self.idle_timer.start(self.inactivity_check_interval)       # in milliseconds 
-        self.total_idle_time_timer = QTimer(self)                   # QTimer to track the TOTAL idle time
-        self.total_idle_time_timer.start(self.autologout_time)
+        # Idle detection: input events of the application + idle time of the system, one single-shot timer
+        self.idle_monitor = IdleMonitor(self.autologout_time, self)
+        self.idle_monitor.idle.connect(self.logout_by_inactivity)
+        self.idle_monitor.start()
+        # Session heartbeat: checkpoint events.last_seen (written off the GUI thread, coalesced)
+        self.heartbeat = SessionHeartbeat(self.login_event)
+        self.heartbeat_timer = QTimer(self)
+        self.heartbeat_timer.timeout.connect(self.heartbeat.beat)
+        self.heartbeat_timer.start(int(SessionHeartbeat.interval * 1000))     # config.json: "heartbeat_interval"
 
     def turn_off_mini_gui_timers(self):
-        self.idle_timer.stop()
-        self.total_idle_time_timer.stop()
-        self.idle_timer.deleteLater()
-        self.total_idle_time_timer.deleteLater()
+        self.idle_monitor.stop()
+        self.heartbeat_timer.stop()
+        self.heartbeat_timer.deleteLater()
+        self.idle_monitor.deleteLater()
 
     def toggle_size(self):
         if self.is_minimized:
@@ -160,46 +164,26 @@ class MiniGui(QFrame):
 
     def logout_and_start_big_gui(self):
         self.logout()
-        self.big_gui = BigGui(self.config_dict)
+        if self.big_gui is None:
+            self.big_gui = BigGui(self.config_dict)
+        # back to the login screen (the same window for the whole run: no new browser, no reload of the assets);
         # fill out the email address of the user who logged out (in case of accidental logout)
-        self.big_gui.email_pass_button_frame.email_line_edit.setText(self.curr_user.email)
-        self.big_gui.email_pass_button_frame.pass_line_edit.setText("")
+        self.big_gui.reset_for_login(self.curr_user.email)
         self.big_gui.show()
         self.turn_off_mini_gui_timers()
         self.close()  # Close mini_gui
 
-    # check if the mouse is idle every interval = INACTIVITY_CHECK_MILLISECONDS
-    def check_mouse_idle(self):
-        current_mouse_position = self.mapFromGlobal(QCursor.pos())
-        if current_mouse_position == self.last_mouse_position:
-            # If the mouse is idle, increment the idle time 
-            self.idle_time += self.idle_timer.interval()
-            # Restart the idle time timer to count the idle time
-            self.total_idle_time_timer.start(self.idle_timer.interval())
-            print('...idle_time: ', int(self.idle_time)/1000, ' seconds', ' ' * 30, end="\r")
-            if int(self.idle_time) >= self.autologout_time:
-                self.logout_by_inactivity()
-
-        else:                           # if the mouse moved
-            self.idle_time = 0          # reset the idle time to 0
-            self.total_idle_time_timer.stop() #stop the idle time timer
-            
-            print(f"...mouse cursor moved to: {current_mouse_position.x()}, {current_mouse_position.y()}",  ' ' * 50, end='\r')
-
-        # Update the last known mouse position
-        self.last_mouse_position = current_mouse_position
-
     def logout(self):
         if self.login_event:
-            # Record logout event before closing the MiniGUI
+            # Record logout event before closing the MiniGUI (queued for the background writer)
             self.login_event.logout_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            self.login_event.record_logout()
-            
-            logout_event_id = self.login_event.lastrowid
-            if logout_event_id:
-                print(f"Logout successful. Logout event recorded with ID {logout_event_id}")
-            else:
-                print("Error recording logout event.")
+            with operation('logout'):
+                future = self.login_event.record_logout_async()
+            login_event = self.login_event
+            def report_logout(future):     # called in the writer thread (errors are printed by the backend)
+                if future.exception() is None:
+                    print(f"Logout successful. Logout event recorded with ID {login_event.lastrowid}")
+            future.add_done_callback(report_logout)
             self.ready_to_close = True
 
     def closeEvent(self, event):
@@ -353,6 +337,7 @@ class EmailPassButtonPanel(QFrame):
 
         # Login status QLabel
         login_status_label = QLabel("")
+        self.login_status_label = login_status_label
         login_status_label.setAlignment(Qt.AlignCenter)
 
         email_pass_button_status_layout.addWidget(login_status_label)
@@ -373,37 +358,17 @@ class EmailPassButtonPanel(QFrame):
             print("...recording login event...")
             email = self.email_line_edit.text()
             password = self.pass_line_edit.text()
-            print( "email, password:", email, password) 
-            user_authenticated = User.authenticate_user(email, password)
-            print("user_authenticated:", user_authenticated)
-            if user_authenticated:
-                # global mini_gui_window
-                self.curr_user = User.from_database_by_email(email)
-                if self.curr_user:
-                    record_login_local_event()
-                else:
-                    print("Error from gui_authenticate_user(): failed to load user information from database.")
+            # check the password; last_login and the login event are written by the background writer
+            with operation('local login'):
+                self.curr_user, self.login_local_event = login(email, password, self.config_dict['device_name'], 'local')
+            print("user_authenticated:", self.curr_user is not None)
+            if self.curr_user:
+                print("Login successful. Login event queued for the background writer.")
+                self.big_gui_ref.show_mini_gui(self.curr_user, self.login_local_event, self.config_dict)
             else:
                 print("Error from gui_authenticate_user(): Login failed. Invalid password.")
                 login_status_label.setText('<font color="yellow">Login failed. Invalid password</font>')
                 return None
-            
-        def record_login_local_event():
-            print("User from db: curr_user.name:", self.curr_user.name)
-            if self.curr_user: 
-                # Record login event
-                self.login_local_event = Event()
-                self.login_local_event.email = self.curr_user.email
-                self.login_local_event.login_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                self.login_local_event.login_type = 'local'  
-                self.login_event_id = self.login_local_event.record_login()   #reminder: record_login() returns lastrowid | None
-                print(f"Login successful. Login event recorded with ID {self.login_event_id}")
-                if self.login_event_id:
-                    self.big_gui_ref.show_mini_gui(self.curr_user, self.login_local_event, self.config_dict)
-                else:
-                    print("Error recording login event.")
-                    return None
-                    # Handle the error as needed
 
         # trigger authenticate_user                
         login_button.clicked.connect(gui_authenticate_user)         # when clicking login    
@@ -443,6 +408,17 @@ class EmailPassButtonPanel(QFrame):
         set_status_login_btn()  
         self.email_line_edit.textChanged.connect(set_status_login_btn)
 
+    def reset(self, email=''):
+        '''Login state: email filled out (e.g. the user who just logged out), empty password, no status'''
+        self.email_line_edit.setText(email)
+        self.pass_line_edit.setText("")
+        self.login_status_label.setText("")
+        self.show()
+        if email:
+            self.pass_line_edit.setFocus()
+        else:
+            self.email_line_edit.setFocus()
+
 
 
 class BigGui(QMainWindow):
@@ -535,8 +511,15 @@ class BigGui(QMainWindow):
 
 
     def show_mini_gui(self, user, event, config_dict):
-        # start mini_gui close big_gui;    NOTE: in the two lines below: must use 'self.'
-        self.mini_gui = MiniGui(user, event, self.config_dict)
+        # start mini_gui hide big_gui (kept, and shown again by the MiniGui on logout);  NOTE: must use 'self.'
+        self.mini_gui = MiniGui(user, event, self.config_dict, big_gui=self)
         self.mini_gui.show()
-        self.close()
+        self.hide()
+
+    def reset_for_login(self, email=''):
+        '''Bring the window back to its login state after a session'''
+        self.mini_gui = None
+        self.email_pass_button_frame.reset(email)
+        self.cancel_login_with_ilab_btn.hide()
+        self.browser.reset()
 
@@ -1,9 +1,24 @@
+import sqlite3
 from datetime import datetime
-from PySide6.QtWidgets import QLabel, QVBoxLayout, QHBoxLayout, QWidget, QPushButton, QLineEdit, QMessageBox, QTabWidget, QSpacerItem, QSizePolicy
+from PySide6.QtWidgets import QApplication, QFileDialog, QProgressBar, QCheckBox, QLabel, QVBoxLayout, QHBoxLayout, QWidget, QPushButton, QLineEdit, QMessageBox, QTabWidget, QSpacerItem, QSizePolicy, QTableWidget, QTableWidgetItem, QHeaderView
 from PySide6.QtCore import Qt
-from backend.main import User, get_column_names, export_table_to_csv
+from backend.main import User, get_column_names, sql_stats
+from backend.export import export_table_to_csv, export_delta
+from backend.roster import import_roster
 from backend.hash import get_salt_hash
+from backend.migrations import migrate, LATEST_VERSION
+from frontend.watchdog import operation
 from itertools import islice
+import os
+
+# destination of the incremental exports (holds the manifest and the watermark)
+DELTA_EXPORT_FOLDER = os.path.join(os.path.expanduser('~'), 'Downloads', 'cores_db_deltas')
+
+# columns of the SQL Statistics tab: (header, key of sql_stats.snapshot())
+SQL_STATS_COLUMNS = (('Statement', 'template'), ('Calls', 'count'), ('Total ms', 'total_ms'), ('Avg ms', 'avg_ms'),
+                     ('p99 ms', 'p99_ms'), ('Rows', 'rows'), ('Fetch ms', 'fetch_ms'), ('Wait ms', 'wait_ms'),
+                     ('Errors', 'errors'),
+                     ('Call sites', 'call_sites'))
 
 class EditUserGUI(QWidget):
     def __init__(self, user_data):
@@ -50,22 +65,16 @@ class EditUserGUI(QWidget):
         
         for key in list(self.fields.keys())[1:9]:  
             # Set field value to None if empty, otherwise use the field's text
-            new_value = self.fields[key].text() or None
-            # Use the row_id with the update_user_property method to update each property
-            success = user_instance.update_user_property(row_id, key, new_value)
-            
-            if not success:
-                # Handle the case where the update fails
-                self.status_label.setText(f'<font color="red">Failed to update {key}.</font>')
-                return
+            setattr(user_instance, key, self.fields[key].text() or None)
 
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        # Finally, update 'last_mod' to current time
-        success = user_instance.update_user_property(row_id, 'last_mod', current_time)
-        if success:
+        # 'last_mod' is set to current time only if something was changed
+        if user_instance.dirty_columns():
+            user_instance.last_mod = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # one UPDATE of the changed columns, in one transaction
+        if user_instance.save():
             self.status_label.setText('<font color="green">User updated successfully.</font>')
         else:
-            self.status_label.setText('<font color="red">Failed to update last modification time.</font>')
+            self.status_label.setText('<font color="red">Failed to update user.</font>')
         
 
 
@@ -273,7 +282,9 @@ class SettingsGUI(QWidget):
         if self.curr_user.type == "admin":
             self.tabWidget.addTab(self.createUpdateDatabaseTab(), "Update Database")
             self.tabWidget.addTab(self.createAddOrEditUserTab(), "Add/Edit User")
+            self.tabWidget.addTab(self.createImportUsersTab(), "Import Users")
             self.tabWidget.addTab(self.createExportDatabaseTab(), "Export Database")
+            self.tabWidget.addTab(self.createSqlStatsTab(), "SQL Statistics")
         
         # Tab available for all users
         self.tabWidget.addTab(self.createResetPasswordTab(), "Reset Password")
@@ -296,7 +307,15 @@ class SettingsGUI(QWidget):
         btnLayout.addStretch()  # Add stretchable space on the right
 
         layout.addLayout(btnLayout)  # Add the horizontal layout containing the button to the main vertical layout
-        # updateDatabaseBtn.clicked.connect(self.updateDatabase)  # Implement this method
+        updateDatabaseBtn.clicked.connect(self.updateDatabase)
+
+        # Progress bar and status label (updated while the migrations run)
+        self.updateDatabaseProgress = QProgressBar()
+        self.updateDatabaseProgress.setValue(0)
+        layout.addWidget(self.updateDatabaseProgress)
+        self.updateDatabaseStatus = QLabel(f"Latest schema version: {LATEST_VERSION}")
+        self.updateDatabaseStatus.setAlignment(Qt.AlignCenter)
+        layout.addWidget(self.updateDatabaseStatus)
 
         tab.setLayout(layout)
         return tab
@@ -305,6 +324,36 @@ class SettingsGUI(QWidget):
         tab = AddOrEditUserGUI()
         return tab
     
+    def createImportUsersTab(self):
+        tab = QWidget()
+        layout = QVBoxLayout()
+
+        # Description with center alignment
+        desc = QLabel("Adds or updates the users of a CSV roster (header with an email column; name, title, phone, PI...).")
+        desc.setAlignment(Qt.AlignCenter)
+        desc.setWordWrap(True)
+        layout.addWidget(desc)
+
+        # Button with center alignment using QHBoxLayout
+        btnLayout = QHBoxLayout()
+        btnLayout.addStretch()
+        importUsersBtn = QPushButton('Import CSV Roster...')
+        importUsersBtn.setFixedSize(importUsersBtn.sizeHint())
+        btnLayout.addWidget(importUsersBtn)
+        btnLayout.addStretch()
+        layout.addLayout(btnLayout)
+        importUsersBtn.clicked.connect(self.importUsers)
+
+        # Option: only validate and count
+        self.dryRunImportCheckBox = QCheckBox("Dry run (check the file, write nothing)")
+        layout.addWidget(self.dryRunImportCheckBox, alignment=Qt.AlignCenter)
+        self.importStatus = QLabel("")
+        self.importStatus.setAlignment(Qt.AlignCenter)
+        layout.addWidget(self.importStatus)
+
+        tab.setLayout(layout)
+        return tab
+
     def createExportDatabaseTab(self):
         tab = QWidget()
         layout = QVBoxLayout()
@@ -324,16 +373,130 @@ class SettingsGUI(QWidget):
         layout.addLayout(btnLayout)  # Add the horizontal layout containing the button to the main vertical layout
 
         exportDatabaseBtn.clicked.connect(self.exportDatabase)  # Connect the button to its action
+
+        # Option: write gzip-compressed files (.csv.gz)
+        self.compressExportCheckBox = QCheckBox("Compress (gzip)")
+        layout.addWidget(self.compressExportCheckBox, alignment=Qt.AlignCenter)
+        # Option: only export what changed since the last incremental export (to DELTA_EXPORT_FOLDER)
+        self.incrementalExportCheckBox = QCheckBox("Incremental (only new or changed rows, with manifest)")
+        self.incrementalExportCheckBox.setToolTip(DELTA_EXPORT_FOLDER)
+        layout.addWidget(self.incrementalExportCheckBox, alignment=Qt.AlignCenter)
+        self.exportStatus = QLabel("")
+        self.exportStatus.setAlignment(Qt.AlignCenter)
+        layout.addWidget(self.exportStatus)
         
         tab.setLayout(layout)
         return tab
         
+    def createSqlStatsTab(self):
+        tab = QWidget()
+        layout = QVBoxLayout()
+
+        # Description with center alignment
+        if sql_stats.enabled:
+            text = f"Time spent in each SQL statement since {sql_stats.since}, most expensive first."
+        else:
+            text = 'SQL statistics are off: set "sql_stats": true in config.json and restart.'
+        desc = QLabel(text)
+        desc.setAlignment(Qt.AlignCenter)
+        desc.setWordWrap(True)
+        layout.addWidget(desc)
+
+        self.sqlStatsTable = QTableWidget(0, len(SQL_STATS_COLUMNS))
+        self.sqlStatsTable.setHorizontalHeaderLabels([label for label, _ in SQL_STATS_COLUMNS])
+        self.sqlStatsTable.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.sqlStatsTable.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.sqlStatsTable.setSortingEnabled(True)
+        layout.addWidget(self.sqlStatsTable)
+
+        # Buttons: refresh the table, start again from zero, save as JSON
+        btnLayout = QHBoxLayout()
+        btnLayout.addStretch()
+        for label, action in (('Refresh', self.refreshSqlStats), ('Reset', self.resetSqlStats),
+                              ('Save JSON...', self.saveSqlStats)):
+            button = QPushButton(label)
+            button.setFixedSize(button.sizeHint())
+            button.setEnabled(sql_stats.enabled)
+            button.clicked.connect(action)
+            btnLayout.addWidget(button)
+        btnLayout.addStretch()
+        layout.addLayout(btnLayout)
+
+        tab.setLayout(layout)
+        self.refreshSqlStats()
+        return tab
+
     def createResetPasswordTab(self):
         tab = PasswordGUI(self.curr_user)
         return tab
         
     def updateDatabase(self):
-        print("Update Database clicked")
+        def progress(step, total_steps, description):
+            self.updateDatabaseProgress.setMaximum(total_steps)
+            self.updateDatabaseProgress.setValue(step - 1)
+            self.updateDatabaseStatus.setText(f"Step {step} of {total_steps}: {description}")
+            QApplication.processEvents()   # repaint the progress bar between steps
+
+        try:
+            with operation('database migration'):
+                version = migrate(progress=progress)
+        except sqlite3.Error as e:
+            self.updateDatabaseStatus.setText(f'<font color="red">Update failed, no changes were made: {e}</font>')
+            return
+        self.updateDatabaseProgress.setMaximum(1)
+        self.updateDatabaseProgress.setValue(1)
+        self.updateDatabaseStatus.setText(f'<font color="green">The database is up to date (version {version}).</font>')
+
+    def importUsers(self):
+        path_to_csv, _ = QFileDialog.getOpenFileName(self, "Import CSV Roster", os.path.expanduser('~'),
+                                                     "CSV files (*.csv);;All files (*)")
+        if not path_to_csv:
+            return
+
+        def progress(rows_done, rows_per_sec):
+            self.importStatus.setText(f"{rows_done} rows ({rows_per_sec:.0f} rows/s)")
+            QApplication.processEvents()   # keep the GUI responsive during long imports
+
+        dry_run = self.dryRunImportCheckBox.isChecked()
+        with operation('roster import'):
+            counts = import_roster(path_to_csv, dry_run=dry_run, progress=progress)
+        if counts is None:
+            self.importStatus.setText('<font color="red">Import failed, no changes were made.</font>')
+            return
+        summary = (f"{counts['inserted']} inserted, {counts['updated']} updated, "
+                   f"{counts['unchanged']} unchanged, {counts['skipped']} skipped "
+                   f"({counts['skipped_admin']} admin, {counts['skipped'] - counts['skipped_admin']} invalid email)")
+        if dry_run:
+            self.importStatus.setText(f"Dry run: {summary}")
+        else:
+            self.importStatus.setText(f'<font color="green">Imported: {summary}</font>')
+
+    def refreshSqlStats(self):
+        rows = sql_stats.snapshot()
+        self.sqlStatsTable.setSortingEnabled(False)     # do not re-sort while the rows are filled
+        self.sqlStatsTable.setRowCount(len(rows))
+        for row_number, row in enumerate(rows):
+            for column_number, (_, key) in enumerate(SQL_STATS_COLUMNS):
+                value = row[key]
+                if key == 'call_sites':
+                    value = ", ".join(value)
+                item = QTableWidgetItem()
+                item.setData(Qt.DisplayRole, value)     # numbers sort as numbers
+                if key == 'template':
+                    item.setToolTip(value)
+                self.sqlStatsTable.setItem(row_number, column_number, item)
+        self.sqlStatsTable.setSortingEnabled(True)
+
+    def resetSqlStats(self):
+        sql_stats.reset()
+        self.refreshSqlStats()
+
+    def saveSqlStats(self):
+        default_path = os.path.join(os.path.expanduser('~'), 'Downloads',
+                                    f"sql_stats_{datetime.now().strftime('%Y_%m_%d_%H%M')}.json")
+        path, _ = QFileDialog.getSaveFileName(self, "Save SQL Statistics", default_path, "JSON files (*.json)")
+        if path and not sql_stats.dump(path):
+            QMessageBox.warning(self, "Save Failed", f"Failed to write {path}.")
 
     def openAddOrEditUserGUI(self):
         self.addOrEditUserGUI = AddOrEditUserGUI()
@@ -344,9 +507,28 @@ class SettingsGUI(QWidget):
         self.passwordGUI.show()
     
     def exportDatabase(self):
+        compress = self.compressExportCheckBox.isChecked()
+
+        def progress(table_name):
+            def report(rows_written, rows_per_sec):
+                self.exportStatus.setText(f"{table_name}: {rows_written} rows ({rows_per_sec:.0f} rows/s)")
+                QApplication.processEvents()   # keep the GUI responsive during long exports
+            return report
+
+        if self.incrementalExportCheckBox.isChecked():
+            delta = export_delta(DELTA_EXPORT_FOLDER, compress=compress,
+                                 progress=lambda table_name, rows, rate: progress(table_name)(rows, rate))
+            if delta:
+                message = (f"Delta {delta['sequence']} exported to {DELTA_EXPORT_FOLDER}: "
+                           f"{delta['rows']['events']} events, {delta['rows']['users']} users.")
+                QMessageBox.information(self, "Export Successful", message)
+            else:
+                QMessageBox.warning(self, "Export Failed", "Failed to export database.")
+            return
+
         # Attempt to export both tables and capture their success status
-        success_users = export_table_to_csv('users')
-        success_events = export_table_to_csv('events')
+        success_users = export_table_to_csv('users', compress=compress, progress=progress('users'))
+        success_events = export_table_to_csv('events', compress=compress, progress=progress('events'))
         if success_users and success_events:
             message = "Database exported successfully."
             QMessageBox.information(self, "Export Successful", message)
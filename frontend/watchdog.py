@@ -0,0 +1,146 @@
+'''
+Opt-in diagnostics of a "hung" kiosk: event-loop stall watchdog and cProfile switch
+
+StallWatchdog: a QTimer ticks in the GUI thread every `interval_ms`; a Python thread compares the time of
+the last tick with the clock. When the GUI thread has not ticked for `threshold_ms` (blocking SQLite call,
+QWebEngine page, hashing...), the stack of the GUI thread and the active operation are written to the log,
+once per stall; when the event loop comes back, the total duration of the stall is written too.
+The active operation is set by the GUI code around the actions that may block:
+    with operation('local login'):
+        login(...)
+
+Profiling: run_profiled(main, path) runs main() under cProfile and writes the profile on exit
+(read it with:  python -m pstats path   or snakeviz).
+
+Enabled from config.json:  "stall_threshold_ms": 500,  "profile": "kiosk.prof"
+or from the environment:   CORES_STALL_THRESHOLD_MS=500   CORES_PROFILE=kiosk.prof
+'''
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import datetime
+from PySide6.QtCore import QObject, QTimer
+
+DEFAULT_LOG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stalls.log')
+
+_operation = None       # what the GUI thread is doing (set by operation())
+
+
+@contextmanager
+def operation(name):
+    '''Name the action of the GUI thread, for the stall reports (nested: the innermost one is reported)'''
+    global _operation
+    previous, _operation = _operation, name
+    try:
+        yield
+    finally:
+        _operation = previous
+
+
+class StallWatchdog(QObject):
+    def __init__(self, threshold_ms=500, interval_ms=100, log_path=None, parent=None):
+        super().__init__(parent)
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.log_path = log_path or DEFAULT_LOG
+        self.stall_count = 0
+        self.max_latency = 0.0              # seconds, largest delay of a tick
+        self._last_tick = time.monotonic()
+        self._stalled_since = None          # time of the last tick before the current stall (reported)
+        self._gui_thread_id = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread = None
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._tick)
+
+    def start(self):
+        self._last_tick = time.monotonic()
+        self._timer.start(int(self.interval * 1000))
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name='stall_watchdog', daemon=True)
+        self._thread.start()
+        print(f"Stall watchdog: reports the GUI thread blocked for more than {self.threshold * 1000:.0f} ms "
+              f"to {self.log_path}")
+
+    def stop(self):
+        self._timer.stop()
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(1)
+            self._thread = None
+
+    def _tick(self):
+        # GUI thread: the event loop is running
+        now = time.monotonic()
+        self.max_latency = max(self.max_latency, now - self._last_tick - self.interval)
+        stalled_since = self._stalled_since
+        self._last_tick = now
+        if stalled_since is not None:
+            self._stalled_since = None
+            self._log(f"event loop back after {(now - stalled_since) * 1000:.0f} ms")
+
+    def _watch(self):
+        # watchdog thread: not blocked by the GUI thread
+        while not self._stop.wait(self.interval / 2):
+            last_tick = self._last_tick
+            if self._stalled_since is None and time.monotonic() - last_tick > self.threshold:
+                self._stalled_since = last_tick
+                self.stall_count += 1
+                self._report(time.monotonic() - last_tick)
+
+    def _report(self, blocked_for):
+        frame = sys._current_frames().get(self._gui_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no stack)\n"
+        self._log(f"GUI thread blocked for {blocked_for * 1000:.0f} ms (operation: {_operation or 'unknown'})\n"
+                  f"{stack}")
+
+    def _log(self, message):
+        line = f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}"
+        print(f"Stall watchdog: {line}")
+        try:
+            with open(self.log_path, 'a', encoding='utf-8') as log_file:
+                log_file.write(line.rstrip('\n') + '\n')
+        except OSError as e:
+            print(f"Stall watchdog: cannot write {self.log_path}: {e}")
+
+
+def stall_threshold_ms(config_dict):
+    '''Threshold of the watchdog from the environment or config.json (None: watchdog off)'''
+    value = os.environ.get('CORES_STALL_THRESHOLD_MS') or config_dict.get('stall_threshold_ms')
+    if not value:
+        return None
+    try:
+        threshold = int(value)
+    except (TypeError, ValueError):
+        threshold = 0
+    if threshold <= 0:
+        print(f"Warning: invalid stall threshold {value!r} (a number of ms is expected): watchdog off.")
+        return None
+    return threshold
+
+
+def profile_path(config_path='config.json'):
+    '''Destination of the cProfile output from the environment or config.json (None: not profiled)'''
+    path = os.environ.get('CORES_PROFILE')
+    if path:
+        return path
+    try:
+        with open(config_path, 'r') as config_file:
+            return json.load(config_file).get('profile')
+    except (OSError, ValueError):
+        return None
+
+
+def run_profiled(function, path):
+    '''Run function() under cProfile; the profile is written to path when it returns, raises or exits'''
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function)
+    finally:
+        profiler.dump_stats(path)
+        print(f"Profile written to {path} (python -m pstats {path})")
@@ -1,20 +1,52 @@
 import sys
 from frontend.main_gui import BigGui
 from PySide6.QtWidgets import QApplication
+from PySide6.QtCore import QTimer
+from backend.main import (initialize_database, close_cores_db, use_remote_events, sweep_orphaned_sessions,
+                          enable_sql_stats, SessionHeartbeat)
+from frontend.watchdog import StallWatchdog, stall_threshold_ms, profile_path, run_profiled
 import json
 
+SWEEP_INTERVAL = 3600000   # milliseconds between two sweeps of the orphaned sessions
+
 def main():
     """
     Entry point for the entire application, initializes the main GUI.
     """
     app = QApplication(sys.argv)
+    app.aboutToQuit.connect(close_cores_db)     # close the pooled database connections on exit
     with open('config.json', 'r') as config_file:
         config_dict = json.load(config_file)
+    if config_dict.get('sql_stats'):            # optional: statistics of the SQL statements (Settings tab)
+        enable_sql_stats()
+    if config_dict.get('events_url'):           # optional: send the events to the ingestion server
+        use_remote_events(config_dict['events_url'])
+    if initialize_database() is None:           # open cores.db and apply pending schema migrations
+        print("The kiosk cannot start: cores.db is not usable.")
+        sys.exit(1)
+    if 'heartbeat_interval' in config_dict:     # optional: seconds between two checkpoints of a session
+        SessionHeartbeat.configure(config_dict['heartbeat_interval'])
+    # close the sessions left open by a crash of this kiosk, then periodically the ones of other devices
+    sweep_orphaned_sessions(config_dict['device_name'])
+    sweep_timer = QTimer()
+    sweep_timer.timeout.connect(lambda: sweep_orphaned_sessions())
+    sweep_timer.start(SWEEP_INTERVAL)
     
+    # optional: report the stalls of the event loop (GUI thread blocked) to stalls.log
+    threshold = stall_threshold_ms(config_dict)
+    if threshold:
+        watchdog = StallWatchdog(threshold)
+        watchdog.start()
+        app.aboutToQuit.connect(watchdog.stop)
+
     main_window = BigGui(config_dict)
     main_window.show()
     app.setStyle("Fusion")
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
-    main()
+    path = profile_path()       # optional: run under cProfile (CORES_PROFILE or "profile" in config.json)
+    if path:
+        run_profiled(main, path)
+    else:
+        main()